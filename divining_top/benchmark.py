@@ -0,0 +1,819 @@
+from optparse import OptionParser
+import psycopg2
+import psycopg2.sql
+import mysql.connector
+import concurrent.futures
+import multiprocessing
+import http.server
+import threading
+import tempfile
+import hashlib
+import datetime
+import random
+import json
+import logging
+import sys
+import os
+from os import path
+
+import divining_top
+
+# The size of the synthetic data at a scale of 1
+sets_per_scale = 20
+cards_per_set = 250
+
+parser = OptionParser(usage="usage: %prog -c CONNECTION [options]")
+
+parser.add_option("-c", "--connection", dest="connection_string",
+                  help="The connection string of the postgres server to "
+                       "benchmark against. A throwaway database is created "
+                       "on it for each scale and dropped afterwards")
+
+parser.add_option("-t", "--template", dest="template_database",
+                  default="divining_top_template",
+                  help="The database to copy the throwaway databases from, "
+                       "which should have the spellbook schema migrated into "
+                       "it and no data")
+
+parser.add_option("-m", "--mysql_connection", dest="mysql_connection_string",
+                  help="The connection string of a throwaway mysql database "
+                       "to benchmark the user migration against. Its cards, "
+                       "usercards and usercardchanges tables are replaced. "
+                       "The migration isn't benchmarked without one")
+
+parser.add_option("-s", "--scales", dest="scales", default="1",
+                  help="A comma separated list of the sizes of synthetic data "
+                       "to benchmark, as multiples of {0} sets of {1} cards, "
+                       "e.g. 1,10,50".format(sets_per_scale, cards_per_set))
+
+parser.add_option("--seed", dest="seed", type="int", default=1,
+                  help="The seed of the synthetic data")
+
+parser.add_option("-b", "--bulk", action="store_true", dest="bulk_load",
+                  help="benchmarks the bulk card load")
+
+parser.add_option("-w", "--workers", dest="workers", type="int", default=1,
+                  help="The number of connections to load sets and migrate "
+                       "users with")
+
+parser.add_option("--pipeline", action="store_true", dest="pipeline",
+                  help="benchmarks the row by row card load with prepared "
+                       "and batched statements")
+
+parser.add_option("--peak_rss", action="store_false", dest="trace_memory", default=True,
+                  help="measures the peak memory of each stage as the peak "
+                       "RSS of the process rather than with tracemalloc, "
+                       "which doesn't slow the stages down but only shows a "
+                       "stage's memory when it's the largest so far, so its "
+                       "regressions can be hidden by earlier stages")
+
+parser.add_option("--set_files", action="store_true", dest="set_files",
+                  help="benchmarks downloading the json as a file per set "
+                       "from a local stand-in for the set files, and loading "
+                       "the sets from those files")
+
+parser.add_option("--skip_images", action="store_true", dest="skip_images",
+                  help="doesn't benchmark the card image download")
+
+parser.add_option("--baselines", dest="baselines_file",
+                  default=path.join(divining_top.dataFolder, 'benchmark_baselines.json'),
+                  help="The file the baseline results are stored in")
+
+parser.add_option("--save_baselines", action="store_true", dest="save_baselines",
+                  help="stores the results of this run as the new baselines "
+                       "rather than comparing them to the old ones")
+
+parser.add_option("--tolerance", dest="tolerance", type="float", default=0.25,
+                  help="How far the throughput can fall or the peak memory "
+                       "can rise from the baseline, as a fraction of it, "
+                       "before the benchmark fails")
+
+parser.add_option("-v", "--verbose", action="store_true", dest="verbose",
+                  help="shows the loader's progress, which is otherwise only "
+                       "logged for warnings")
+
+# The number of mysql users whose cards are migrated, and the share of the
+# cards that each of them owns
+migration_user_count = 5
+migration_owned_share = 0.2
+
+synthetic_languages = [
+    'French',
+    'German',
+    'Italian',
+    'Spanish',
+    'Japanese',
+    'Portuguese (Brazil)',
+    'Russian',
+    'Chinese Simplified',
+    'Korean',
+]
+
+synthetic_rarities = ['Common', 'Uncommon', 'Rare', 'Mythic Rare']
+
+synthetic_types = [
+    (['Creature'], ['Elf', 'Warrior']),
+    (['Creature'], ['Zombie']),
+    (['Instant'], []),
+    (['Sorcery'], []),
+    (['Enchantment'], ['Aura']),
+    (['Artifact'], ['Equipment']),
+    (['Planeswalker'], ['Jace']),
+    (['Land'], []),
+]
+
+# A small JPEG, only the start and end markers of which are checked
+synthetic_image = b'\xff\xd8\xff\xe0' + bytes(8 * 1024) + b'\xff\xd9'
+
+
+def main():
+
+    (options, args) = parser.parse_args()
+
+    if not options.connection_string:
+        parser.error('A postgres connection string is required')
+
+    baselines = load_baselines(options.baselines_file)
+
+    results = {}
+
+    for scale in [int(scale) for scale in options.scales.split(',')]:
+        key = get_baseline_key(scale, options)
+        results[key] = run_benchmark_process(scale, options)
+
+    if options.save_baselines:
+        baselines.update(results)
+        divining_top.write_file_atomically(
+            options.baselines_file, [json.dumps(baselines, indent=2, sort_keys=True).encode('utf8')])
+        print('Saved the baselines to {0}'.format(options.baselines_file))
+        return
+
+    regressions = []
+    for (key, stages) in results.items():
+        print_results(key, stages, baselines.get(key, {}))
+        regressions += find_regressions(key, stages, baselines.get(key, {}), options.tolerance)
+
+    if regressions:
+        print('\nThe benchmark regressed past the baselines:')
+        for regression in regressions:
+            print('  ' + regression)
+        sys.exit(1)
+
+
+def get_baseline_key(scale, options):
+
+    if options.bulk_load:
+        mode = 'bulk'
+    elif options.workers > 1:
+        mode = '{0} workers'.format(options.workers)
+    else:
+        mode = 'serial'
+
+    if options.pipeline and not options.bulk_load:
+        mode += ' pipelined'
+
+    if options.set_files:
+        mode += ' from set files'
+
+    # The peak RSS can't be compared with the peaks from tracemalloc
+    if not options.trace_memory:
+        mode += ' by peak RSS'
+
+    return '{0}x {1}'.format(scale, mode)
+
+
+def configure_logging(verbose):
+
+    logging.basicConfig(level=logging.INFO if verbose else logging.WARNING,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+
+def run_benchmark_process(scale, options):
+    """
+    Runs the benchmark of the given scale in a fresh process, so that the
+    memory of the earlier scales isn't counted in its peak RSS
+    """
+
+    context = multiprocessing.get_context('spawn')
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context,
+                                                initializer=configure_logging,
+                                                initargs=(options.verbose,)) as executor:
+        return executor.submit(run_benchmark, scale, options).result()
+
+
+def run_benchmark(scale, options):
+    """
+    Loads synthetic data of the given scale into a throwaway database,
+    returning the throughput and peak memory of each stage
+    """
+
+    print('Benchmarking at {0}x scale... '.format(scale), flush=True)
+
+    image_server = None
+    if not options.skip_images:
+        image_server = start_image_server()
+
+    set_file_server = None
+    if options.set_files:
+        set_file_server = start_set_file_server()
+
+    try:
+        return run_benchmark_stages(scale, options, image_server, set_file_server)
+    finally:
+        if image_server:
+            image_server.shutdown()
+        if set_file_server:
+            set_file_server.shutdown()
+
+
+def run_benchmark_stages(scale, options, image_server, set_file_server):
+
+    all_sets = generate_all_sets(scale, options.seed)
+
+    work_folder = tempfile.TemporaryDirectory()
+
+    # The loader reads the json from these files rather than the real data
+    divining_top.json_data_file = path.join(work_folder.name, 'AllSets-x.json')
+    divining_top.json_zip_file = path.join(work_folder.name, 'AllSets-x.json.zip')
+    divining_top.sets_folder = path.join(work_folder.name, 'sets')
+    divining_top.set_manifest_file = path.join(divining_top.sets_folder, 'manifest.json')
+
+    with open(divining_top.json_data_file, 'w', encoding='utf8') as f:
+        json.dump(all_sets, f)
+
+    connection_string = create_benchmark_database(options)
+
+    loader_options = divining_top.options
+    loader_options.connection_string = connection_string
+    loader_options.bulk_load = options.bulk_load
+    loader_options.workers = options.workers
+    loader_options.pipeline = options.pipeline
+    loader_options.trace_memory = options.trace_memory
+    loader_options.image_folder = path.join(work_folder.name, 'images')
+    loader_options.image_rate = 0
+    loader_options.sets_url = None
+
+    if options.mysql_connection_string:
+        build_mysql_data(all_sets, options.mysql_connection_string)
+        loader_options.mysql_connection_string = options.mysql_connection_string
+        loader_options.mysql_users = ','.join('{0}=benchmark_user_{0}'.format(user_id)
+                                              for user_id in range(1, migration_user_count + 1))
+
+    if set_file_server:
+        set_file_server.set_files = get_set_files(all_sets)
+        loader_options.sets_url = 'http://127.0.0.1:{0}'.format(set_file_server.server_address[1])
+
+    if image_server:
+        divining_top.image_download_url = 'http://127.0.0.1:{0}/Handlers/Image.ashx?multiverseid={{0}}&type=card'.format(
+            image_server.server_address[1])
+        os.makedirs(loader_options.image_folder)
+
+    # The loader only sees the data through the files and servers above, so
+    # the generated copy isn't left to count against its memory
+    del all_sets
+
+    # The state of the last run is thrown away
+    divining_top.id_cache = divining_top.IdCache()
+    divining_top.content_manifest = divining_top.ContentManifest()
+    divining_top.card_faces = divining_top.CardFaces()
+    divining_top.rate_limiters.clear()
+    divining_top.run_metrics = metrics = divining_top.RunMetrics()
+
+    try:
+        run_loader_stages(metrics, options)
+    finally:
+        drop_benchmark_database(options)
+        work_folder.cleanup()
+
+    results = {}
+    for stage in metrics.stages:
+        rows = sum(count for (counter, count) in stage['rows'].items()
+                   if counter not in ('skipped', 'failed'))
+
+        results[stage['name']] = {
+            'rows': rows,
+            'wall_seconds': stage['wall_seconds'],
+            'rows_per_second': rows / max(stage['wall_seconds'], 0.000001),
+            'peak_memory_bytes': stage['peak_memory_bytes'],
+        }
+
+    print("Done\n", flush=True)
+
+    return results
+
+
+def run_loader_stages(metrics, options):
+
+    metrics.start()
+
+    if options.set_files:
+        with metrics.stage('set_download'):
+            divining_top.download_set_files()
+
+        # Every set is unchanged the second time, so this times how quickly
+        # the server's answers to the conditional requests are handled
+        with metrics.stage('set_revalidation'):
+            divining_top.download_set_files()
+
+    with metrics.stage('parse') as stage:
+        json_data = divining_top.parse_json_data()
+        stage['rows']['parsed'] = sum(len(set[1]['cards']) for set in json_data)
+
+    connection = divining_top.connect_to_database()
+
+    with metrics.stage('reference_tables'):
+        divining_top.update_rarity_table(connection)
+        divining_top.update_language_information(connection)
+        divining_top.update_block_information(json_data, connection)
+        divining_top.update_set_information(json_data, connection)
+        divining_top.create_search_columns(connection)
+        divining_top.create_printing_language_view(connection)
+        divining_top.id_cache.load(connection)
+
+    with metrics.stage('cards'):
+        if options.bulk_load:
+            divining_top.bulk_update_card_information(json_data, connection)
+        elif options.workers > 1:
+            divining_top.parallel_update_card_information(json_data, connection)
+        else:
+            divining_top.update_card_information(json_data, connection)
+
+    with metrics.stage('search_columns'):
+        divining_top.update_search_columns(connection)
+
+    with metrics.stage('rulings'):
+        divining_top.update_ruling_table(json_data, connection)
+
+    with metrics.stage('physical_cards'):
+        divining_top.update_physical_cards(connection)
+
+    with metrics.stage('printing_language_view'):
+        divining_top.refresh_printing_language_view(connection)
+
+    with metrics.stage('commit'):
+        connection.commit()
+
+    if options.mysql_connection_string:
+        create_benchmark_users(connection)
+
+        with metrics.stage('migration'):
+            divining_top.migrate_database(connection)
+            connection.commit()
+
+    if not options.skip_images:
+        with metrics.stage('images'):
+            divining_top.download_card_images(connection)
+
+    connection.close()
+
+    metrics.finish()
+
+
+def generate_all_sets(scale, seed):
+    """
+    Generates AllSets shaped json data with the given multiple of
+    sets_per_scale sets, including reprints, foreign names, rulings and
+    split, double-faced and meld cards
+    """
+
+    rng = random.Random(seed)
+
+    set_count = sets_per_scale * scale
+
+    # Cards are reprinted in several sets, so there are fewer cards than
+    # printings
+    card_names = ['Synthetic Card {0}'.format(index)
+                  for index in range(set_count * cards_per_set // 3)]
+
+    all_sets = {}
+    next_multiverse_id = [1]
+
+    def get_multiverse_id():
+        next_multiverse_id[0] += 1
+        return next_multiverse_id[0]
+
+    for set_index in range(set_count):
+
+        set_code = 'S{0:03d}'.format(set_index)
+
+        # The cards in each group share a collector number, with a letter for
+        # each face
+        card_groups = [[generate_card(rng, card_name, 'normal', None)]
+                       for card_name in rng.sample(card_names, cards_per_set - 5)]
+
+        # Multi-faced cards share a pool of names so that they get reprinted
+        # too
+        pair_index = rng.randrange(set_count)
+
+        for (layout, front_name, back_name) in [('split', 'Synthetic Fire {0}', 'Synthetic Ice {0}'),
+                                                ('double-faced', 'Synthetic Day {0}', 'Synthetic Night {0}')]:
+            names = [front_name.format(pair_index), back_name.format(pair_index)]
+            card_groups.append([generate_card(rng, names[0], layout, names, set_index),
+                                generate_card(rng, names[1], layout, names, set_index)])
+
+        meld_names = ['Synthetic Meld Top {0}'.format(pair_index),
+                      'Synthetic Meld Bottom {0}'.format(pair_index),
+                      'Synthetic Meld Whole {0}'.format(pair_index)]
+        card_groups.append([generate_card(rng, meld_names[0], 'meld', [meld_names[0], meld_names[2]], set_index),
+                            generate_card(rng, meld_names[2], 'meld', meld_names, set_index)])
+        card_groups.append([generate_card(rng, meld_names[1], 'meld', [meld_names[1], meld_names[2]], set_index)])
+
+        # Like the oldest real sets, some sets have no collector numbers
+        numbered = set_index % 5 != 0
+
+        cards = []
+
+        for (group_index, card_group) in enumerate(card_groups):
+            for (face_index, card) in enumerate(card_group):
+
+                card['multiverseid'] = get_multiverse_id()
+
+                if not numbered:
+                    card['mciNumber'] = str(len(cards) + 1)
+                elif len(card_group) == 1:
+                    card['number'] = str(group_index + 1)
+                else:
+                    card['number'] = '{0}{1}'.format(group_index + 1, 'ab'[face_index])
+
+                for foreign_name in card.get('foreignNames', []):
+                    if rng.random() < 0.25:
+                        foreign_name['multiverseid'] = get_multiverse_id()
+
+                cards.append(card)
+
+        all_sets[set_code] = {
+            'name': 'Synthetic Set {0}'.format(set_index),
+            'code': set_code,
+            'releaseDate': (datetime.date(1993, 8, 5) + datetime.timedelta(days=30 * set_index)).isoformat(),
+            'block': 'Synthetic Block {0}'.format(set_index // 3),
+            'type': 'expansion',
+            'cards': cards,
+        }
+
+    return all_sets
+
+
+def generate_card(rng, card_name, layout, names, language_seed=None):
+    """
+    Generates a printing of a card. The details of the card itself are
+    seeded by its name so that its reprints match, and the faces of a
+    multi-faced card are given the same language_seed so that they are
+    printed in the same languages
+    """
+
+    card_rng = random.Random(card_name)
+    language_rng = random.Random(language_seed) if language_seed is not None else rng
+
+    (types, subtypes) = card_rng.choice(synthetic_types)
+
+    card = {
+        'name': card_name,
+        'layout': layout,
+        'manaCost': '{' + str(card_rng.randint(0, 6)) + '}',
+        'cmc': card_rng.randint(0, 6),
+        'colors': card_rng.sample(['White', 'Blue', 'Black', 'Red', 'Green'], card_rng.choice([0, 1, 1, 1, 2])),
+        'types': types,
+        'subtypes': subtypes,
+        'text': 'Synthetic rules text for {0}.'.format(card_name),
+        'artist': 'Synthetic Artist {0}'.format(rng.randrange(100)),
+        'rarity': rng.choice(synthetic_rarities),
+    }
+
+    if names:
+        card['names'] = names
+
+    if 'Creature' in types:
+        card['power'] = card_rng.choice(['0', '1', '2', '3', '*', '1+*'])
+        card['toughness'] = card_rng.choice(['1', '2', '3', '4'])
+
+    if 'Planeswalker' in types:
+        card['loyalty'] = str(card_rng.randint(2, 6))
+
+    if rng.random() < 0.3:
+        card['flavor'] = 'Synthetic flavour text.'
+
+    if language_rng.random() < 0.6:
+        card['foreignNames'] = [{
+            'language': language,
+            'name': '{0} ({1})'.format(card_name, language),
+        } for language in language_rng.sample(synthetic_languages, language_rng.randint(1, len(synthetic_languages)))]
+
+    if card_rng.random() < 0.3:
+        card['rulings'] = [{
+            'date': '2016-0{0}-01'.format(index + 1),
+            'text': 'Synthetic ruling {0} for {1}.'.format(index, card_name),
+        } for index in range(card_rng.randint(1, 3))]
+
+    return card
+
+
+def create_benchmark_database(options):
+    """
+    Creates the throwaway database from the template database, returning
+    its connection string
+    """
+
+    database_name = get_benchmark_database_name()
+
+    connection = psycopg2.connect(options.connection_string)
+    connection.autocommit = True
+
+    cursor = connection.cursor()
+    cursor.execute(psycopg2.sql.SQL("DROP DATABASE IF EXISTS {0}").format(
+        psycopg2.sql.Identifier(database_name)))
+    cursor.execute(psycopg2.sql.SQL("CREATE DATABASE {0} TEMPLATE {1}").format(
+        psycopg2.sql.Identifier(database_name),
+        psycopg2.sql.Identifier(options.template_database)))
+    cursor.close()
+
+    connection.close()
+
+    return psycopg2.extensions.make_dsn(options.connection_string, dbname=database_name)
+
+
+def drop_benchmark_database(options):
+
+    connection = psycopg2.connect(options.connection_string)
+    connection.autocommit = True
+
+    cursor = connection.cursor()
+    cursor.execute(psycopg2.sql.SQL("DROP DATABASE IF EXISTS {0}").format(
+        psycopg2.sql.Identifier(get_benchmark_database_name())))
+    cursor.close()
+
+    connection.close()
+
+
+def get_benchmark_database_name():
+    return 'divining_top_benchmark_{0}'.format(os.getpid())
+
+
+def create_benchmark_users(connection):
+
+    cursor = connection.cursor()
+
+    for user_id in range(1, migration_user_count + 1):
+        cursor.execute("""
+INSERT INTO auth_user (
+    password,
+    is_superuser,
+    username,
+    first_name,
+    last_name,
+    email,
+    is_staff,
+    is_active,
+    date_joined
+) VALUES (
+    '!',
+    FALSE,
+    %(username)s,
+    '',
+    '',
+    '',
+    FALSE,
+    TRUE,
+    NOW()
+)
+""", {'username': 'benchmark_user_{0}'.format(user_id)})
+
+    cursor.close()
+    connection.commit()
+
+
+def build_mysql_data(all_sets, mysql_connection_string):
+    """
+    Fills the mysql database with owned cards and card changes of the
+    synthetic cards for migration_user_count users
+    """
+
+    rng = random.Random(len(all_sets))
+
+    # Meld backs don't have physical cards of their own to migrate
+    owned_cards = [(card['name'], set_code)
+                   for (set_code, set_data) in sorted(all_sets.items())
+                   for card in set_data['cards']
+                   if not (card['layout'] == 'meld' and len(card['names']) == 3)]
+
+    card_ids = dict((card_name, card_id + 1)
+                    for (card_id, card_name) in enumerate(sorted(set(name for (name, set_code) in owned_cards))))
+
+    connectParams = dict(entry.split('=') for entry in mysql_connection_string.split(';'))
+    cnx = mysql.connector.connect(**connectParams)
+    cursor = cnx.cursor()
+
+    cursor.execute("DROP TABLE IF EXISTS cards")
+    cursor.execute("DROP TABLE IF EXISTS usercards")
+    cursor.execute("DROP TABLE IF EXISTS usercardchanges")
+
+    cursor.execute("""
+CREATE TABLE cards (
+    id INT PRIMARY KEY,
+    name VARCHAR(200) NOT NULL
+)""")
+
+    cursor.execute("""
+CREATE TABLE usercards (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    ownerid INT NOT NULL,
+    cardid INT NOT NULL,
+    count INT NOT NULL,
+    setcode VARCHAR(10) NOT NULL
+)""")
+
+    cursor.execute("""
+CREATE TABLE usercardchanges (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    userid INT NOT NULL,
+    cardid INT NOT NULL,
+    setcode VARCHAR(10) NOT NULL,
+    datemodified DATETIME NOT NULL,
+    difference INT NOT NULL
+)""")
+
+    cursor.executemany("INSERT INTO cards (id, name) VALUES (%s, %s)",
+                       [(card_id, card_name) for (card_name, card_id) in card_ids.items()])
+
+    for user_id in range(1, migration_user_count + 1):
+
+        user_cards = rng.sample(owned_cards, int(len(owned_cards) * migration_owned_share))
+
+        cursor.executemany("""
+INSERT INTO usercards (ownerid, cardid, count, setcode)
+VALUES (%s, %s, %s, %s)""", [(user_id, card_ids[card_name], rng.randint(1, 4), set_code)
+                             for (card_name, set_code) in user_cards])
+
+        cursor.executemany("""
+INSERT INTO usercardchanges (userid, cardid, setcode, datemodified, difference)
+VALUES (%s, %s, %s, %s, %s)""", [(user_id, card_ids[card_name], set_code,
+                                  datetime.datetime(2015, 1, 1) + datetime.timedelta(minutes=index),
+                                  rng.choice([-1, 1, 2]))
+                                 for (index, (card_name, set_code)) in enumerate(user_cards * 2)])
+
+    cnx.commit()
+    cnx.close()
+
+
+class ImageRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Stands in for gatherer, returning the same small image for every
+    request
+    """
+
+    # Keeps the connection alive between requests, like gatherer does
+    protocol_version = 'HTTP/1.1'
+
+    # Otherwise the body waits for the client to acknowledge the headers
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(synthetic_image)))
+        self.end_headers()
+        self.wfile.write(synthetic_image)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SetFileRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Stands in for the set files server, returning the set list and the file
+    of each set from the server's set_files, and answering a request with
+    the file's ETag with 304 Not Modified
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+
+        set_file = self.server.set_files.get(self.path.lstrip('/'))
+
+        if set_file is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        (content, etag) = set_file
+
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def get_set_files(all_sets):
+    """
+    Returns file name -> (content, ETag) of the set list and of each set in
+    the given data, as the set file server serves them
+    """
+
+    set_list = [{'code': set_code, 'name': set_data['name'], 'releaseDate': set_data['releaseDate']}
+                for (set_code, set_data) in all_sets.items()]
+
+    files = [('SetList.json', set_list)]
+    files += [('{0}-x.json'.format(set_code), set_data) for (set_code, set_data) in all_sets.items()]
+
+    set_files = {}
+    for (file_name, data) in files:
+        content = json.dumps(data).encode('utf8')
+        set_files[file_name] = (content, '"{0}"'.format(hashlib.sha1(content).hexdigest()))
+
+    return set_files
+
+
+def start_set_file_server():
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), SetFileRequestHandler)
+    server.daemon_threads = True
+    server.set_files = {}
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server
+
+
+def start_image_server():
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ImageRequestHandler)
+    server.daemon_threads = True
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    return server
+
+
+def load_baselines(file_name):
+
+    if not path.isfile(file_name):
+        return {}
+
+    with open(file_name, 'r', encoding='utf8') as f:
+        return json.load(f)
+
+
+def print_results(key, stages, baselines):
+
+    print('{0}:'.format(key))
+    print('  {0:<18}{1:>10}{2:>10}{3:>12}{4:>12}{5:>12}'.format(
+        'stage', 'rows', 'seconds', 'rows/s', 'peak MB', 'baseline'))
+
+    for (stage_name, result) in stages.items():
+
+        baseline = baselines.get(stage_name)
+        change = ''
+        if baseline and baseline['rows_per_second']:
+            change = '{0:+.0%}'.format(result['rows_per_second'] / baseline['rows_per_second'] - 1)
+
+        print('  {0:<18}{1:>10}{2:>10.2f}{3:>12.0f}{4:>12.1f}{5:>12}'.format(
+            stage_name, result['rows'], result['wall_seconds'], result['rows_per_second'],
+            result['peak_memory_bytes'] / 1024 / 1024, change))
+
+
+def find_regressions(key, stages, baselines, tolerance):
+    """
+    Returns a description of each stage whose throughput or peak memory is
+    worse than its baseline by more than the tolerance
+    """
+
+    regressions = []
+
+    for (stage_name, result) in stages.items():
+
+        baseline = baselines.get(stage_name)
+        if not baseline:
+            continue
+
+        # Stages that don't write any rows only have their memory compared
+        if baseline['rows'] and result['rows_per_second'] < baseline['rows_per_second'] * (1 - tolerance):
+            regressions.append('{0} {1}: {2:.0f} rows/s, down from {3:.0f}'.format(
+                key, stage_name, result['rows_per_second'], baseline['rows_per_second']))
+
+        if result['peak_memory_bytes'] > baseline['peak_memory_bytes'] * (1 + tolerance):
+            regressions.append('{0} {1}: {2:.1f} MB peak memory, up from {3:.1f}'.format(
+                key, stage_name, result['peak_memory_bytes'] / 1024 / 1024,
+                baseline['peak_memory_bytes'] / 1024 / 1024))
+
+    return regressions
+
+
+if __name__ == "__main__":
+    main()
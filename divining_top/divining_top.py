@@ -1,15 +1,35 @@
 ﻿from optparse import OptionParser
 import urllib.request
+import urllib.parse
 import psycopg2
+import psycopg2.sql
 import zipfile
 import json
+import textwrap
+import tempfile
+import shutil
+import hashlib
+import sqlite3
+import datetime
 import requests
 import re
 import queue
 import threading
+import contextlib
+import collections
+import unicodedata
+import logging
 from os import path
+import os
 import time
+import random
+import resource
+import tracemalloc
+import asyncio
+import aiohttp
+import numpy as np
 import mysql.connector
+from psycopg2.extras import execute_values
 
 dataFolder = '../data'
 
@@ -22,20 +42,126 @@ parser.add_option("-c", "--connection", dest="connection_string",
 parser.add_option("-m", "--mysql_connection", dest="mysql_connection_string",
                   help="The mysql connection string")
 
+parser.add_option("--mysql_users", dest="mysql_users", default="1=Liam",
+                  help="The users to migrate from mysql, as a comma separated "
+                       "list of mysql user id=username pairs")
+
 parser.add_option("-d", "--download", action="store_true", dest="download",
                   help="downloads the json file even if it already exists")
 
+parser.add_option("--sets_url", dest="sets_url",
+                  help="downloads the json data as one file per set from "
+                       "this url (which lists the sets in SetList.json) "
+                       "instead of as a single file, only fetching the sets "
+                       "that have changed")
+
+parser.add_option("--set_concurrency", dest="set_concurrency", type="int",
+                  default=8,
+                  help="The number of set files to download at once")
+
 parser.add_option("-i", "--imagedir", dest="image_folder",
                   help="The location to download the card images to")
 
 parser.add_option("-r", "--reset", dest="reset_database",
                   help="Whether to reset the database before loading the data")
 
-(options, args) = parser.parse_args()
-
+parser.add_option("--rebuild_indexes", action="store_true", dest="rebuild_indexes",
+                  help="when resetting the database, drops the indexes and "
+                       "foreign keys of the card tables before loading and "
+                       "rebuilds them once the cards are loaded")
+
+parser.add_option("--stream", action="store_true", dest="stream_json",
+                  help="reads the json file one set at a time instead of "
+                       "loading it all into memory")
+
+parser.add_option("-b", "--bulk", action="store_true", dest="bulk_load",
+                  help="loads cards, printings and languages through COPY "
+                       "into staging tables instead of row by row")
+
+parser.add_option("--incremental", action="store_true", dest="incremental",
+                  help="skips sets and cards that haven't changed since the "
+                       "last incremental load")
+
+parser.add_option("-w", "--workers", dest="workers", type="int", default=1,
+                  help="The number of database connections to load sets, "
+                       "rebuild indexes and migrate users over in parallel "
+                       "(which commits the work done before each parallel "
+                       "stage)")
+
+parser.add_option("--image_concurrency", dest="image_concurrency", type="int",
+                  default=8,
+                  help="The number of card images to download at once")
+
+parser.add_option("--image_rate", dest="image_rate", type="float", default=10,
+                  help="The most card image requests to send to a host each "
+                       "second (or 0 for no limit)")
+
+parser.add_option("--image_retries", dest="image_retries", type="int",
+                  default=5,
+                  help="The number of times to retry a failed card image "
+                       "download")
+
+parser.add_option("--verify_images", action="store_true", dest="verify_images",
+                  help="checks the size and hash of every downloaded card "
+                       "image against the image manifest")
+
+parser.add_option("-l", "--log_level", dest="log_level", default="info",
+                  type="choice", choices=["debug", "info", "warning", "error"],
+                  help="The level of messages to log: debug, info, warning "
+                       "or error. Every card is only logged at debug")
+
+parser.add_option("--progress_interval", dest="progress_interval",
+                  type="float", default=10,
+                  help="The number of seconds between the progress reports "
+                       "of the card load")
+
+parser.add_option("--pipeline", action="store_true", dest="pipeline",
+                  help="runs the statements of the row by row card load as "
+                       "prepared statements, and sends the ones whose "
+                       "results aren't needed to the server in batches")
+
+parser.add_option("--resume", action="store_true", dest="resume",
+                  help="continues the last load from its checkpoints, "
+                       "skipping the stages and sets that it finished, as "
+                       "long as the json data hasn't changed since")
+
+parser.add_option("--commit_sets", dest="commit_sets", type="int", default=10,
+                  help="The number of sets to load between commits, or 0 to "
+                       "only commit once all of the cards are loaded")
+
+parser.add_option("--report", dest="report_file",
+                  help="writes a json report of the time, rows, database "
+                       "round trips and memory used by each stage of the run "
+                       "to this file")
+
+parser.add_option("--prometheus", dest="prometheus_file",
+                  help="writes the run metrics to this file in the prometheus "
+                       "text format, for the node exporter's textfile "
+                       "collector")
+
+parser.add_option("--trace_memory", action="store_true", dest="trace_memory",
+                  help="measures the peak memory of each stage with "
+                       "tracemalloc rather than the peak RSS of the process, "
+                       "which is more accurate but slower")
+
+parser.add_option("--snapshot", dest="snapshot_file",
+                  help="writes a read-only SQLite snapshot of the card "
+                       "catalog to this file once the load is finished, for "
+                       "services that only need to read the cards")
+
+# The command line is parsed in main(), so that the loader's functions can be
+# imported and run with these defaults by other scripts
+options = parser.get_default_values()
+
+logger = logging.getLogger('divining_top')
+
+json_download_url = 'http://mtgjson.com/json/AllSets-x.json.zip'
 json_zip_file = path.join(dataFolder, 'AllSets-x.json.zip')
+json_zip_headers_file = path.join(dataFolder, 'AllSets-x.json.zip.headers')
 json_data_file = path.join(dataFolder, 'AllSets-x.json')
 pretty_json_file = path.join(dataFolder, 'AllSets-x-pretty.json')
+sets_folder = path.join(dataFolder, 'sets')
+set_manifest_file = path.join(sets_folder, 'manifest.json')
 json_pretty_file = path.join(dataFolder, 'AllSets-x-pretty.json')
 
 colour_name_to_flag = {
@@ -54,6 +180,15 @@ colour_code_to_flag = {
     'g': 16,
 }
 
+# Each colour's position in a row of colour flags
+colour_name_to_index = dict((name, index) for (index, name) in enumerate(colour_name_to_flag))
+colour_code_to_index = dict((code, index) for (index, code) in enumerate(colour_code_to_flag))
+
+collector_number_pattern = re.compile('^(?P<special>[a-z]+)?(?P<number>[0-9]+)(?P<letter>[a-z]+)?$')
+mci_number_pattern = re.compile('^(/(?P<setcode>[^/]*)/(?P<language>[^/]*)/)?(?P<number>[0-9]+)(\\.html)?$')
+# Also matches values like '.5', but never a '.' on its own
+number_pattern = re.compile('(\\d*\\.?\\d+)')
+
 rarity_name_to_code = {
     'basic land': 'L',
     'common': 'C',
@@ -62,50 +197,151 @@ rarity_name_to_code = {
     'mythic rare': 'M'
 }
 
-image_download_queue = queue.Queue()
 image_download_url = 'http://gatherer.wizards.com/Handlers/Image.ashx?multiverseid={0}&type=card'
+image_manifest_file_name = 'manifest.sqlite3'
 
 
 def main():
 
+    parser.parse_args(values=options)
+
+    logging.basicConfig(level=getattr(logging, options.log_level.upper()),
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    run_metrics.start()
+
     new_data_file = False
 
-    if options.download or not path.isfile(json_data_file):
-        download_json_data()
-        new_data_file = True
+    if options.sets_url:
+        with run_metrics.stage('download'):
+            new_data_file = download_set_files()
+
+    elif options.download or not (path.isfile(json_zip_file) or path.isfile(json_data_file)):
+        with run_metrics.stage('download'):
+            new_data_file = download_json_data()
 
-    json_data = parse_json_data()
+    with run_metrics.stage('parse'):
+        json_data = parse_json_data()
 
     if new_data_file:
-        pretty_print_json_data(json_data)
+        with run_metrics.stage('pretty_print'):
+            pretty_print_json_data(json_data)
 
     connection = connect_to_database()
 
-    if options.reset_database:
-        reset_database(connection)
+    checkpoints.load(connection)
+
+    # A load that failed with the indexes dropped leaves them recorded, and
+    # they're put back before anything else is loaded, unless this load is
+    # going to rebuild them itself
+    if not (options.reset_database and options.rebuild_indexes) and indexes_dropped(connection):
+        with run_metrics.stage('rebuild_indexes'):
+            rebuild_indexes(connection)
+
+    if options.reset_database and not checkpoints.stage_done('reset'):
+        with run_metrics.stage('reset'):
+            reset_database(connection)
+            checkpoints.complete_stage(connection, 'reset')
+
+    with run_metrics.stage('reference_tables'):
+        update_rarity_table(connection)
+        update_language_information(connection)
+        update_block_information(json_data, connection)
+        update_set_information(json_data, connection)
+        # A resumed load that dropped the indexes leaves the search indexes
+        # to rebuild_indexes too
+        create_search_columns(connection, create_indexes=not indexes_dropped(connection))
+        create_printing_language_view(connection)
+        connection.commit()
+
+    if options.reset_database and options.rebuild_indexes and not checkpoints.stage_done('drop_indexes'):
+        with run_metrics.stage('drop_indexes'):
+            drop_indexes(connection)
+            checkpoints.complete_stage(connection, 'drop_indexes')
+
+    with run_metrics.stage('id_cache'):
+        id_cache.load(connection)
+
+        if options.incremental:
+            content_manifest.load(connection)
+
+    # The cards are checkpointed set by set, so this stage is always run to
+    # pick up the sets that weren't finished
+    with run_metrics.stage('cards'):
+        if options.bulk_load:
+            bulk_update_card_information(json_data, connection)
+        elif options.workers > 1:
+            parallel_update_card_information(json_data, connection)
+        else:
+            update_card_information(json_data, connection)
+
+        update_search_columns(connection)
+        connection.commit()
+
+    if not checkpoints.stage_done('rulings'):
+        with run_metrics.stage('rulings'):
+            update_ruling_table(json_data, connection)
+            checkpoints.complete_stage(connection, 'rulings')
+
+    if not checkpoints.stage_done('physical_cards'):
+        with run_metrics.stage('physical_cards'):
+            update_physical_cards(connection)
+            checkpoints.complete_stage(connection, 'physical_cards')
+
+    if options.reset_database and options.rebuild_indexes and not checkpoints.stage_done('rebuild_indexes'):
+        with run_metrics.stage('rebuild_indexes'):
+            rebuild_indexes(connection)
+            checkpoints.complete_stage(connection, 'rebuild_indexes')
+
+    if not checkpoints.stage_done('printing_language_view'):
+        with run_metrics.stage('printing_language_view'):
+            refresh_printing_language_view(connection)
+            checkpoints.complete_stage(connection, 'printing_language_view')
+
+    if options.incremental and not checkpoints.stage_done('content_manifest'):
+        with run_metrics.stage('content_manifest'):
+            content_manifest.save(connection)
+            checkpoints.complete_stage(connection, 'content_manifest')
+
+    if options.mysql_connection_string and not checkpoints.stage_done('migration'):
+        with run_metrics.stage('migration'):
+            migrate_database(connection)
+            checkpoints.complete_stage(connection, 'migration')
+
+    with run_metrics.stage('commit'):
+        # The load is finished, so the next one starts from scratch
+        checkpoints.clear(connection)
+        connection.commit()
+
+    if options.snapshot_file:
+        with run_metrics.stage('snapshot'):
+            export_catalog_snapshot(connection)
 
-    update_rarity_table(connection)
-    update_language_information(connection)
-    update_block_information(json_data, connection)
-    update_set_information(json_data, connection)
-    update_card_information(json_data, connection)
-    update_ruling_table(json_data, connection)
-    update_physical_cards(json_data, connection)
+    if options.image_folder:
+        with run_metrics.stage('images'):
+            download_card_images(connection)
 
-    if options.mysql_connection_string:
-        migrate_database(connection)
+    connection.close()
 
-    connection.commit()
+    run_metrics.finish()
 
-    if options.image_folder:
-        download_card_images(connection)
+    if options.report_file:
+        run_metrics.write_report(options.report_file)
 
-    connection.close()
+    if options.prometheus_file:
+        run_metrics.write_prometheus(options.prometheus_file)
 
 
 def parse_json_data():
-    f = open(json_data_file, 'r', encoding="utf8")
-    json_data = json.load(f, encoding='UTF-8')
+
+    if options.sets_url:
+        return SetFilesJsonData(set_manifest_file)
+
+    if options.stream_json:
+        return StreamedJsonData(open_json_data_file)
+
+    f = open_json_data_file()
+    json_data = json.load(f)
     f.close()
 
     json_data = sorted(json_data.items(),
@@ -114,386 +350,3846 @@ def parse_json_data():
     return json_data
 
 
-def pretty_print_json_data(json_data):
-    f = open(pretty_json_file, 'w', encoding='utf8')
-    f.write(json.dumps(json_data,
-                       sort_keys=True,
-                       indent=2,
-                       separators=(',', ':')))
-    f.close()
+def open_json_data_file():
+    """
+    Opens the json data in binary mode, reading it straight out of the
+    downloaded zip file if there is one
+    """
 
+    if not path.isfile(json_zip_file):
+        return open(json_data_file, 'rb')
 
-def download_json_data():
+    # The member keeps the zip file open for as long as it is itself open
+    return zipfile.ZipFile(json_zip_file).open(path.basename(json_data_file))
 
-    url = "http://mtgjson.com/json/AllSets-x.json.zip"
-    r = requests.get(url)
 
-    with open(json_zip_file, 'wb') as output:
-        output.write(r.content)
+class StreamedJsonData:
+    """
+    A re-iterable sequence of (set code, set data) pairs, in release order,
+    that only ever holds one set in memory at a time.
+
+    The file is scanned once up front to find the release date and byte range
+    of each set, after which every iteration seeks to each set and decodes it
+    on its own. Seeking backwards in a compressed zip member means
+    decompressing it again from the start, so a zip member is extracted to a
+    temporary file once and the sets are read from there instead.
+    """
 
-    zip = zipfile.ZipFile(json_zip_file)
-    zip.extractall(dataFolder)
+    def __init__(self, open_json_file):
+        self.open_json_file = open_json_file
+        self.extracted_file = None
 
+        with open_json_file() as json_file:
+            if isinstance(json_file, zipfile.ZipExtFile):
+                # The temporary file is deleted when this is garbage collected
+                self.extracted_file = tempfile.NamedTemporaryFile('wb', dir=dataFolder,
+                                                                  suffix='.json')
+                shutil.copyfileobj(json_file, self.extracted_file, 1 << 20)
+                self.extracted_file.flush()
+                self.open_json_file = lambda: open(self.extracted_file.name, 'rb')
 
-def connect_to_database():
+        with self.open_json_file() as json_file:
+            self.index = index_json_sets(json_file)
 
-    conn = psycopg2.connect(options.connection_string)
-    return conn
+        # The sort is stable, so sets released on the same day keep their
+        # order in the file (as they would when sorting the whole dictionary)
+        self.index.sort(key=lambda entry: entry[1])
 
+    def __len__(self):
+        return len(self.index)
 
-def reset_database(connection):
+    def __iter__(self):
 
-    cursor = connection.cursor()
+        with self.open_json_file() as json_file:
+            for (set_code, release_date, offset, length) in self.index:
+                json_file.seek(offset)
+                set_data = json.loads(json_file.read(length).decode('utf8'))
+                yield (set_code, set_data)
 
-    cursor.execute("""
-TRUNCATE spellbook_card CASCADE;
-ALTER SEQUENCE spellbook_block_id_seq RESTART;
-ALTER SEQUENCE spellbook_card_id_seq RESTART;
-ALTER SEQUENCE spellbook_cardprinting_id_seq RESTART;
-ALTER SEQUENCE spellbook_cardprintinglanguage_id_seq RESTART;
-ALTER SEQUENCE spellbook_cardruling_id_seq RESTART;
-TRUNCATE spellbook_physicalcard CASCADE;
-ALTER SEQUENCE spellbook_physicalcard_id_seq RESTART;
-TRUNCATE spellbook_rarity CASCADE;
-ALTER SEQUENCE spellbook_rarity_id_seq RESTART;
-TRUNCATE spellbook_set CASCADE;
-ALTER SEQUENCE spellbook_set_id_seq RESTART;
-TRUNCATE spellbook_language;
-ALTER SEQEUNCE spellbook_language_id_seq RESTART;
-""")
 
-    cursor.close()
+def index_json_sets(json_file):
+    """
+    Returns a list of (set code, release date, offset, length) entries for
+    each set in the given binary json file
+    """
 
+    index = []
 
-def update_rarity_table(connection):
-    cursor = connection.cursor()
+    for (set_code, set_data, offset, length) in iterate_json_object(json_file):
+        index.append((set_code, set_data['releaseDate'], offset, length))
 
-    cursor.execute("""
-INSERT INTO spellbook_rarity (
-    symbol,
-    name,
-    display_order
-) VALUES (
-    'L',
-    'Basic Land',
-    10
-), (
-    'C',
-    'Common',
-    20
-), (
-    'U',
-    'Uncommon',
-    30
-), (
-    'R',
-    'Rare',
-    40
-), (
-    'M',
-    'Mythic Rare',
-    50
-), (
-    'T',
-    'Timeshifted',
-    60
-), (
-    'S',
-    'Special',
-    70
-)
-ON CONFLICT(symbol) DO NOTHING;
-""")
+    return index
 
-    cursor.close()
 
-def update_language_information(connection):
-    
-    cursor = connection.cursor()
+def iterate_json_object(json_file, chunk_size=1 << 20):
+    """
+    Yields (key, value, offset, length) for each member of the top level
+    object in the given binary json file, reading it in chunks.
 
-    cursor.execute("""
-INSERT INTO spellbook_language (
-    name,
-    mci_code
-) VALUES (
-   'English',
-   'en'
-), (
-   'Chinese Simplified',
-   'tw'
-), (
-   'Chinese Traditional',
-   'ch'
-), (
-   'French',
-   'fr'
-), (
-   'German',
-   'de'
-), (
-   'Italian',
-   'it'
-), (
-   'Japanese',
-   'jp'
-), (
-   'Italian',
-   'it'
-), (
-   'Portuguese (Brazil)',
-   'pt'
-), (
-   'Russian',
-   'ru'
-), (
-   'Spanish',
-   'es'
-), (
-   'Korean',
-   NULL
-)
-ON CONFLICT(name) DO NOTHING;
-""")
+    The file is decoded as latin-1 so that string offsets are byte offsets.
+    Every structural json character is ASCII, so this is safe for finding
+    the extent of each member, but any non-ASCII text in the yielded values
+    will be garbled (decode the byte range as UTF-8 to get the real value).
+    """
 
-    cursor.close()
+    decoder = json.JSONDecoder()
+    buffer = ''
+    buffer_offset = 0
+    position = 0
+    end_of_file = False
+
+    def read_more(size):
+        nonlocal buffer, end_of_file
+        chunk = json_file.read(size)
+        if not chunk:
+            end_of_file = True
+            return False
+        buffer += chunk.decode('latin-1')
+        return True
+
+    def next_token():
+        nonlocal position
+        while True:
+            while position < len(buffer) and buffer[position].isspace():
+                position += 1
+            if position < len(buffer):
+                return buffer[position]
+            if not read_more(chunk_size):
+                raise ValueError('Unexpected end of json file')
+
+    def decode_value():
+        nonlocal position
+        while True:
+            try:
+                (value, end) = decoder.raw_decode(buffer, position)
+                start = position
+                position = end
+                return (value, start)
+            except ValueError:
+                # The value is probably split over the end of the buffer, so
+                # double the amount read each time to stay linear in its size
+                if end_of_file or not read_more(max(chunk_size, len(buffer))):
+                    raise
+
+    if next_token() != '{':
+        raise ValueError('Expected a json object')
+    position += 1
+
+    if next_token() == '}':
+        return
 
-def update_block_information(json_data, connection):
+    while True:
+        next_token()
+        (key, start) = decode_value()
 
-    print("Updating block information... ")
+        if next_token() != ':':
+            raise ValueError('Expected ":" after key {0}'.format(key))
+        position += 1
+        next_token()
 
-    cursor = connection.cursor()
+        (value, start) = decode_value()
+        yield (key, value, buffer_offset + start, position - start)
 
-    for set in json_data:
+        token = next_token()
+        position += 1
+        if token == '}':
+            return
+        if token != ',':
+            raise ValueError('Expected "," or "}}" after {0}'.format(key))
 
-        # Ignore sets that have no block
-        if 'block' not in set[1]:
-            continue
+        # Drop everything that has already been decoded
+        buffer = buffer[position:]
+        buffer_offset += position
+        position = 0
 
-        cursor.execute("""
-INSERT INTO spellbook_block (
-    name,
-    release_date
-) VALUES (
-    %(block_name)s,
-    %(release_date)s
-) ON CONFLICT (name) DO NOTHING
-        """, {
-        'block_name': set[1]['block'],
-        'release_date': set[1]['releaseDate']
-        })
 
-    cursor.close()
+def pretty_print_json_data(json_data):
+    f = open(pretty_json_file, 'w', encoding='utf8')
 
-    print("Done\n")
+    # Written one set at a time (with the same layout json.dumps would give
+    # the whole list) so streamed data doesn't have to be held in memory
+    f.write('[\n')
+    for (index, set) in enumerate(json_data):
+        if index > 0:
+            f.write(',\n')
+        f.write(textwrap.indent(json.dumps(set,
+                                           sort_keys=True,
+                                           indent=2,
+                                           separators=(',', ':')), '  '))
+    f.write('\n]')
 
+    f.close()
 
-def update_set_information(json_data, connection):
 
-    print("Updating set information... ")
-    cursor = connection.cursor()
+def download_json_data():
+    """
+    Downloads the json zip file if it has changed since it was last
+    downloaded, returning whether it was downloaded
+    """
 
-    for set in json_data:
+    headers = {}
 
-        cursor.execute("""
-INSERT INTO spellbook_set (
-    code,
-    name,
-    release_date,
-    block_id,
-    mci_code
-) VALUES (
-    %(set_code)s,
-    %(set_name)s,
-    %(release_date)s,
-    (SELECT id FROM spellbook_block WHERE name = %(block_name)s),
-    %(mci_code)s
-) ON CONFLICT (code) DO UPDATE SET mci_code = EXCLUDED.mci_code""", {
-            'set_code': set[0],
-            'set_name': set[1]['name'],
-            'release_date': set[1]['releaseDate'],
-            'block_name': set[1].get('block'),
-            'mci_code': set[1].get('magicCardsInfoCode')
-        })
+    if path.isfile(json_zip_file) and path.isfile(json_zip_headers_file):
+        with open(json_zip_headers_file, 'r', encoding='utf8') as f:
+            headers = get_conditional_headers(json.load(f))
 
-    cursor.close()
+    r = requests.get(json_download_url, headers=headers, stream=True, timeout=60)
 
-    print("Done\n")
+    if r.status_code == 304:
+        logger.info("The json file has not changed since it was last downloaded")
+        r.close()
+        return False
 
+    r.raise_for_status()
 
-def update_card_information(json_data, connection):
+    try:
+        write_file_atomically(json_zip_file, r.iter_content(chunk_size=1 << 20))
+    finally:
+        r.close()
 
-    cursor = connection.cursor()
+    with open(json_zip_headers_file, 'w', encoding='utf8') as f:
+        json.dump(get_validators(r.headers), f)
 
-    for set in json_data:
+    return True
 
-        collector_number = 0
-        for card in set[1]['cards']:
-            collector_number += 1
-            update_card(card, set[0], cursor, collector_number)
 
-    cursor.close()
+def get_validators(response_headers):
+    """
+    Returns the validators of a download (its ETag and Last-Modified date),
+    to be stored alongside it
+    """
 
+    return {
+        'etag': response_headers.get('ETag'),
+        'last_modified': response_headers.get('Last-Modified')
+    }
 
-def get_card_id(cursor, card_name):
 
-    # Find whether a card of the given name exists in the database yet
-    cursor.execute("""
-SELECT c.id card_id
-FROM spellbook_card c
-WHERE c.name = %(name)s
-    """, {'name': card_name})
+def get_conditional_headers(validators):
+    """
+    Returns the headers that send the stored validators of the last download
+    back to the server, so that it can tell us if nothing has changed
+    """
 
-    assert(cursor.rowcount < 2)
+    headers = {}
 
-    rows = cursor.fetchone()
-    if rows is not None:
-        return rows[0]
+    if validators.get('etag'):
+        headers['If-None-Match'] = validators['etag']
+    if validators.get('last_modified'):
+        headers['If-Modified-Since'] = validators['last_modified']
 
-    return None
+    return headers
 
-def get_card_printing_id(cursor, card_id, setcode, collector_number, collector_letter):
-    
-    cursor.execute("""
-SELECT id
-FROM spellbook_cardprinting
-WHERE card_id = %(card_id)s
-AND set_id = ( SELECT id FROM spellbook_set WHERE code = %(setcode)s )
-AND collector_number = %(collector_number)s
-AND collector_letter IS NOT DISTINCT FROM %(collector_letter)s
-    """,
-    {
-        'card_id': card_id,
-        'setcode': setcode,
-        'collector_number': collector_number,
-        'collector_letter': collector_letter
-    })
 
-    assert(cursor.rowcount < 2)
+def download_set_files():
+    """
+    Downloads the file of each set in the set list that has changed since it
+    was last downloaded, options.set_concurrency at a time, returning whether
+    any of them were downloaded
+    """
 
-    rows = cursor.fetchone()
-    if rows is not None:
-        return rows[0]
-   
-    return None
+    logger.info("Downloading set files...")
 
-def get_card_printing_language_id(cursor, printing_id, language):
+    os.makedirs(sets_folder, exist_ok=True)
 
-    cursor.execute("""
-SELECT id
-FROM spellbook_cardprintinglanguage
-WHERE card_printing_id = %(printing_id)s
-AND language_id = ( SELECT id FROM spellbook_language WHERE name = %(language)s )
-""", {
-        'language': language,
-        'printing_id': printing_id
-    })
-    rows = cursor.fetchone()
+    r = requests.get(options.sets_url.rstrip('/') + '/SetList.json', timeout=60)
+    r.raise_for_status()
 
-    if rows is None:
-        return None
+    # The sort is stable, so sets released on the same day keep their order
+    # in the list
+    set_list = sorted(r.json(), key=lambda entry: entry['releaseDate'])
 
-    return rows[0]
+    # set code -> the entry it had in the manifest of the last download
+    manifest = {}
+    if path.isfile(set_manifest_file):
+        with open(set_manifest_file, 'r', encoding='utf8') as f:
+            manifest = dict((entry['code'], entry) for entry in json.load(f))
 
-def get_card_details(card):
-    
-    card_colour = 0
-    if 'colors' in card:
-        card_colour = get_colour_flags_from_names(card['colors'])
+    entries = [dict(manifest.get(entry['code'], {}),
+                    code=entry['code'],
+                    release_date=entry['releaseDate'])
+               for entry in set_list]
 
+    downloaded = asyncio.run(download_sets(entries))
 
-    card_details = {
-        'name': card['name'],
-        'cost': card.get('manaCost'),
-        'cmc': card.get('cmc') or 0,
-        'colour': card_colour,
-        'colour_identity':
-            get_colour_flags_from_codes(card['colorIdentity'])
-            if 'colourIdentity' in card
-            else 0,
-        'colour_count': bin(card_colour).count('1'),
-        'type':
-            ' '.join(card['types'])
-            if card.get('types')
-            else None,
-        'subtype':
-            ' '.join(card['subtypes'])
-            if card.get('subtypes')
-            else None,
-        'power': card.get('power'),
-        'num_power':
-            convert_to_number(card['power'])
-            if card.get('power')
-            else 0,
-        'toughness': card.get('toughness'),
-        'num_toughness': convert_to_number(card['toughness'])
-            if card.get('toughness')
-            else 0,
-        'loyalty': card.get('loyalty'),
-        'num_loyalty': convert_to_number(card['loyalty'])
-            if card.get('loyalty')
-            else 0,
-        'rules_text': card.get('text'),
+    # The manifest is only written once every set is on disk, so a failed
+    # download leaves the last complete set of files in place
+    write_file_atomically(set_manifest_file, [json.dumps(entries, indent=2).encode('utf8')])
+
+    logger.info("Downloaded %s of %s sets", downloaded, len(entries))
+
+    return downloaded > 0
+
+
+async def download_sets(entries):
+
+    connector = aiohttp.TCPConnector(limit=options.set_concurrency)
+    timeout = aiohttp.ClientTimeout(total=300)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+
+        # The workers share one iterator, so that each set is only downloaded
+        # by whichever of them gets to it first
+        remaining_entries = iter(entries)
+        workers = [asyncio.create_task(set_download_worker(session, remaining_entries))
+                   for i in range(options.set_concurrency)]
+
+        return sum(await asyncio.gather(*workers))
+
+
+async def set_download_worker(session, entries):
+    """
+    Downloads each of the given sets that has changed, updating its manifest
+    entry, and returns the number that were downloaded
+    """
+
+    downloaded = 0
+
+    for entry in entries:
+
+        set_file = get_set_file_path(entry['code'])
+
+        # A set whose file has gone missing is downloaded unconditionally
+        headers = {}
+        if path.isfile(set_file) and entry.get('sha1'):
+            headers = get_conditional_headers(entry)
+
+        (content, response_headers) = await fetch_with_retries(
+            session, '{0}/{1}-x.json'.format(options.sets_url.rstrip('/'), entry['code']),
+            headers=headers, rate_limited=False)
+
+        if content is None:
+            run_metrics.count('skipped')
+            continue
+
+        # Parsing and writing a set's file takes long enough to hold up the
+        # other downloads, so it's done on a thread
+        entry['sha1'] = await asyncio.to_thread(save_set_file, set_file, content)
+        entry.update(get_validators(response_headers))
+
+        logger.debug('Downloaded set %s', entry['code'])
+        run_metrics.count('downloaded')
+        downloaded += 1
+
+    return downloaded
+
+
+def save_set_file(set_file, content):
+    """
+    Writes the downloaded content of a set's file, returning its hash
+    """
+
+    # Make sure the file is whole before it replaces the last one
+    json.loads(content.decode('utf8'))
+
+    write_file_atomically(set_file, [content])
+
+    return hashlib.sha1(content).hexdigest()
+
+
+def get_set_file_path(setcode):
+    return path.join(sets_folder, setcode + '-x.json')
+
+
+class SetFilesJsonData:
+    """
+    A re-iterable sequence of (set code, set data) pairs, in release order,
+    read from the set files downloaded by download_set_files one set at a
+    time.
+
+    In an incremental load the sets whose files haven't changed since the
+    last one are left out without being read.
+    """
+
+    def __init__(self, manifest_file):
+        with open(manifest_file, 'r', encoding='utf8') as f:
+            self.entries = json.load(f)
+
+    def __len__(self):
+        # Only the sets that will be yielded, so that progress is measured
+        # against the sets that are actually loaded
+        return sum(1 for entry in self.entries
+                   if content_manifest.file_changed(entry['code'], entry['sha1']))
+
+    def __iter__(self):
+
+        for entry in self.entries:
+
+            if not content_manifest.set_file_changed(entry['code'], entry['sha1']):
+                continue
+
+            with open(get_set_file_path(entry['code']), 'rb') as f:
+                set_data = json.load(f)
+
+            yield (entry['code'], set_data)
+
+
+def write_file_atomically(file_name, chunks):
+    """
+    Writes the given chunks of bytes to a temporary file next to the given
+    file and then renames it into place, so that a failed write never
+    replaces a good file with a partial one
+    """
+
+    output = tempfile.NamedTemporaryFile('wb', dir=path.dirname(file_name) or '.',
+                                         suffix='.part', delete=False)
+    try:
+        with output:
+            for chunk in chunks:
+                output.write(chunk)
+        os.replace(output.name, file_name)
+    except BaseException:
+        os.remove(output.name)
+        raise
+
+
+def connect_to_database():
+
+    conn = psycopg2.connect(options.connection_string, cursor_factory=MetricsCursor)
+    return conn
+
+
+class MetricsCursor(psycopg2.extensions.cursor):
+    """
+    A cursor that counts every statement it sends to the server, and the rows
+    written by each one, against the current stage of the run.
+
+    A named (server-side) cursor also goes back to the server for each batch
+    of rows it fetches, so its fetches are counted as round trips too.
+    """
+
+    def execute(self, query, vars=None):
+        result = super().execute(query, vars)
+        run_metrics.add_statement(query, self.rowcount)
+        return result
+
+    def executemany(self, query, vars_list):
+        result = super().executemany(query, vars_list)
+        run_metrics.add_statement(query, self.rowcount)
+        return result
+
+    def copy_expert(self, sql, file, size=8192):
+        result = super().copy_expert(sql, file, size)
+        run_metrics.add_statement(sql, self.rowcount)
+        return result
+
+    def fetchone(self):
+        self.add_fetch()
+        return super().fetchone()
+
+    def fetchmany(self, size=None):
+        self.add_fetch()
+        return super().fetchmany(self.arraysize if size is None else size)
+
+    def fetchall(self):
+        self.add_fetch()
+        return super().fetchall()
+
+    def __iter__(self):
+
+        if self.name is None:
+            return super().__iter__()
+
+        return self.iterate_named()
+
+    def iterate_named(self):
+
+        # The same FETCH FORWARD itersize batches as the cursor's own
+        # iteration, only counted
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            yield from rows
+
+    def add_fetch(self):
+        if self.name is not None:
+            run_metrics.add_statement('FETCH', 0)
+
+
+class RunMetrics:
+    """
+    Records the wall time, CPU time, rows written, database round trips and
+    peak memory of each stage of the run
+
+    Statements queued by a StatementPipeline don't report the rows they
+    wrote, so they're counted as statements under their own counters
+    (queued_updates and so on) rather than in the row counts.
+    """
+
+    # The first word of a statement -> the counter for the rows it affects
+    row_counters = {
+        'INSERT': 'inserted',
+        'UPDATE': 'updated',
+        'DELETE': 'deleted',
+        'COPY': 'copied',
     }
 
-    return card_details
+    def __init__(self):
+        self.stages = []
+        self.current_stage = None
+        self.started = None
+        self.finished = None
+        self.lock = threading.Lock()
+
+    def start(self):
+
+        self.started = datetime.datetime.now(datetime.timezone.utc)
+
+        if options.trace_memory:
+            tracemalloc.start()
+
+    def finish(self):
+
+        self.finished = datetime.datetime.now(datetime.timezone.utc)
+
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+
+        stage = {
+            'name': name,
+            'wall_seconds': 0,
+            'cpu_seconds': 0,
+            'round_trips': 0,
+            'rows': dict((counter, 0) for counter in ['inserted', 'updated', 'deleted', 'skipped']),
+            'peak_memory_bytes': 0,
+        }
+
+        self.stages.append(stage)
+        self.current_stage = stage
+
+        if tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+
+        wall_started = time.perf_counter()
+        cpu_started = time.process_time()
+
+        try:
+            yield stage
+        finally:
+            stage['wall_seconds'] = time.perf_counter() - wall_started
+            stage['cpu_seconds'] = time.process_time() - cpu_started
+
+            if tracemalloc.is_tracing():
+                stage['peak_memory_bytes'] = tracemalloc.get_traced_memory()[1]
+            else:
+                # ru_maxrss is in kilobytes on linux, and is the peak for the
+                # whole process so far rather than just this stage
+                stage['peak_memory_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+            self.current_stage = None
+
+    def count(self, counter, amount=1):
+
+        # Statements run outside of any stage, such as when connecting, are
+        # not counted
+        stage = self.current_stage
+        if stage is None:
+            return
+
+        with self.lock:
+            stage['rows'][counter] = stage['rows'].get(counter, 0) + amount
+
+    def add_statement(self, query, row_count):
+
+        stage = self.current_stage
+        if stage is None:
+            return
+
+        if isinstance(query, bytes):
+            query = query.decode('utf8', 'replace')
+
+        words = str(query).split(None, 1)
+        counter = self.row_counters.get(words[0].upper()) if words else None
+
+        with self.lock:
+            stage['round_trips'] += 1
+
+            if counter and row_count > 0:
+                stage['rows'][counter] = stage['rows'].get(counter, 0) + row_count
+
+    def get_report(self):
+
+        return {
+            'started': self.started.isoformat() if self.started else None,
+            'finished': self.finished.isoformat() if self.finished else None,
+            'wall_seconds': sum(stage['wall_seconds'] for stage in self.stages),
+            'cpu_seconds': sum(stage['cpu_seconds'] for stage in self.stages),
+            'round_trips': sum(stage['round_trips'] for stage in self.stages),
+            'peak_memory_bytes': max([stage['peak_memory_bytes'] for stage in self.stages] or [0]),
+            'stages': self.stages,
+        }
+
+    def write_report(self, file_name):
+
+        report = json.dumps(self.get_report(), indent=2)
+        write_file_atomically(file_name, [report.encode('utf8')])
+
+    def write_prometheus(self, file_name):
+        """
+        Writes the metrics in the prometheus text format. The file is renamed
+        into place so that the node exporter never reads half of it
+        """
+
+        lines = []
+
+        def add_metric(metric, metric_type, help_text, samples):
+            lines.append('# HELP {0} {1}'.format(metric, help_text))
+            lines.append('# TYPE {0} {1}'.format(metric, metric_type))
+            for (labels, value) in samples:
+                label_text = ','.join('{0}="{1}"'.format(key, value) for (key, value) in labels)
+                lines.append('{0}{{{1}}} {2}'.format(metric, label_text, value))
+
+        add_metric('divining_top_stage_wall_seconds', 'gauge',
+                   'The wall time taken by each stage of the last run',
+                   [([('stage', stage['name'])], stage['wall_seconds']) for stage in self.stages])
+
+        add_metric('divining_top_stage_cpu_seconds', 'gauge',
+                   'The CPU time used by each stage of the last run',
+                   [([('stage', stage['name'])], stage['cpu_seconds']) for stage in self.stages])
+
+        add_metric('divining_top_stage_round_trips', 'gauge',
+                   'The database statements sent by each stage of the last run',
+                   [([('stage', stage['name'])], stage['round_trips']) for stage in self.stages])
+
+        add_metric('divining_top_stage_rows', 'gauge',
+                   'The rows written or skipped by each stage of the last run',
+                   [([('stage', stage['name']), ('operation', counter)], value)
+                    for stage in self.stages
+                    for (counter, value) in stage['rows'].items()])
+
+        add_metric('divining_top_stage_peak_memory_bytes', 'gauge',
+                   'The peak memory of each stage of the last run',
+                   [([('stage', stage['name'])], stage['peak_memory_bytes']) for stage in self.stages])
+
+        lines.append('# HELP divining_top_last_run_timestamp_seconds The time the last run finished')
+        lines.append('# TYPE divining_top_last_run_timestamp_seconds gauge')
+        lines.append('divining_top_last_run_timestamp_seconds {0}'.format(self.finished.timestamp()))
+
+        write_file_atomically(file_name, [('\n'.join(lines) + '\n').encode('utf8')])
+
+
+run_metrics = RunMetrics()
+
+
+def reset_database(connection):
+
+    cursor = connection.cursor()
+
+    cursor.execute("""
+TRUNCATE spellbook_card CASCADE;
+TRUNCATE spellbook_block CASCADE;
+ALTER SEQUENCE spellbook_block_id_seq RESTART;
+ALTER SEQUENCE spellbook_card_id_seq RESTART;
+ALTER SEQUENCE spellbook_cardprinting_id_seq RESTART;
+ALTER SEQUENCE spellbook_cardprintinglanguage_id_seq RESTART;
+ALTER SEQUENCE spellbook_cardruling_id_seq RESTART;
+TRUNCATE spellbook_physicalcard CASCADE;
+ALTER SEQUENCE spellbook_physicalcard_id_seq RESTART;
+TRUNCATE spellbook_rarity CASCADE;
+ALTER SEQUENCE spellbook_rarity_id_seq RESTART;
+TRUNCATE spellbook_set CASCADE;
+ALTER SEQUENCE spellbook_set_id_seq RESTART;
+TRUNCATE spellbook_language CASCADE;
+ALTER SEQUENCE spellbook_language_id_seq RESTART;
+DROP TABLE IF EXISTS divining_top_set_hash;
+DROP TABLE IF EXISTS divining_top_card_hash;
+DROP TABLE IF EXISTS divining_top_set_file_hash;
+""")
+
+    cursor.close()
+
+
+# The tables that have their indexes and foreign keys dropped while a reset
+# database is loaded
+rebuilt_tables = [
+    'spellbook_card',
+    'spellbook_cardprinting',
+    'spellbook_cardprintinglanguage',
+    'spellbook_physicalcardlink',
+]
+
+
+def drop_indexes(connection):
+    """
+    Drops the secondary indexes and foreign keys of the rebuilt tables,
+    recording their definitions in divining_top_dropped_index so that
+    rebuild_indexes can put them back.
+
+    The primary keys and unique constraints are kept, because the load
+    relies on them to find conflicting rows.
+    """
+
+    logger.info("Dropping indexes...")
+
+    cursor = connection.cursor()
+
+    cursor.execute("""
+CREATE TABLE IF NOT EXISTS divining_top_dropped_index (
+    name varchar(200) PRIMARY KEY,
+    table_name varchar(200) NOT NULL,
+    kind varchar(20) NOT NULL,
+    definition text NOT NULL
+)
+""")
+
+    cursor.execute("""
+SELECT
+    index_class.relname,
+    table_class.relname,
+    'index',
+    pg_get_indexdef(index.indexrelid)
+FROM pg_index index
+JOIN pg_class index_class
+  ON index_class.oid = index.indexrelid
+JOIN pg_class table_class
+  ON table_class.oid = index.indrelid
+WHERE table_class.relname = ANY(%(tables)s)
+AND table_class.relnamespace = 'public'::regnamespace
+AND NOT index.indisunique
+AND NOT EXISTS (
+    SELECT 1
+    FROM pg_constraint
+    WHERE pg_constraint.conindid = index.indexrelid
+)
+UNION ALL
+SELECT
+    constraint_.conname,
+    table_class.relname,
+    'foreign_key',
+    pg_get_constraintdef(constraint_.oid)
+FROM pg_constraint constraint_
+JOIN pg_class table_class
+  ON table_class.oid = constraint_.conrelid
+WHERE table_class.relname = ANY(%(tables)s)
+AND table_class.relnamespace = 'public'::regnamespace
+AND constraint_.contype = 'f'
+""", {'tables': rebuilt_tables})
+    dropped = cursor.fetchall()
+
+    # The definitions are committed along with the drops, so a load that
+    # fails before the indexes are rebuilt can still put them back
+    execute_values(cursor, """
+INSERT INTO divining_top_dropped_index (
+    name,
+    table_name,
+    kind,
+    definition
+) VALUES %s
+ON CONFLICT (name) DO NOTHING
+""", dropped)
+
+    for (name, table_name, kind, definition) in dropped:
+        if kind == 'index':
+            cursor.execute(psycopg2.sql.SQL("DROP INDEX {0}").format(
+                psycopg2.sql.Identifier(name)))
+        else:
+            cursor.execute(psycopg2.sql.SQL("ALTER TABLE {0} DROP CONSTRAINT {1}").format(
+                psycopg2.sql.Identifier(table_name), psycopg2.sql.Identifier(name)))
+
+    cursor.close()
+
+    logger.info("Dropped %s indexes and foreign keys", len(dropped))
+
+
+def rebuild_indexes(connection):
+    """
+    Recreates the indexes and foreign keys recorded by drop_indexes, building
+    the indexes and validating the foreign keys over options.workers
+    connections, and then analyzes the rebuilt tables
+    """
+
+    logger.info("Rebuilding indexes...")
+
+    cursor = connection.cursor()
+
+    cursor.execute("""
+SELECT name, table_name, kind, definition
+FROM divining_top_dropped_index
+ORDER BY name
+""")
+    dropped = cursor.fetchall()
+
+    # Adding a foreign key without checking the existing rows is quick, but
+    # locks the referenced table, so they are added one at a time here and
+    # checked in parallel below
+    for (name, table_name, kind, definition) in dropped:
+        if kind != 'foreign_key':
+            continue
+
+        cursor.execute(psycopg2.sql.SQL("""
+ALTER TABLE {0} ADD CONSTRAINT {1} {2} NOT VALID
+""").format(psycopg2.sql.Identifier(table_name),
+            psycopg2.sql.Identifier(name),
+            psycopg2.sql.SQL(definition)))
+
+        cursor.execute("""
+UPDATE divining_top_dropped_index
+SET kind = 'validate'
+WHERE name = %(name)s
+""", {'name': name})
+
+    # The other connections can't see the loaded rows until they are
+    # committed
+    connection.commit()
+
+    # The indexes are all built before any foreign key is validated, as
+    # validating a foreign key locks out index builds on its table
+    index_statements = []
+    validate_statements = []
+
+    for (name, table_name, kind, definition) in dropped:
+        if kind == 'index':
+            # The definition is made idempotent in case an earlier rebuild
+            # was interrupted after building this index
+            index_statements.append((name, psycopg2.sql.SQL(
+                definition.replace(' INDEX ', ' INDEX IF NOT EXISTS ', 1))))
+        else:
+            validate_statements.append((name, psycopg2.sql.SQL(
+                "ALTER TABLE {0} VALIDATE CONSTRAINT {1}").format(
+                    psycopg2.sql.Identifier(table_name), psycopg2.sql.Identifier(name))))
+
+    for statements in (index_statements, validate_statements):
+
+        statement_queue = queue.Queue()
+        for statement in statements:
+            statement_queue.put(statement)
+
+        workers = [IndexBuildThread(statement_queue)
+                   for i in range(max(1, min(options.workers, len(statements))))]
+
+        for worker in workers:
+            worker.start()
+
+        for worker in workers:
+            worker.join()
+
+        for worker in workers:
+            if worker.error is not None:
+                raise worker.error
+
+    # Gives the first queries after the load up to date statistics
+    cursor.execute(psycopg2.sql.SQL("ANALYZE {0}").format(
+        psycopg2.sql.SQL(', ').join(psycopg2.sql.Identifier(table) for table in rebuilt_tables)))
+
+    cursor.close()
+
+    logger.info("Rebuilt %s indexes and foreign keys", len(dropped))
+
+
+def indexes_dropped(connection):
+    """
+    Returns whether there are indexes or foreign keys dropped by
+    drop_indexes that haven't been rebuilt yet
+    """
+
+    cursor = connection.cursor()
+
+    cursor.execute("SELECT to_regclass('divining_top_dropped_index') IS NOT NULL")
+    (dropped,) = cursor.fetchone()
+
+    if dropped:
+        cursor.execute("SELECT EXISTS (SELECT 1 FROM divining_top_dropped_index)")
+        (dropped,) = cursor.fetchone()
+
+    cursor.close()
+
+    return dropped
+
+
+class IndexBuildThread(threading.Thread):
+    """
+    Runs the index and constraint statements taken from the queue on a
+    connection of its own, committing each one as soon as it has finished
+    along with the removal of its divining_top_dropped_index row
+    """
+
+    def __init__(self, statement_queue):
+        threading.Thread.__init__(self)
+        self.statement_queue = statement_queue
+        self.error = None
+
+    def run(self):
+
+        connection = None
+
+        try:
+            connection = connect_to_database()
+            cursor = connection.cursor()
+
+            while True:
+                try:
+                    (name, statement) = self.statement_queue.get_nowait()
+                except queue.Empty:
+                    break
+
+                logger.debug('Rebuilding %s', name)
+
+                cursor.execute(statement)
+                cursor.execute("""
+DELETE FROM divining_top_dropped_index
+WHERE name = %(name)s
+""", {'name': name})
+                connection.commit()
+
+            cursor.close()
+
+        except Exception as error:
+            self.error = error
+
+        finally:
+            if connection is not None:
+                connection.close()
+
+
+def update_rarity_table(connection):
+    cursor = connection.cursor()
+
+    cursor.execute("""
+INSERT INTO spellbook_rarity (
+    symbol,
+    name,
+    display_order
+) VALUES (
+    'L',
+    'Basic Land',
+    10
+), (
+    'C',
+    'Common',
+    20
+), (
+    'U',
+    'Uncommon',
+    30
+), (
+    'R',
+    'Rare',
+    40
+), (
+    'M',
+    'Mythic Rare',
+    50
+), (
+    'T',
+    'Timeshifted',
+    60
+), (
+    'S',
+    'Special',
+    70
+)
+ON CONFLICT(symbol) DO NOTHING;
+""")
+
+    cursor.close()
+
+def update_language_information(connection):
+    
+    cursor = connection.cursor()
+
+    cursor.execute("""
+INSERT INTO spellbook_language (
+    name,
+    mci_code
+) VALUES (
+   'English',
+   'en'
+), (
+   'Chinese Simplified',
+   'tw'
+), (
+   'Chinese Traditional',
+   'ch'
+), (
+   'French',
+   'fr'
+), (
+   'German',
+   'de'
+), (
+   'Italian',
+   'it'
+), (
+   'Japanese',
+   'jp'
+), (
+   'Italian',
+   'it'
+), (
+   'Portuguese (Brazil)',
+   'pt'
+), (
+   'Russian',
+   'ru'
+), (
+   'Spanish',
+   'es'
+), (
+   'Korean',
+   NULL
+)
+ON CONFLICT(name) DO NOTHING;
+""")
+
+    cursor.close()
+
+def update_block_information(json_data, connection):
+
+    logger.info("Updating block information...")
+
+    cursor = connection.cursor()
+
+    for set in json_data:
+
+        # Ignore sets that have no block
+        if 'block' not in set[1]:
+            continue
+
+        cursor.execute("""
+INSERT INTO spellbook_block (
+    name,
+    release_date
+) VALUES (
+    %(block_name)s,
+    %(release_date)s
+) ON CONFLICT (name) DO NOTHING
+        """, {
+        'block_name': set[1]['block'],
+        'release_date': set[1]['releaseDate']
+        })
+
+    cursor.close()
+
+    logger.info("Done")
+
+
+def update_set_information(json_data, connection):
+
+    logger.info("Updating set information...")
+    cursor = connection.cursor()
+
+    for set in json_data:
+
+        cursor.execute("""
+INSERT INTO spellbook_set (
+    code,
+    name,
+    release_date,
+    block_id,
+    mci_code
+) VALUES (
+    %(set_code)s,
+    %(set_name)s,
+    %(release_date)s,
+    (SELECT id FROM spellbook_block WHERE name = %(block_name)s),
+    %(mci_code)s
+) ON CONFLICT (code) DO UPDATE SET mci_code = EXCLUDED.mci_code""", {
+            'set_code': set[0],
+            'set_name': set[1]['name'],
+            'release_date': set[1]['releaseDate'],
+            'block_name': set[1].get('block'),
+            'mci_code': set[1].get('magicCardsInfoCode')
+        })
+
+    cursor.close()
+
+    logger.info("Done")
+
+
+# The (table, column, type) of each column that the card search uses
+search_columns = [
+    ('spellbook_card', 'search_name', 'varchar(200)'),
+    ('spellbook_card', 'search_vector', 'tsvector'),
+    ('spellbook_cardprintinglanguage', 'search_name', 'varchar(200)'),
+]
+
+
+def create_search_columns(connection, create_indexes=True):
+    """
+    Adds the columns and indexes that the card search uses to the card and
+    printing language tables, if they aren't there already. The indexes are
+    left out when create_indexes is False.
+
+    The search columns of a row are cleared whenever the loader changes it,
+    and filled in again by update_search_columns.
+    """
+
+    cursor = connection.cursor()
+
+    # ALTER TABLE locks out every read of the table before it checks whether
+    # the column is there, so it's only run for the columns that are missing
+    cursor.execute("""
+SELECT table_name, column_name
+FROM information_schema.columns
+WHERE table_schema = current_schema()
+AND table_name = ANY(%(tables)s)
+""", {'tables': list(set(table for (table, column, column_type) in search_columns))})
+    existing_columns = set(cursor.fetchall())
+
+    for (table, column, column_type) in search_columns:
+        if (table, column) not in existing_columns:
+            cursor.execute(psycopg2.sql.SQL("ALTER TABLE {0} ADD COLUMN {1} {2}").format(
+                psycopg2.sql.Identifier(table), psycopg2.sql.Identifier(column),
+                psycopg2.sql.SQL(column_type)))
+
+    if not create_indexes:
+        cursor.close()
+        return
+
+    cursor.execute("""
+CREATE INDEX IF NOT EXISTS divining_top_card_search_vector
+ON spellbook_card USING GIN (search_vector);
+
+CREATE INDEX IF NOT EXISTS divining_top_card_search_stale
+ON spellbook_card (id) WHERE search_name IS NULL;
+
+CREATE INDEX IF NOT EXISTS divining_top_cardprintinglanguage_search_stale
+ON spellbook_cardprintinglanguage (id) WHERE search_name IS NULL;
+
+SAVEPOINT create_trigram_indexes;
+""")
+
+    # The trigram indexes need an extension that might not be installed,
+    # without which names can only be searched by scanning
+    try:
+        cursor.execute("""
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS divining_top_card_search_name
+ON spellbook_card USING GIN (search_name gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS divining_top_cardprintinglanguage_search_name
+ON spellbook_cardprintinglanguage USING GIN (search_name gin_trgm_ops);
+""")
+    except psycopg2.Error as e:
+        logger.warning('Not creating the trigram search indexes: %s', str(e).strip())
+        cursor.execute("ROLLBACK TO SAVEPOINT create_trigram_indexes")
+
+    cursor.close()
+
+
+def update_search_columns(connection):
+    """
+    Fills in the search columns of the cards and printing languages that
+    were added or changed since they were last filled in
+    """
+
+    logger.info("Updating search columns...")
+
+    cursor = connection.cursor()
+
+    cursor.execute("""
+SELECT id, name, type, subtype, rules_text
+FROM spellbook_card
+WHERE search_name IS NULL
+""")
+    cards = [(card_id, get_search_name(name),
+              get_search_name(' '.join(text for text in (name, card_type, subtype, rules_text) if text)))
+             for (card_id, name, card_type, subtype, rules_text) in cursor.fetchall()]
+
+    execute_values(cursor, """
+UPDATE spellbook_card card SET
+    search_name = search.search_name,
+    search_vector = to_tsvector('simple', search.search_text)
+FROM (VALUES %s) search (id, search_name, search_text)
+WHERE card.id = search.id
+""", cards, page_size=1000)
+
+    cursor.execute("""
+SELECT id, card_name
+FROM spellbook_cardprintinglanguage
+WHERE search_name IS NULL
+""")
+    printing_languages = [(printing_language_id, get_search_name(card_name))
+                          for (printing_language_id, card_name) in cursor.fetchall()]
+
+    execute_values(cursor, """
+UPDATE spellbook_cardprintinglanguage printlang SET
+    search_name = search.search_name
+FROM (VALUES %s) search (id, search_name)
+WHERE printlang.id = search.id
+""", printing_languages, page_size=1000)
+
+    cursor.close()
+
+    logger.info("Updated the search columns of %s cards and %s printing languages",
+                len(cards), len(printing_languages))
+
+
+def get_search_name(text):
+    """
+    Returns the given text in lower case with its accents removed, the form
+    that the search columns hold
+    """
+
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(c for c in decomposed if not unicodedata.combining(c)).casefold()
+
+
+def update_card_information(json_data, connection):
+
+    logger.info("Updating cards...")
+
+    cursor = get_load_cursor(connection)
+
+    progress = ProgressReporter(json_data, 'cards')
+
+    stage_last_card_details(json_data, connection, ['cards'])
+
+    sets_loaded = 0
+
+    for set in json_data:
+
+        progress.start_set(set[0])
+
+        if checkpoints.set_done('cards', set[0]):
+            card_faces.add_set(set)
+            progress.add(len(set[1]['cards']))
+            continue
+
+        if not content_manifest.set_changed(set[0], set[1]):
+            progress.add(len(set[1]['cards']))
+            continue
+
+        update_set_card_records(set, cursor)
+        update_set_printings(set, cursor)
+
+        progress.add(len(set[1]['cards']))
+
+        checkpoints.complete_set(cursor, 'cards', set[0])
+
+        sets_loaded += 1
+        if options.commit_sets and sets_loaded % options.commit_sets == 0:
+            flush_statements(cursor)
+            connection.commit()
+
+    cursor.execute("DROP TABLE divining_top_last_card")
+    cursor.close()
+
+    progress.report()
+
+    logger.info("Done")
+
+
+def parallel_update_card_information(json_data, connection):
+    """
+    Loads the cards in two phases. Every card-level row is upserted on the
+    given connection first, in the same order as a serial load so the last
+    printing of each card still wins. The printings and languages of each set
+    are then spread across options.workers connections of their own, which
+    can't conflict as no two sets share a printing.
+
+    The cards are committed before the other connections can use them, and
+    each worker commits its own sets, so the load is no longer one
+    transaction.
+    """
+
+    logger.info("Updating cards...")
+
+    cursor = get_load_cursor(connection)
+
+    progress = ProgressReporter(json_data, 'cards')
+
+    stage_last_card_details(json_data, connection, ['card_records', 'cards'])
+
+    sets_loaded = 0
+
+    for set in json_data:
+
+        progress.start_set(set[0])
+
+        if checkpoints.set_done('card_records', set[0]) or checkpoints.set_done('cards', set[0]):
+            progress.add(len(set[1]['cards']))
+            continue
+
+        if not content_manifest.set_changed(set[0], set[1]):
+            progress.add(len(set[1]['cards']))
+            continue
+
+        update_set_card_records(set, cursor)
+
+        progress.add(len(set[1]['cards']))
+
+        checkpoints.complete_set(cursor, 'card_records', set[0])
+
+        sets_loaded += 1
+        if options.commit_sets and sets_loaded % options.commit_sets == 0:
+            flush_statements(cursor)
+            connection.commit()
+
+    cursor.execute("DROP TABLE divining_top_last_card")
+    cursor.close()
+
+    connection.commit()
+
+    progress.report()
+
+    logger.info("Updating printings with %s workers...", options.workers)
+
+    progress = ProgressReporter(json_data, 'printings')
+
+    # The queue is bounded so that streamed sets aren't all read into memory
+    # ahead of the workers
+    set_queue = queue.Queue(maxsize=options.workers * 2)
+
+    workers = [SetLoadThread(set_queue, progress) for i in range(options.workers)]
+    for worker in workers:
+        worker.start()
+
+    # The workers are always sent their sentinels, so that an error reading
+    # a set can't leave them waiting on the queue forever
+    try:
+        for set in json_data:
+            if checkpoints.set_done('cards', set[0]):
+                card_faces.add_set(set)
+                progress.add(len(set[1]['cards']))
+            elif content_manifest.set_changed(set[0], set[1]):
+                set_queue.put(set)
+            else:
+                progress.add(len(set[1]['cards']))
+
+    finally:
+        for worker in workers:
+            set_queue.put(None)
+
+        for worker in workers:
+            worker.join()
+
+    for worker in workers:
+        if worker.error is not None:
+            raise worker.error
+
+    progress.report()
+
+    logger.info("Done")
+
+
+class SetLoadThread(threading.Thread):
+    """
+    Loads the printings of each set taken from the queue on a connection of
+    its own, committing them every options.commit_sets sets and once it takes
+    None from the queue
+    """
+
+    def __init__(self, set_queue, progress):
+        threading.Thread.__init__(self)
+        self.set_queue = set_queue
+        self.progress = progress
+        self.error = None
+
+    def run(self):
+
+        connection = None
+        finished = False
+        sets_loaded = 0
+
+        try:
+            connection = connect_to_database()
+            cursor = get_load_cursor(connection)
+
+            while not finished:
+                set = self.set_queue.get()
+
+                if set is None:
+                    finished = True
+                    continue
+
+                self.progress.start_set(set[0])
+
+                update_set_printings(set, cursor)
+
+                self.progress.add(len(set[1]['cards']))
+                checkpoints.complete_set(cursor, 'cards', set[0])
+
+                sets_loaded += 1
+                if options.commit_sets and sets_loaded % options.commit_sets == 0:
+                    flush_statements(cursor)
+                    connection.commit()
+
+            cursor.close()
+            connection.commit()
+
+        except Exception as error:
+            self.error = error
+
+            # Keep emptying the queue so that the loader can't block on a
+            # worker that has died
+            while not finished:
+                finished = self.set_queue.get() is None
+
+        finally:
+            if connection is not None:
+                connection.close()
+
+
+class ProgressReporter:
+    """
+    Logs how far through the sets a load is every options.progress_interval
+    seconds, with the rate, the current set and an estimate of the time left.
+
+    The estimate is by cards when the json has been read into memory, and by
+    sets when it is being streamed, as a streamed load can't count the cards
+    without reading every set.
+    """
+
+    def __init__(self, json_data, unit):
+        self.unit = unit
+        self.total_sets = len(json_data)
+        self.total = sum(len(set[1]['cards']) for set in json_data) if isinstance(json_data, list) else None
+        self.sets_started = 0
+        self.current_set = None
+        self.done = 0
+        self.started = time.monotonic()
+        self.reported = self.started
+        self.lock = threading.Lock()
+
+    def start_set(self, setcode):
+        with self.lock:
+            self.sets_started += 1
+            self.current_set = setcode
+
+    def add(self, count=1):
+
+        with self.lock:
+            self.done += count
+
+            now = time.monotonic()
+            if now - self.reported < options.progress_interval:
+                return
+
+            self.reported = now
+
+        self.report()
+
+    def report(self):
+
+        elapsed = max(time.monotonic() - self.started, 0.001)
+        rate = self.done / elapsed
+
+        if self.total is not None:
+            progress = '{0}/{1} {2}'.format(self.done, self.total, self.unit)
+            remaining = (self.total - self.done) / rate if rate else None
+        else:
+            progress = '{0} {1}, set {2}/{3}'.format(self.done, self.unit, self.sets_started, self.total_sets)
+            remaining = elapsed / self.sets_started * (self.total_sets - self.sets_started) if self.sets_started else None
+
+        logger.info('Loaded %s, %.1f %s/s, in set %s, %s left',
+                    progress, rate, self.unit, self.current_set,
+                    datetime.timedelta(seconds=round(remaining)) if remaining is not None else 'unknown')
+
+
+# The most statements that are queued before they are sent to the server
+pipeline_batch_size = 100
+
+
+class StatementPipeline:
+    """
+    A cursor for the row by row card load that runs its updates as
+    server-side prepared statements, so that they're only parsed and planned
+    once per connection.
+
+    psycopg2 has no pipeline mode, so as the updates' results aren't needed
+    they are queued instead and sent pipeline_batch_size at a time as a
+    single query. Anything else run on the cursor sends the queue first, so
+    the statements still run in order.
+    """
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.connection = cursor.connection
+        self.queued = []
+        # The run_metrics counter of each queued statement
+        self.queued_counters = []
+        # statement name -> (positional sql, parameter names)
+        self.statements = {}
+
+        # Prepared statements belong to the connection, so an earlier cursor
+        # may already have prepared some of them
+        cursor.execute("SELECT name FROM pg_prepared_statements")
+        self.prepared = set(row[0] for row in cursor)
+
+    def execute(self, query, vars=None):
+        self.flush()
+        self.cursor.execute(query, vars)
+
+    def mogrify(self, query, vars=None):
+        return self.cursor.mogrify(query, vars)
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def close(self):
+        self.flush()
+        self.cursor.close()
+
+    def queue_prepared(self, name, query, params):
+
+        self.queued.append(self.get_execute_sql(name, query, params))
+        self.queued_counters.append('queued_{0}s'.format(query.split(None, 1)[0].lower()))
+
+        if len(self.queued) >= pipeline_batch_size:
+            self.flush()
+
+    def flush(self):
+
+        if not self.queued:
+            return
+
+        self.cursor.execute(b';\n'.join(self.queued))
+
+        # Only the last statement's row count comes back, and a queued update
+        # may not have matched any rows, so the statements themselves are
+        # counted instead of the rows they wrote
+        for counter in self.queued_counters:
+            run_metrics.count(counter)
+
+        self.queued = []
+        self.queued_counters = []
+
+    def get_execute_sql(self, name, query, params):
+        """
+        Returns the sql that executes the given query as the prepared
+        statement with the given name, which prepares it first if this
+        connection hasn't already
+        """
+
+        name = 'divining_top_' + name
+
+        if name not in self.statements:
+            param_names = []
+
+            def replace_param(match):
+                if match.group(1) not in param_names:
+                    param_names.append(match.group(1))
+                return '$' + str(param_names.index(match.group(1)) + 1)
+
+            self.statements[name] = (re.sub(r'%\((\w+)\)s', replace_param, query), param_names)
+
+        (statement, param_names) = self.statements[name]
+
+        sql = self.cursor.mogrify('EXECUTE {0} ({1})'.format(name, ', '.join(['%s'] * len(param_names))),
+                                  [params[param_name] for param_name in param_names])
+
+        if name not in self.prepared:
+            sql = 'PREPARE {0} AS {1};\n'.format(name, statement).encode('utf8') + sql
+            self.prepared.add(name)
+
+        return sql
+
+
+def get_load_cursor(connection):
+    """
+    Returns a cursor for the row by row card load, which is a
+    StatementPipeline when --pipeline is on
+    """
+
+    cursor = connection.cursor()
+
+    if options.pipeline:
+        return StatementPipeline(cursor)
+
+    return cursor
+
+
+def queue_statement(cursor, name, query, params):
+    """
+    Executes the given query, whose results aren't needed, as the prepared
+    statement with the given name if the cursor is a StatementPipeline, which
+    might not send it until later
+    """
+
+    if isinstance(cursor, StatementPipeline):
+        cursor.queue_prepared(name, query, params)
+    else:
+        cursor.execute(query, params)
+
+
+def flush_statements(cursor):
+
+    if isinstance(cursor, StatementPipeline):
+        cursor.flush()
+
+
+def get_card_id(cursor, card_name):
+
+    if id_cache.loaded:
+        return id_cache.card_ids.get(card_name)
+
+    # Find whether a card of the given name exists in the database yet
+    cursor.execute("""
+SELECT c.id card_id
+FROM spellbook_card c
+WHERE c.name = %(name)s
+    """, {'name': card_name})
+
+    assert(cursor.rowcount < 2)
+
+    rows = cursor.fetchone()
+    if rows is not None:
+        return rows[0]
+
+    return None
+
+def get_card_printing_id(cursor, card_id, setcode, collector_number, collector_letter):
+
+    if id_cache.loaded:
+        return id_cache.printing_ids.get(
+            (card_id, setcode, int(collector_number), collector_letter))
+
+    cursor.execute("""
+SELECT id
+FROM spellbook_cardprinting
+WHERE card_id = %(card_id)s
+AND set_id = ( SELECT id FROM spellbook_set WHERE code = %(setcode)s )
+AND collector_number = %(collector_number)s
+AND collector_letter IS NOT DISTINCT FROM %(collector_letter)s
+    """,
+    {
+        'card_id': card_id,
+        'setcode': setcode,
+        'collector_number': collector_number,
+        'collector_letter': collector_letter
+    })
+
+    assert(cursor.rowcount < 2)
+
+    rows = cursor.fetchone()
+    if rows is not None:
+        return rows[0]
+   
+    return None
+
+def get_card_printing_language_id(cursor, printing_id, language):
+
+    if id_cache.loaded:
+        return id_cache.printing_language_ids.get(
+            (printing_id, id_cache.language_ids.get(language)))
+
+    cursor.execute("""
+SELECT id
+FROM spellbook_cardprintinglanguage
+WHERE card_printing_id = %(printing_id)s
+AND language_id = ( SELECT id FROM spellbook_language WHERE name = %(language)s )
+""", {
+        'language': language,
+        'printing_id': printing_id
+    })
+    rows = cursor.fetchone()
+
+    if rows is None:
+        return None
+
+    return rows[0]
+
+
+def get_set_id(cursor, setcode):
+
+    if id_cache.loaded:
+        return id_cache.set_ids.get(setcode)
+
+    cursor.execute("""
+SELECT id
+FROM spellbook_set
+WHERE code = %(setcode)s
+""", {'setcode': setcode})
+    rows = cursor.fetchone()
+
+    if rows is None:
+        return None
+
+    return rows[0]
+
+
+def get_rarity_id(cursor, rarity):
+
+    if id_cache.loaded:
+        return id_cache.rarity_ids.get(rarity)
+
+    cursor.execute("""
+SELECT id
+FROM spellbook_rarity
+WHERE name = %(rarity)s
+""", {'rarity': rarity})
+    rows = cursor.fetchone()
+
+    if rows is None:
+        return None
+
+    return rows[0]
+
+
+def get_language_id(cursor, language):
+
+    if id_cache.loaded:
+        return id_cache.language_ids.get(language)
+
+    cursor.execute("""
+SELECT id
+FROM spellbook_language
+WHERE name = %(language)s
+""", {'language': language})
+    rows = cursor.fetchone()
+
+    if rows is None:
+        return None
+
+    return rows[0]
+
+
+class IdCache:
+    """
+    In-memory maps of the ids that the loader resolves over and over again.
+
+    Everything is loaded in one go by load(), after which the get_*_id
+    functions answer from here instead of the database, and the cache is kept
+    up to date as new rows are inserted.
+    """
+
+    def __init__(self):
+        self.loaded = False
+        # name -> id
+        self.card_ids = {}
+        # code -> id
+        self.set_ids = {}
+        # name -> id
+        self.rarity_ids = {}
+        # name -> id
+        self.language_ids = {}
+        # (card id, set code, collector number, collector letter) -> id
+        self.printing_ids = {}
+        # (printing id, language id) -> id
+        self.printing_language_ids = {}
+
+    def load(self, connection):
+
+        logger.info("Loading id cache...")
+
+        cursor = connection.cursor()
+
+        cursor.execute("SELECT name, id FROM spellbook_card")
+        self.card_ids = dict(cursor)
+
+        cursor.execute("SELECT code, id FROM spellbook_set")
+        self.set_ids = dict(cursor)
+
+        cursor.execute("SELECT name, id FROM spellbook_rarity")
+        self.rarity_ids = dict(cursor)
+
+        cursor.execute("SELECT name, id FROM spellbook_language")
+        self.language_ids = dict(cursor)
+
+        cursor.close()
+
+        # The printing tables are large, so they are read through server side
+        # cursors rather than fetched all at once
+        cursor = connection.cursor('id_cache_printings')
+        cursor.itersize = 10000
+        cursor.execute("""
+SELECT
+    printing.card_id,
+    set.code,
+    printing.collector_number,
+    printing.collector_letter,
+    printing.id
+FROM spellbook_cardprinting printing
+JOIN spellbook_set set
+  ON set.id = printing.set_id
+""")
+        self.printing_ids = {}
+        for (card_id, setcode, collector_number, collector_letter, printing_id) in cursor:
+            self.printing_ids[(card_id, setcode, collector_number, collector_letter)] = printing_id
+        cursor.close()
+
+        cursor = connection.cursor('id_cache_printing_languages')
+        cursor.itersize = 10000
+        cursor.execute("""
+SELECT card_printing_id, language_id, id
+FROM spellbook_cardprintinglanguage
+""")
+        self.printing_language_ids = {}
+        for (printing_id, language_id, printing_language_id) in cursor:
+            self.printing_language_ids[(printing_id, language_id)] = printing_language_id
+        cursor.close()
+
+        self.loaded = True
+
+        logger.info("Done")
+
+    def add_printing(self, card_id, setcode, collector_number, collector_letter, printing_id):
+        self.printing_ids[(card_id, setcode, int(collector_number), collector_letter)] = printing_id
+
+    def add_printing_language(self, printing_id, language, printing_language_id):
+        self.printing_language_ids[(printing_id, self.language_ids.get(language))] = printing_language_id
+
+
+id_cache = IdCache()
+
+
+class ContentManifest:
+    """
+    Content hashes of every set and card as of the last incremental load,
+    which are used to skip the sets and cards that haven't changed since.
+
+    Until load() is called every set and card counts as changed.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        # set code -> hash
+        self.set_hashes = {}
+        # set code -> set of card hashes
+        self.card_hashes = {}
+        # set code -> hash of the set's downloaded file
+        self.file_hashes = {}
+        # The hashes of the data being loaded, filled in as they are checked
+        self.new_set_hashes = {}
+        self.new_card_hashes = {}
+        self.new_file_hashes = {}
+
+    def load(self, connection):
+
+        cursor = connection.cursor()
+
+        cursor.execute("""
+CREATE TABLE IF NOT EXISTS divining_top_set_hash (
+    set_code varchar(10) PRIMARY KEY,
+    content_hash char(40) NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS divining_top_card_hash (
+    set_code varchar(10) NOT NULL,
+    content_hash char(40) NOT NULL,
+    PRIMARY KEY (set_code, content_hash)
+);
+
+CREATE TABLE IF NOT EXISTS divining_top_set_file_hash (
+    set_code varchar(10) PRIMARY KEY,
+    file_hash char(40) NOT NULL
+);
+""")
+
+        cursor.execute("SELECT set_code, file_hash FROM divining_top_set_file_hash")
+        self.file_hashes = dict(cursor)
+
+        cursor.execute("SELECT set_code, content_hash FROM divining_top_set_hash")
+        self.set_hashes = dict(cursor)
+
+        self.card_hashes = {}
+        cursor.execute("SELECT set_code, content_hash FROM divining_top_card_hash")
+        for (set_code, content_hash) in cursor:
+            self.card_hashes.setdefault(set_code, set()).add(content_hash)
+
+        cursor.close()
+
+        self.enabled = True
+
+    def set_file_changed(self, setcode, file_hash):
+        """
+        Returns whether the file of the given set has changed since the last
+        incremental load, which lets a set be skipped without reading it
+        """
+
+        if not self.enabled:
+            return True
+
+        self.new_file_hashes[setcode] = file_hash
+
+        return self.file_changed(setcode, file_hash)
+
+    def file_changed(self, setcode, file_hash):
+        """
+        Returns whether the file of the given set has changed since the last
+        incremental load, without recording its new hash
+        """
+
+        return not self.enabled or file_hash != self.file_hashes.get(setcode)
+
+    def set_changed(self, setcode, set_data):
+
+        if not self.enabled:
+            return True
+
+        # A set can be checked more than once in a load, so it's only counted
+        # as skipped the first time
+        if setcode not in self.new_set_hashes:
+            self.new_set_hashes[setcode] = get_content_hash(set_data)
+
+            if self.new_set_hashes[setcode] == self.set_hashes.get(setcode):
+                run_metrics.count('skipped', len(set_data['cards']))
+
+        return self.new_set_hashes[setcode] != self.set_hashes.get(setcode)
+
+    def card_changed(self, setcode, collector_number, card):
+
+        if not self.enabled:
+            return True
+
+        # Cards are hashed along with their position in the set, as a card
+        # without a number takes its collector number from its position
+        key = (setcode, collector_number)
+        if key not in self.new_card_hashes:
+            self.new_card_hashes[key] = get_content_hash([collector_number, card])
+
+            # Only counted the first time, like a skipped set
+            if self.new_card_hashes[key] in self.card_hashes.get(setcode, ()):
+                run_metrics.count('skipped')
+
+        return self.new_card_hashes[key] not in self.card_hashes.get(setcode, ())
+
+    def save(self, connection):
+
+        cursor = connection.cursor()
+
+        # Every card in a changed set has been hashed, so the card hashes of
+        # those sets can be replaced wholesale
+        changed_sets = [setcode for (setcode, content_hash) in self.new_set_hashes.items()
+                        if content_hash != self.set_hashes.get(setcode)]
+
+        cursor.execute("""
+DELETE FROM divining_top_card_hash
+WHERE set_code = ANY(%(set_codes)s)
+""", {'set_codes': changed_sets})
+
+        execute_values(cursor, """
+INSERT INTO divining_top_card_hash (
+    set_code,
+    content_hash
+) VALUES %s
+ON CONFLICT DO NOTHING
+""", [(setcode, content_hash) for ((setcode, collector_number), content_hash)
+      in self.new_card_hashes.items()], page_size=1000)
+
+        execute_values(cursor, """
+INSERT INTO divining_top_set_hash (
+    set_code,
+    content_hash
+) VALUES %s
+ON CONFLICT (set_code) DO UPDATE SET content_hash = EXCLUDED.content_hash
+""", [(setcode, self.new_set_hashes[setcode]) for setcode in changed_sets])
+
+        execute_values(cursor, """
+INSERT INTO divining_top_set_file_hash (
+    set_code,
+    file_hash
+) VALUES %s
+ON CONFLICT (set_code) DO UPDATE SET file_hash = EXCLUDED.file_hash
+""", [(setcode, file_hash) for (setcode, file_hash) in self.new_file_hashes.items()
+      if file_hash != self.file_hashes.get(setcode)])
+
+        cursor.close()
+
+
+def get_content_hash(json_value):
+    return hashlib.sha1(json.dumps(json_value, sort_keys=True).encode('utf8')).hexdigest()
+
+
+content_manifest = ContentManifest()
+
+
+class Checkpoints:
+    """
+    The stages and sets that the current load has committed, so that a load
+    that fails part way through can be resumed with --resume.
+
+    The checkpoints are tied to the json data file they were made with, and
+    are cleared when a load finishes or starts over. Until load() is called
+    nothing counts as done and nothing is recorded.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.data_version = None
+        # stage -> set of set codes, with '' for the stage itself
+        self.completed = {}
+
+    def load(self, connection):
+
+        cursor = connection.cursor()
+
+        cursor.execute("""
+CREATE TABLE IF NOT EXISTS divining_top_checkpoint (
+    stage varchar(50) NOT NULL,
+    set_code varchar(10) NOT NULL DEFAULT '',
+    data_version char(40) NOT NULL,
+    completed timestamp with time zone NOT NULL DEFAULT NOW(),
+    PRIMARY KEY (stage, set_code)
+);
+""")
+
+        self.data_version = get_data_version()
+
+        if options.resume:
+            cursor.execute("""
+SELECT stage, set_code
+FROM divining_top_checkpoint
+WHERE data_version = %(data_version)s
+""", {'data_version': self.data_version})
+
+            for (stage, set_code) in cursor:
+                self.completed.setdefault(stage, set()).add(set_code)
+
+            if self.completed:
+                logger.info('Resuming the last load, which finished %s sets',
+                            len(self.completed.get('cards', ())))
+            else:
+                logger.info('There is no load of this json data to resume')
+
+        # Checkpoints of any other data can't be resumed any more
+        cursor.execute("""
+DELETE FROM divining_top_checkpoint
+WHERE data_version <> %(data_version)s OR NOT %(resume)s
+""", {'data_version': self.data_version, 'resume': bool(options.resume)})
+
+        cursor.close()
+        connection.commit()
+
+        self.enabled = True
+
+    def stage_done(self, stage):
+        return self.set_done(stage, '')
+
+    def set_done(self, stage, setcode):
+        return setcode in self.completed.get(stage, ())
+
+    def complete_stage(self, connection, stage):
+        """
+        Checkpoints the given stage and commits it along with its work
+        """
+
+        cursor = connection.cursor()
+        self.complete_set(cursor, stage, '')
+        cursor.close()
+
+        connection.commit()
+
+    def complete_set(self, cursor, stage, setcode):
+        """
+        Checkpoints the given set of a stage, which is committed with the
+        set's own work
+        """
+
+        if not self.enabled:
+            return
+
+        cursor.execute("""
+INSERT INTO divining_top_checkpoint (
+    stage,
+    set_code,
+    data_version
+) VALUES (
+    %(stage)s,
+    %(set_code)s,
+    %(data_version)s
+) ON CONFLICT (stage, set_code) DO NOTHING
+""", {'stage': stage, 'set_code': setcode, 'data_version': self.data_version})
+
+    def clear(self, connection):
+
+        if not self.enabled:
+            return
+
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM divining_top_checkpoint")
+        cursor.close()
+
+        self.completed = {}
+
+
+def get_data_version():
+    """
+    Returns a hash that changes whenever the json data file is replaced
+    """
+
+    # The set file manifest has the hash of every set file in it
+    if options.sets_url:
+        with open(set_manifest_file, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    data_file = json_zip_file if path.isfile(json_zip_file) else json_data_file
+    stat = os.stat(data_file)
+
+    return hashlib.sha1('{0}:{1}:{2}'.format(
+        path.abspath(data_file), stat.st_size, stat.st_mtime_ns).encode('utf8')).hexdigest()
+
+
+checkpoints = Checkpoints()
+
+
+def get_card_details(card):
+    
+    card_colour = 0
+    if 'colors' in card:
+        card_colour = get_colour_flags_from_names(card['colors'])
+
+
+    card_details = {
+        'name': card['name'],
+        'cost': card.get('manaCost'),
+        'cmc': card.get('cmc') or 0,
+        'colour': card_colour,
+        'colour_identity':
+            get_colour_flags_from_codes(card['colorIdentity'])
+            if 'colourIdentity' in card
+            else 0,
+        'colour_count': bin(card_colour).count('1'),
+        'type':
+            ' '.join(card['types'])
+            if card.get('types')
+            else None,
+        'subtype':
+            ' '.join(card['subtypes'])
+            if card.get('subtypes')
+            else None,
+        'power': card.get('power'),
+        'num_power':
+            convert_to_number(card['power'])
+            if card.get('power')
+            else 0,
+        'toughness': card.get('toughness'),
+        'num_toughness': convert_to_number(card['toughness'])
+            if card.get('toughness')
+            else 0,
+        'loyalty': card.get('loyalty'),
+        'num_loyalty': convert_to_number(card['loyalty'])
+            if card.get('loyalty')
+            else 0,
+        'rules_text': card.get('text'),
+    }
+
+    return card_details
+
+def get_card_printing_details(card, setcode, collector_number):
+
+    cnum_match = None
+    if 'number' in card:
+        cnum_match = collector_number_pattern.search(card['number'])
+
+    mci_number_match = None
+    if 'mciNumber' in card:
+        mci_number_match = mci_number_pattern.search(card['mciNumber'])
+
+    printing_details = {
+        'rarity':
+            'Timeshifted'
+            if 'timeshifted' in card
+            else card.get('rarity'),
+        'flavour_text': card.get('flavor'),
+        'artist': card['artist'],
+        'collector_number':
+            cnum_match.group('number')
+            if cnum_match
+            else collector_number,
+        'collector_letter':
+            cnum_match.group('special') or cnum_match.group('letter')
+            if cnum_match
+            else None,
+        'original_text': card.get('originalText'),
+        'original_type': card.get('originalType'),
+        'setcode': setcode,
+        'mci_number': mci_number_match.group('number')
+                      if mci_number_match and 'number' not in card
+                      else None
+    }
+
+    return printing_details
+
+
+def transform_card_batch(cards, setcode):
+    """
+    Computes the card and printing details of a whole list of cards at once.
+
+    Returns a dict of columns keyed the same as the details from
+    get_card_details and get_card_printing_details, with one entry per card
+    in order. The derived fields are NumPy arrays.
+    """
+
+    count = len(cards)
+
+    colours = np.zeros((count, len(colour_name_to_flag)), dtype=bool)
+    colour_identities = np.zeros((count, len(colour_code_to_flag)), dtype=bool)
+
+    for (row, card) in enumerate(cards):
+
+        for colour in card.get('colors', ()):
+            colours[row, colour_name_to_index[colour.lower()]] = True
+
+        if 'colourIdentity' in card:
+            for colour in card['colorIdentity']:
+                colour_identities[row, colour_code_to_index[colour.lower()]] = True
+
+    colour_flags = np.array(list(colour_name_to_flag.values()))
+    colour_code_flags = np.array(list(colour_code_to_flag.values()))
+
+    # Collector numbers that are just digits are converted in one go, and the
+    # regex is only needed for the rest
+    has_number = np.array(['number' in card for card in cards], dtype=bool)
+    numbers = np.array([card.get('number') or '' for card in cards], dtype=str)
+    plain_numbers = np.char.isdecimal(numbers)
+
+    collector_numbers = np.arange(1, count + 1)
+    collector_numbers[plain_numbers] = numbers[plain_numbers].astype(int)
+    collector_letters = [None] * count
+
+    for index in np.flatnonzero(has_number & ~plain_numbers):
+        match = collector_number_pattern.search(cards[index]['number'])
+        if match:
+            collector_numbers[index] = int(match.group('number'))
+            collector_letters[index] = match.group('special') or match.group('letter')
+
+    mci_numbers = [None] * count
+
+    for index in np.flatnonzero(~has_number):
+        if 'mciNumber' in cards[index]:
+            match = mci_number_pattern.search(cards[index]['mciNumber'])
+            if match:
+                mci_numbers[index] = match.group('number')
+
+    return {
+        'name': [card['name'] for card in cards],
+        'cost': [card.get('manaCost') for card in cards],
+        'cmc': [card.get('cmc') or 0 for card in cards],
+        'colour': colours @ colour_flags,
+        'colour_identity': colour_identities @ colour_code_flags,
+        'colour_count': colours.sum(axis=1),
+        'type': [' '.join(card['types']) if card.get('types') else None for card in cards],
+        'subtype': [' '.join(card['subtypes']) if card.get('subtypes') else None for card in cards],
+        'power': [card.get('power') for card in cards],
+        'num_power': get_number_column([card.get('power') for card in cards]),
+        'toughness': [card.get('toughness') for card in cards],
+        'num_toughness': get_number_column([card.get('toughness') for card in cards]),
+        'loyalty': [card.get('loyalty') for card in cards],
+        'num_loyalty': get_number_column([card.get('loyalty') for card in cards]),
+        'rules_text': [card.get('text') for card in cards],
+        'rarity': ['Timeshifted' if 'timeshifted' in card else card.get('rarity') for card in cards],
+        'flavour_text': [card.get('flavor') for card in cards],
+        'artist': [card['artist'] for card in cards],
+        'collector_number': collector_numbers,
+        'collector_letter': collector_letters,
+        'original_text': [card.get('originalText') for card in cards],
+        'original_type': [card.get('originalType') for card in cards],
+        'setcode': [setcode] * count,
+        'mci_number': mci_numbers,
+    }
+
+
+def get_number_column(values):
+    """
+    Converts a list of power, toughness or loyalty values to an array of
+    numbers the same way convert_to_number does, only using the regex for
+    the values that aren't plain integers
+    """
+
+    strings = np.array([str(value) if value else '' for value in values], dtype=str)
+    plain = np.char.isdecimal(strings)
+
+    numbers = np.zeros(len(strings))
+    numbers[plain] = strings[plain].astype(float)
+
+    for index in np.flatnonzero(~plain & (strings != '')):
+        numbers[index] = convert_to_number(strings[index])
+
+    return numbers
+
+
+def get_changed_cards(set):
+    """
+    Yields the collector number (by position) and data of each card in the
+    given set that has changed since the last incremental load
+    """
+
+    collector_number = 0
+    for card in set[1]['cards']:
+        collector_number += 1
+
+        if content_manifest.card_changed(set[0], collector_number, card):
+            yield (collector_number, card)
+
+
+def stage_last_card_details(json_data, connection, checkpoint_stages):
+    """
+    Fills divining_top_last_card with the card details of the last printing
+    of each card, which is what a card ends up with when every printing is
+    written in turn, along with the first set that will write it (the first
+    set with a changed printing of the card that isn't done in one of the
+    given checkpoint stages), so that each card only needs to be written once.
+
+    The details are kept in the database rather than in memory, so that a
+    streamed load only holds the set being loaded.
+    """
+
+    cursor = connection.cursor()
+
+    cursor.execute("""
+DROP TABLE IF EXISTS divining_top_card_details;
+CREATE UNLOGGED TABLE divining_top_card_details AS
+SELECT
+    0 load_order,
+    set.code setcode,
+    FALSE changed,
+    card.*
+FROM spellbook_card card,
+     spellbook_set set
+WITH NO DATA;
+""")
+
+    def card_rows():
+        load_order = 0
+        for set in json_data:
+
+            changed_numbers = ()
+            if (not any(checkpoints.set_done(stage, set[0]) for stage in checkpoint_stages)
+                    and content_manifest.set_changed(set[0], set[1])):
+                changed_numbers = frozenset(collector_number for (collector_number, card)
+                                            in get_changed_cards(set))
+
+            for (index, card) in enumerate(set[1]['cards']):
+                load_order += 1
+                card_details = get_card_details(card)
+                yield ([load_order, set[0], index + 1 in changed_numbers] +
+                       [card_details[column] for column in staged_card_columns])
+
+    cursor.copy_expert("""
+COPY divining_top_card_details (
+    load_order, setcode, changed, {0}
+) FROM STDIN""".format(', '.join(staged_card_columns)), CopyStream(card_rows()))
+
+    cursor.execute("""
+DROP TABLE IF EXISTS divining_top_last_card;
+CREATE UNLOGGED TABLE divining_top_last_card AS
+SELECT
+    last_details.*,
+    first_change.setcode first_setcode
+FROM (
+    SELECT DISTINCT ON (name) {0}
+    FROM divining_top_card_details
+    ORDER BY name, load_order DESC
+) last_details
+JOIN (
+    SELECT DISTINCT ON (name) name, setcode
+    FROM divining_top_card_details
+    WHERE changed
+    ORDER BY name, load_order
+) first_change
+  ON first_change.name = last_details.name;
+
+CREATE INDEX ON divining_top_last_card (first_setcode);
+
+DROP TABLE divining_top_card_details;
+""".format(', '.join(staged_card_columns)))
+
+    cursor.close()
+
+
+def get_set_card_details(cursor, setcode):
+    """
+    Returns a map of card name to the card details staged by
+    stage_last_card_details of each card that the given set writes
+    """
+
+    cursor.execute("""
+SELECT {0}
+FROM divining_top_last_card
+WHERE first_setcode = %(setcode)s
+""".format(', '.join(staged_card_columns)), {'setcode': setcode})
+
+    return dict((row[0], dict(zip(staged_card_columns, row))) for row in cursor.fetchall())
+
+
+def update_set_card_records(set, cursor):
+    """
+    Inserts or updates the card-level rows of the changed cards in the given
+    set, inserting all of the new cards in one batch.
+
+    Only the cards that this set is the first to write are written, with
+    their details from stage_last_card_details, so that later printings of
+    the card are skipped.
+    """
+
+    card_details = get_set_card_details(cursor, set[0])
+
+    # name -> card details of the cards that aren't in the database yet
+    new_cards = {}
+
+    for (collector_number, card) in get_changed_cards(set):
+
+        if card['name'] not in card_details:
+            continue
+
+        logger.debug('Updating card %s', card['name'])
+
+        details = card_details.pop(card['name'])
+
+        card_id = get_card_id(cursor, card['name'])
+
+        if card_id is None:
+            new_cards[card['name']] = details
+            continue
+
+        logger.debug('Updating card record %s', card_id)
+
+        queue_statement(cursor, 'update_card', """
+UPDATE spellbook_card SET
+    cost =  %(cost)s,
+    cmc = %(cmc)s,
+    colour = %(colour)s,
+    colour_identity =  %(colour_identity)s,
+    colour_count = %(colour_count)s,
+    type = %(type)s,
+    subtype =  %(subtype)s,
+    power = %(power)s,
+    num_power = %(num_power)s,
+    toughness =  %(toughness)s,
+    num_toughness = %(num_toughness)s,
+    loyalty =  %(loyalty)s,
+    num_loyalty = %(num_loyalty)s,
+    rules_text = %(rules_text)s,
+    search_name = NULL
+WHERE id = %(card_id)s
+AND (
+    cost,
+    cmc,
+    colour,
+    colour_identity,
+    colour_count,
+    type,
+    subtype,
+    power,
+    num_power,
+    toughness,
+    num_toughness,
+    loyalty,
+    num_loyalty,
+    rules_text
+) IS DISTINCT FROM (
+    %(cost)s,
+    %(cmc)s,
+    %(colour)s,
+    %(colour_identity)s,
+    %(colour_count)s,
+    %(type)s,
+    %(subtype)s,
+    %(power)s,
+    %(num_power)s,
+    %(toughness)s,
+    %(num_toughness)s,
+    %(loyalty)s,
+    %(num_loyalty)s,
+    %(rules_text)s
+)
+        """, dict(details, card_id=card_id))
+
+    # Map the ids back on the names rather than on the order of the rows, which
+    # RETURNING doesn't promise to keep
+    card_ids = execute_values(cursor, """
+INSERT INTO spellbook_card (
+    name,
+    cost,
+    cmc,
+    colour,
+    colour_identity,
+    colour_count,
+    type,
+    subtype,
+    power,
+    num_power,
+    toughness,
+    num_toughness,
+    loyalty,
+    num_loyalty,
+    rules_text
+) VALUES %s
+RETURNING id, name
+""", [[card_details[column] for column in staged_card_columns]
+      for card_details in new_cards.values()],
+        page_size=1000, fetch=True)
+
+    for (card_id, card_name) in card_ids:
+        id_cache.card_ids[card_name] = card_id
+        logger.debug('Inserted new card record %s', card_id)
+
+
+def update_set_printings(set, cursor):
+    """
+    Inserts or updates the printings of the changed cards in the given set,
+    and inserts their missing printing languages, inserting the new
+    printings and then the new languages in one batch each
+    """
+
+    set_id = get_set_id(cursor, set[0])
+
+    # (card, printing details) of each changed card
+    printings = []
+
+    # (card id, collector number, collector letter) -> printing details of
+    # the printings that aren't in the database yet
+    new_printings = {}
+
+    for (collector_number, card) in get_changed_cards(set):
+
+        card_id = get_card_id(cursor, card['name'])
+        assert(card_id is not None)
+
+        printing_details = get_card_printing_details(card, set[0], collector_number)
+        printing_details['card_id'] = card_id
+        printing_details['set_id'] = set_id
+        printing_details['rarity_id'] = get_rarity_id(cursor, printing_details['rarity'])
+
+        printings.append((card, printing_details))
+
+        printing_key = (card_id,
+                        int(printing_details['collector_number']),
+                        printing_details['collector_letter'])
+
+        printing_id = None
+        if printing_key not in new_printings:
+            printing_id = get_card_printing_id(cursor, card_id, set[0],
+                                               printing_details['collector_number'],
+                                               printing_details['collector_letter'])
+
+        if printing_id is None:
+            new_printings[printing_key] = printing_details
+            continue
+
+        printing_details['printing_id'] = printing_id
+
+        queue_statement(cursor, 'update_card_printing', """
+UPDATE spellbook_cardprinting SET
+rarity_id = %(rarity_id)s,
+flavour_text = %(flavour_text)s,
+artist = %(artist)s,
+collector_number = %(collector_number)s,
+collector_letter = %(collector_letter)s,
+original_text = %(original_text)s,
+original_type = %(original_type)s,
+card_id = %(card_id)s,
+mci_number = %(mci_number)s
+WHERE id = %(printing_id)s
+AND (
+    rarity_id,
+    flavour_text,
+    artist,
+    collector_number,
+    collector_letter,
+    original_text,
+    original_type,
+    card_id,
+    mci_number
+) IS DISTINCT FROM (
+    %(rarity_id)s,
+    %(flavour_text)s,
+    %(artist)s,
+    %(collector_number)s,
+    %(collector_letter)s,
+    %(original_text)s,
+    %(original_type)s,
+    %(card_id)s,
+    %(mci_number)s
+)
+        """, printing_details)
+
+    printing_ids = execute_values(cursor, """
+INSERT INTO spellbook_cardprinting (
+    rarity_id,
+    flavour_text,
+    artist,
+    collector_number,
+    collector_letter,
+    original_text,
+    original_type,
+    card_id,
+    set_id,
+    mci_number
+) VALUES %s
+RETURNING id, card_id, collector_number, collector_letter
+""", [[printing_details[column] for column in ('rarity_id', 'flavour_text', 'artist',
+                                              'collector_number', 'collector_letter',
+                                              'original_text', 'original_type',
+                                              'card_id', 'set_id', 'mci_number')]
+      for printing_details in new_printings.values()],
+        page_size=1000, fetch=True)
+
+    for (printing_id, card_id, collector_number, collector_letter) in printing_ids:
+        id_cache.add_printing(card_id, set[0], collector_number, collector_letter, printing_id)
+        logger.debug('Inserted new card printing %s', printing_id)
+
+    # (printing id, language) -> row of the printing languages that aren't
+    # in the database yet
+    new_languages = {}
+
+    for (card, printing_details) in printings:
+
+        printing_id = get_card_printing_id(cursor, printing_details['card_id'], set[0],
+                                           printing_details['collector_number'],
+                                           printing_details['collector_letter'])
+
+        languages = [('English', card['name'], card.get('multiverseid'))]
+        for language in card.get('foreignNames', []):
+            languages.append((language['language'], language['name'], language.get('multiverseid')))
+
+        for (language, name, multiverse_id) in languages:
+
+            if (printing_id, language) in new_languages:
+                continue
+
+            if get_card_printing_language_id(cursor, printing_id, language) is not None:
+                continue
+
+            new_languages[(printing_id, language)] = (
+                get_language_id(cursor, language), name, printing_id, multiverse_id)
+
+        card_faces.add(card, set[0],
+                       printing_details['collector_number'],
+                       printing_details['collector_letter'])
+
+    card_faces.end_set(set[0])
+
+    language_ids = execute_values(cursor, """
+INSERT INTO spellbook_cardprintinglanguage (
+    language_id,
+    card_name,
+    card_printing_id,
+    multiverse_id
+) VALUES %s
+RETURNING id, card_printing_id, language_id
+""", list(new_languages.values()), page_size=1000, fetch=True)
+
+    # (printing id, language id) -> language name of the new rows
+    language_names = {(printing_id, language_row[0]): language
+                      for ((printing_id, language), language_row) in new_languages.items()}
+
+    for (language_id, printing_id, row_language_id) in language_ids:
+        language = language_names[(printing_id, row_language_id)]
+        id_cache.add_printing_language(printing_id, language, language_id)
+        logger.debug('Inserted card language for %s %s', language, language_id)
+
+
+def bulk_update_card_information(json_data, connection):
+
+    logger.info("Bulk loading card information...")
+
+    cursor = connection.cursor()
+
+    create_card_staging_tables(cursor)
+
+    # Cards are streamed straight into COPY while the printings and languages
+    # are spooled to disk, so the json only needs to be walked once.
+    #
+    # Every printing's card details are staged, even in the sets and cards
+    # that haven't changed, so that a card takes its details from its last
+    # printing in all of the data (like stage_last_card_details), but only the
+    # cards with a changed printing are merged
+    printing_file = tempfile.TemporaryFile('w+', encoding='utf8')
+    language_file = tempfile.TemporaryFile('w+', encoding='utf8')
+
+    progress = ProgressReporter(json_data, 'cards')
+
+    loaded_sets = []
+
+    def card_rows():
+        nonlocal load_order
+        for set in json_data:
+
+            progress.start_set(set[0])
+
+            if checkpoints.set_done('cards', set[0]):
+                card_faces.add_set(set)
+                progress.add(len(set[1]['cards']))
+                yield from unchanged_card_rows(set)
+                continue
+
+            if not content_manifest.set_changed(set[0], set[1]):
+                progress.add(len(set[1]['cards']))
+                yield from unchanged_card_rows(set)
+                continue
+
+            loaded_sets.append(set[0])
+
+            cards = set[1]['cards']
+
+            columns = transform_card_batch(cards, set[0])
+            columns = dict((key, column.tolist() if isinstance(column, np.ndarray) else column)
+                           for (key, column) in columns.items())
+
+            card_columns = [columns[column] for column in staged_card_columns]
+            printing_columns = [columns[column] for column in staged_printing_columns]
+
+            for (index, card) in enumerate(cards):
+                load_order += 1
+                progress.add()
+
+                if not content_manifest.card_changed(set[0], index + 1, card):
+                    yield [load_order, False] + [column[index] for column in card_columns]
+                    continue
+
+                collector_number = columns['collector_number'][index]
+                collector_letter = columns['collector_letter'][index]
+
+                card_faces.add(card, set[0], collector_number, collector_letter)
+
+                printing_file.write(format_copy_row(
+                    [load_order, card['name']] +
+                    [column[index] for column in printing_columns]))
+
+                languages = [('English', card['name'], card.get('multiverseid'))]
+                for language in card.get('foreignNames', []):
+                    languages.append((language['language'],
+                                      language['name'],
+                                      language.get('multiverseid')))
+
+                for (language, language_card_name, multiverse_id) in languages:
+                    language_file.write(format_copy_row([
+                        load_order,
+                        card['name'],
+                        set[0],
+                        collector_number,
+                        collector_letter,
+                        language,
+                        language_card_name,
+                        multiverse_id
+                    ]))
+
+                yield [load_order, True] + [column[index] for column in card_columns]
+
+            card_faces.end_set(set[0])
+
+    def unchanged_card_rows(set):
+        nonlocal load_order
+        for card in set[1]['cards']:
+            load_order += 1
+            card_details = get_card_details(card)
+            yield [load_order, False] + [card_details[column] for column in staged_card_columns]
+
+    load_order = 0
+
+    cursor.copy_expert("""
+COPY divining_top_staging_card (
+    load_order, changed, {0}
+) FROM STDIN""".format(', '.join(staged_card_columns)), CopyStream(card_rows()))
+
+    printing_file.seek(0)
+    cursor.copy_expert("""
+COPY divining_top_staging_cardprinting (
+    load_order, card_name, {0}
+) FROM STDIN""".format(', '.join(staged_printing_columns)), printing_file)
+    printing_file.close()
+
+    language_file.seek(0)
+    cursor.copy_expert("""
+COPY divining_top_staging_cardprintinglanguage FROM STDIN""", language_file)
+    language_file.close()
+
+    progress.report()
+
+    merge_staged_cards(cursor)
+
+    # The bulk load is one transaction, so its sets are all checkpointed at
+    # once
+    for setcode in loaded_sets:
+        checkpoints.complete_set(cursor, 'cards', setcode)
+
+    # The merge bypasses the cache, so it has to be reloaded to pick up the
+    # new rows
+    id_cache.load(connection)
+
+    cursor.execute("""
+DROP TABLE divining_top_staging_card;
+DROP TABLE divining_top_staging_cardprinting;
+DROP TABLE divining_top_staging_cardprintinglanguage;
+""")
+
+    cursor.close()
+
+    logger.info("Done")
+
+
+# The card_details and printing_details keys that are copied into staging
+staged_card_columns = (
+    'name',
+    'cost',
+    'cmc',
+    'colour',
+    'colour_identity',
+    'colour_count',
+    'type',
+    'subtype',
+    'power',
+    'num_power',
+    'toughness',
+    'num_toughness',
+    'loyalty',
+    'num_loyalty',
+    'rules_text'
+)
+
+staged_printing_columns = (
+    'setcode',
+    'rarity',
+    'flavour_text',
+    'artist',
+    'collector_number',
+    'collector_letter',
+    'original_text',
+    'original_type',
+    'mci_number'
+)
+
+
+def create_card_staging_tables(cursor):
+
+    # The staging tables are built from the real tables so that the column
+    # types always match the ones they are merged into
+    cursor.execute("""
+DROP TABLE IF EXISTS divining_top_staging_card;
+CREATE UNLOGGED TABLE divining_top_staging_card AS
+SELECT
+    0 load_order,
+    FALSE changed,
+    card.*
+FROM spellbook_card card
+WITH NO DATA;
+
+DROP TABLE IF EXISTS divining_top_staging_cardprinting;
+CREATE UNLOGGED TABLE divining_top_staging_cardprinting AS
+SELECT
+    0 load_order,
+    card.name card_name,
+    set.code setcode,
+    rarity.name rarity,
+    printing.flavour_text,
+    printing.artist,
+    printing.collector_number,
+    printing.collector_letter,
+    printing.original_text,
+    printing.original_type,
+    printing.mci_number
+FROM spellbook_cardprinting printing,
+     spellbook_card card,
+     spellbook_set set,
+     spellbook_rarity rarity
+WITH NO DATA;
+
+DROP TABLE IF EXISTS divining_top_staging_cardprintinglanguage;
+CREATE UNLOGGED TABLE divining_top_staging_cardprintinglanguage AS
+SELECT
+    0 load_order,
+    card.name card_name,
+    set.code setcode,
+    printing.collector_number,
+    printing.collector_letter,
+    language.name language,
+    printlang.card_name language_card_name,
+    printlang.multiverse_id
+FROM spellbook_cardprintinglanguage printlang,
+     spellbook_cardprinting printing,
+     spellbook_card card,
+     spellbook_set set,
+     spellbook_language language
+WITH NO DATA;
+""")
+
+
+def merge_staged_cards(cursor):
+
+    # When a card is staged more than once, the last printing loaded wins
+    # (the same as updating it row by row), but only the cards with a changed
+    # printing are written
+    cursor.execute("""
+INSERT INTO spellbook_card (
+    name,
+    cost,
+    cmc,
+    colour,
+    colour_identity,
+    colour_count,
+    type,
+    subtype,
+    power,
+    num_power,
+    toughness,
+    num_toughness,
+    loyalty,
+    num_loyalty,
+    rules_text
+)
+SELECT DISTINCT ON (name)
+    name,
+    cost,
+    cmc,
+    colour,
+    colour_identity,
+    colour_count,
+    type,
+    subtype,
+    power,
+    num_power,
+    toughness,
+    num_toughness,
+    loyalty,
+    num_loyalty,
+    rules_text
+FROM divining_top_staging_card
+WHERE name IN (
+    SELECT name
+    FROM divining_top_staging_card
+    WHERE changed
+)
+ORDER BY name, load_order DESC
+ON CONFLICT (name) DO UPDATE SET
+    cost = EXCLUDED.cost,
+    cmc = EXCLUDED.cmc,
+    colour = EXCLUDED.colour,
+    colour_identity = EXCLUDED.colour_identity,
+    colour_count = EXCLUDED.colour_count,
+    type = EXCLUDED.type,
+    subtype = EXCLUDED.subtype,
+    power = EXCLUDED.power,
+    num_power = EXCLUDED.num_power,
+    toughness = EXCLUDED.toughness,
+    num_toughness = EXCLUDED.num_toughness,
+    loyalty = EXCLUDED.loyalty,
+    num_loyalty = EXCLUDED.num_loyalty,
+    rules_text = EXCLUDED.rules_text,
+    search_name = NULL
+WHERE (
+    spellbook_card.cost,
+    spellbook_card.cmc,
+    spellbook_card.colour,
+    spellbook_card.colour_identity,
+    spellbook_card.colour_count,
+    spellbook_card.type,
+    spellbook_card.subtype,
+    spellbook_card.power,
+    spellbook_card.num_power,
+    spellbook_card.toughness,
+    spellbook_card.num_toughness,
+    spellbook_card.loyalty,
+    spellbook_card.num_loyalty,
+    spellbook_card.rules_text
+) IS DISTINCT FROM (
+    EXCLUDED.cost,
+    EXCLUDED.cmc,
+    EXCLUDED.colour,
+    EXCLUDED.colour_identity,
+    EXCLUDED.colour_count,
+    EXCLUDED.type,
+    EXCLUDED.subtype,
+    EXCLUDED.power,
+    EXCLUDED.num_power,
+    EXCLUDED.toughness,
+    EXCLUDED.num_toughness,
+    EXCLUDED.loyalty,
+    EXCLUDED.num_loyalty,
+    EXCLUDED.rules_text
+)
+""")
+
+    # Printings have no unique constraint to conflict on (collector_letter
+    # is nullable), so existing printings are updated and the remainder are
+    # inserted
+    staged_printings = """
+SELECT DISTINCT ON (card.id, set.id, staged.collector_number, staged.collector_letter)
+    card.id card_id,
+    set.id set_id,
+    rarity.id rarity_id,
+    staged.flavour_text,
+    staged.artist,
+    staged.collector_number,
+    staged.collector_letter,
+    staged.original_text,
+    staged.original_type,
+    staged.mci_number
+FROM divining_top_staging_cardprinting staged
+JOIN spellbook_card card
+  ON card.name = staged.card_name
+JOIN spellbook_set set
+  ON set.code = staged.setcode
+LEFT JOIN spellbook_rarity rarity
+  ON rarity.name = staged.rarity
+ORDER BY card.id, set.id, staged.collector_number, staged.collector_letter, staged.load_order DESC
+"""
+
+    cursor.execute("""
+UPDATE spellbook_cardprinting printing SET
+    rarity_id = staged.rarity_id,
+    flavour_text = staged.flavour_text,
+    artist = staged.artist,
+    original_text = staged.original_text,
+    original_type = staged.original_type,
+    mci_number = staged.mci_number
+FROM ({0}) staged
+WHERE printing.card_id = staged.card_id
+AND printing.set_id = staged.set_id
+AND printing.collector_number = staged.collector_number
+AND COALESCE(printing.collector_letter, '') = COALESCE(staged.collector_letter, '')
+AND (
+    printing.rarity_id,
+    printing.flavour_text,
+    printing.artist,
+    printing.original_text,
+    printing.original_type,
+    printing.mci_number
+) IS DISTINCT FROM (
+    staged.rarity_id,
+    staged.flavour_text,
+    staged.artist,
+    staged.original_text,
+    staged.original_type,
+    staged.mci_number
+)
+""".format(staged_printings))
+
+    cursor.execute("""
+INSERT INTO spellbook_cardprinting (
+    rarity_id,
+    flavour_text,
+    artist,
+    collector_number,
+    collector_letter,
+    original_text,
+    original_type,
+    card_id,
+    set_id,
+    mci_number
+)
+SELECT
+    staged.rarity_id,
+    staged.flavour_text,
+    staged.artist,
+    staged.collector_number,
+    staged.collector_letter,
+    staged.original_text,
+    staged.original_type,
+    staged.card_id,
+    staged.set_id,
+    staged.mci_number
+FROM ({0}) staged
+WHERE NOT EXISTS (
+    SELECT 1
+    FROM spellbook_cardprinting printing
+    WHERE printing.card_id = staged.card_id
+    AND printing.set_id = staged.set_id
+    AND printing.collector_number = staged.collector_number
+    AND COALESCE(printing.collector_letter, '') = COALESCE(staged.collector_letter, '')
+)
+""".format(staged_printings))
+
+    # Existing printing languages are left as they are, and the first
+    # language staged for a printing wins
+    cursor.execute("""
+INSERT INTO spellbook_cardprintinglanguage (
+    language_id,
+    card_name,
+    card_printing_id,
+    multiverse_id
+)
+SELECT DISTINCT ON (printing.id, language.id)
+    language.id,
+    staged.language_card_name,
+    printing.id,
+    staged.multiverse_id
+FROM divining_top_staging_cardprintinglanguage staged
+JOIN spellbook_card card
+  ON card.name = staged.card_name
+JOIN spellbook_set set
+  ON set.code = staged.setcode
+JOIN spellbook_cardprinting printing
+  ON printing.card_id = card.id
+ AND printing.set_id = set.id
+ AND printing.collector_number = staged.collector_number
+ AND COALESCE(printing.collector_letter, '') = COALESCE(staged.collector_letter, '')
+JOIN spellbook_language language
+  ON language.name = staged.language
+WHERE NOT EXISTS (
+    SELECT 1
+    FROM spellbook_cardprintinglanguage printlang
+    WHERE printlang.card_printing_id = printing.id
+    AND printlang.language_id = language.id
+)
+ORDER BY printing.id, language.id, staged.load_order
+ON CONFLICT DO NOTHING
+""")
+
+
+def format_copy_row(values):
+    """
+    Formats a list of values as a line of COPY text format
+    """
+
+    fields = []
+    for value in values:
+        if value is None:
+            fields.append('\\N')
+        elif isinstance(value, float) and value.is_integer():
+            # Whole numbers are written without a decimal point so they can
+            # also be copied into integer columns
+            fields.append(str(int(value)))
+        else:
+            fields.append(str(value)
+                          .replace('\\', '\\\\')
+                          .replace('\t', '\\t')
+                          .replace('\n', '\\n')
+                          .replace('\r', '\\r'))
+
+    return '\t'.join(fields) + '\n'
+
+
+class CopyStream:
+    """
+    A readable file-like object over an iterable of rows, formatting them for
+    COPY FROM STDIN as they are read so they never all have to be in memory
+    """
+
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = ''
+
+    def read(self, size=-1):
+
+        while size < 0 or len(self.buffer) < size:
+            row = next(self.rows, None)
+            if row is None:
+                break
+            self.buffer += format_copy_row(row)
+
+        if size < 0:
+            size = len(self.buffer)
+
+        (data, self.buffer) = (self.buffer[:size], self.buffer[size:])
+        return data
+
+    def readline(self):
+
+        if not self.buffer:
+            row = next(self.rows, None)
+            if row is None:
+                return ''
+            self.buffer = format_copy_row(row)
+
+        (data, self.buffer) = (self.buffer, '')
+        return data
+
+
+def get_colour_flags_from_names(colour_names):
+    flags = 0
+    for colour in colour_names:
+        flags |= colour_name_to_flag[colour.lower()]
+
+    return flags
+
+
+def update_ruling_table(json_data, connection):
+
+    logger.info("Updating rulings...")
+
+    cursor = connection.cursor()
+
+    cursor.execute("""
+DROP TABLE IF EXISTS divining_top_staging_cardruling;
+CREATE UNLOGGED TABLE divining_top_staging_cardruling AS
+SELECT
+    card.name card_name,
+    ruling.date,
+    ruling.text
+FROM spellbook_cardruling ruling,
+     spellbook_card card
+WITH NO DATA;
+
+DROP TABLE IF EXISTS divining_top_staging_rulingcard;
+CREATE UNLOGGED TABLE divining_top_staging_rulingcard AS
+SELECT card.name card_name
+FROM spellbook_card card
+WITH NO DATA;
+""")
+
+    card_names = set()
+
+    def ruling_rows():
+        for set in json_data:
+
+            if not content_manifest.set_changed(set[0], set[1]):
+                continue
+
+            collector_number = 0
+            for card in set[1]['cards']:
+                collector_number += 1
+
+                if not content_manifest.card_changed(set[0], collector_number, card):
+                    continue
+
+                card_names.add(card['name'])
+
+                for ruling in card.get('rulings', []):
+                    yield [card['name'], ruling['date'], ruling['text']]
+
+    cursor.copy_expert("""
+COPY divining_top_staging_cardruling FROM STDIN""", CopyStream(ruling_rows()))
+
+    cursor.copy_expert("""
+COPY divining_top_staging_rulingcard FROM STDIN""", CopyStream([name] for name in card_names))
+
+    # A full load removes every ruling that isn't staged, but an incremental
+    # load only sees the cards that have changed, so it only touches theirs
+    staged_card_filter = ''
+    if content_manifest.enabled:
+        staged_card_filter = """
+AND card.name IN (SELECT card_name FROM divining_top_staging_rulingcard)"""
+
+    cursor.execute("""
+DELETE FROM spellbook_cardruling ruling
+USING spellbook_card card
+WHERE card.id = ruling.card_id{0}
+AND NOT EXISTS (
+    SELECT 1
+    FROM divining_top_staging_cardruling staged
+    WHERE staged.card_name = card.name
+    AND staged.date = ruling.date
+    AND staged.text = ruling.text
+)
+""".format(staged_card_filter))
+
+    cursor.execute("""
+INSERT INTO spellbook_cardruling (
+    date,
+    text,
+    card_id
+)
+SELECT DISTINCT
+    staged.date,
+    staged.text,
+    card.id
+FROM divining_top_staging_cardruling staged
+JOIN spellbook_card card
+  ON card.name = staged.card_name
+WHERE NOT EXISTS (
+    SELECT 1
+    FROM spellbook_cardruling ruling
+    WHERE ruling.card_id = card.id
+    AND ruling.date = staged.date
+    AND ruling.text = staged.text
+)
+ON CONFLICT (date, text, card_id) DO NOTHING
+""")
+
+    cursor.execute("""
+DROP TABLE divining_top_staging_cardruling;
+DROP TABLE divining_top_staging_rulingcard;
+""")
+
+    cursor.close()
+
+    logger.info("Done")
+
+
+def update_physical_cards(connection):
+    """
+    Creates the physical cards for every card face loaded in this run that
+    doesn't have one yet, working out which faces belong together in memory
+    one set at a time (as the faces of a physical card are always printed in
+    the same set)
+    """
+
+    logger.info("Updating physical cards...")
+
+    cursor = connection.cursor()
+
+    physical_card_count = 0
+    link_count = 0
+
+    for (setcode, set_faces) in card_faces.get_sets():
+        (physical_cards, links) = update_set_physical_cards(cursor, setcode, set_faces)
+        physical_card_count += physical_cards
+        link_count += links
+
+    cursor.close()
+
+    logger.info("Created %s physical cards with %s links", physical_card_count, link_count)
+
+
+def update_set_physical_cards(cursor, setcode, set_faces):
+    """
+    Creates the physical cards of the given faces of a set that don't have
+    one yet, returning the number of physical cards and links created
+    """
+
+    faces = []
+
+    # (language, card name) -> printing language id
+    face_ids = {}
+
+    for (card_name, collector_number, collector_letter, language, layout, names) in set_faces:
+
+        card_id = get_card_id(cursor, card_name)
+        printing_id = get_card_printing_id(cursor, card_id, setcode, collector_number, collector_letter)
+        language_id = get_card_printing_language_id(cursor, printing_id, language)
+
+        if language_id is None:
+            continue
+
+        face_ids.setdefault((language, card_name), language_id)
+        faces.append((language_id, language, card_name, layout, names))
+
+    cursor.execute("""
+SELECT DISTINCT printing_language_id
+FROM spellbook_physicalcardlink
+WHERE printing_language_id = ANY(%(language_ids)s)
+""", {'language_ids': list(face_ids.values())})
+    linked_ids = set(row[0] for row in cursor)
+
+    # (layout, printing language ids) for each new physical card
+    physical_cards = []
+
+    for (language_id, language, card_name, layout, names) in faces:
+
+        # Don't do anything for the back half of meld cards (their
+        # children/front cards will set up the physical ID)
+        if layout == 'meld' and len(names) == 3:
+            continue
+
+        if language_id in linked_ids:
+            # Physical card and link already exists, no work to be done
+            continue
+
+        linked_language_ids = []
+
+        for link_name in names:
+
+            if link_name == card_name:
+                continue
+
+            link_language_id = face_ids.get((language, link_name))
+
+            # The other faces of a card changed in an incremental load might
+            # not have been loaded in this run
+            if link_language_id is None:
+                link_language_id = get_linked_card_printing_language_id(
+                    cursor, setcode, language, link_name)
+
+            if link_language_id is None:
+                logger.warning('%s has no physical ID', link_name)
+                continue
+
+            linked_language_ids.append(link_language_id)
+
+        linked_language_ids.append(language_id)
+        linked_ids.update(linked_language_ids)
+
+        physical_cards.append((layout, linked_language_ids))
+
+    if not physical_cards:
+        return (0, 0)
+
+    # A physical card has no natural key to map RETURNING ids back on, so the
+    # ids are taken from the sequence up front and inserted explicitly
+    cursor.execute("""
+SELECT nextval('spellbook_physicalcard_id_seq')
+FROM generate_series(1, %s)
+""", (len(physical_cards),))
+    physical_ids = [physical_id for (physical_id,) in cursor]
+
+    execute_values(cursor, """
+INSERT INTO spellbook_physicalcard (
+    id,
+    layout
+) VALUES %s
+""", [(physical_id, layout)
+      for (physical_id, (layout, linked_language_ids)) in zip(physical_ids, physical_cards)],
+        page_size=1000)
+
+    links = []
+    for (physical_id, (layout, linked_language_ids)) in zip(physical_ids, physical_cards):
+        for language_id in linked_language_ids:
+            links.append((physical_id, language_id))
+
+    execute_values(cursor, """
+INSERT INTO spellbook_physicalcardlink (
+    physical_card_id,
+    printing_language_id
+) VALUES %s
+ON CONFLICT (physical_card_id, printing_language_id) DO NOTHING
+""", links, page_size=1000)
+
+    return (len(physical_cards), len(links))
+
+
+# The tables of the catalog snapshot, with the query that reads each one
+snapshot_tables = [
+    ('rarity', """
+CREATE TABLE rarity (
+    id INTEGER PRIMARY KEY,
+    symbol TEXT NOT NULL,
+    name TEXT NOT NULL,
+    display_order INTEGER NOT NULL
+)""", """
+SELECT id, symbol, name, display_order
+FROM spellbook_rarity
+ORDER BY id
+"""),
+    ('language', """
+CREATE TABLE language (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    mci_code TEXT
+)""", """
+SELECT id, name, mci_code
+FROM spellbook_language
+ORDER BY id
+"""),
+    ('"set"', """
+CREATE TABLE "set" (
+    id INTEGER PRIMARY KEY,
+    code TEXT NOT NULL,
+    name TEXT NOT NULL,
+    release_date TEXT,
+    block_name TEXT,
+    mci_code TEXT
+)""", """
+SELECT
+    set.id,
+    set.code,
+    set.name,
+    set.release_date::text,
+    block.name,
+    set.mci_code
+FROM spellbook_set set
+LEFT JOIN spellbook_block block
+  ON block.id = set.block_id
+ORDER BY set.id
+"""),
+    ('card', """
+CREATE TABLE card (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    cost TEXT,
+    cmc REAL NOT NULL,
+    colour INTEGER NOT NULL,
+    colour_identity INTEGER NOT NULL,
+    colour_count INTEGER NOT NULL,
+    type TEXT,
+    subtype TEXT,
+    power TEXT,
+    num_power REAL NOT NULL,
+    toughness TEXT,
+    num_toughness REAL NOT NULL,
+    loyalty TEXT,
+    num_loyalty REAL NOT NULL,
+    rules_text TEXT
+)""", """
+SELECT
+    id,
+    name,
+    cost,
+    cmc,
+    colour,
+    colour_identity,
+    colour_count,
+    type,
+    subtype,
+    power,
+    num_power,
+    toughness,
+    num_toughness,
+    loyalty,
+    num_loyalty,
+    rules_text
+FROM spellbook_card
+ORDER BY id
+"""),
+    ('card_printing', """
+CREATE TABLE card_printing (
+    id INTEGER PRIMARY KEY,
+    card_id INTEGER NOT NULL REFERENCES card (id),
+    set_id INTEGER NOT NULL REFERENCES "set" (id),
+    rarity_id INTEGER NOT NULL REFERENCES rarity (id),
+    collector_number INTEGER NOT NULL,
+    collector_letter TEXT,
+    mci_number INTEGER,
+    flavour_text TEXT,
+    artist TEXT,
+    original_text TEXT,
+    original_type TEXT
+)""", """
+SELECT
+    id,
+    card_id,
+    set_id,
+    rarity_id,
+    collector_number,
+    collector_letter,
+    mci_number,
+    flavour_text,
+    artist,
+    original_text,
+    original_type
+FROM spellbook_cardprinting
+ORDER BY id
+"""),
+    ('card_printing_language', """
+CREATE TABLE card_printing_language (
+    id INTEGER PRIMARY KEY,
+    card_printing_id INTEGER NOT NULL REFERENCES card_printing (id),
+    language_id INTEGER NOT NULL REFERENCES language (id),
+    card_name TEXT NOT NULL,
+    multiverse_id INTEGER
+)""", """
+SELECT
+    id,
+    card_printing_id,
+    language_id,
+    card_name,
+    multiverse_id
+FROM spellbook_cardprintinglanguage
+ORDER BY id
+"""),
+    ('physical_card', """
+CREATE TABLE physical_card (
+    id INTEGER PRIMARY KEY,
+    layout TEXT NOT NULL
+)""", """
+SELECT id, layout
+FROM spellbook_physicalcard
+ORDER BY id
+"""),
+    ('physical_card_link', """
+CREATE TABLE physical_card_link (
+    physical_card_id INTEGER NOT NULL REFERENCES physical_card (id),
+    printing_language_id INTEGER NOT NULL REFERENCES card_printing_language (id),
+    PRIMARY KEY (physical_card_id, printing_language_id)
+) WITHOUT ROWID""", """
+SELECT physical_card_id, printing_language_id
+FROM spellbook_physicalcardlink
+ORDER BY physical_card_id, printing_language_id
+"""),
+]
+
+# The snapshot's indexes are built after its rows are written. Each one
+# covers the columns of a common lookup, so those are answered from the index
+# without reading the table
+snapshot_indexes = """
+CREATE UNIQUE INDEX card_name ON card (name, id);
+CREATE UNIQUE INDEX set_code ON "set" (code, id);
+CREATE INDEX card_printing_card ON card_printing (card_id, set_id, collector_number, collector_letter, id);
+CREATE INDEX card_printing_set ON card_printing (set_id, collector_number, collector_letter, card_id, id);
+CREATE UNIQUE INDEX card_printing_language_printing ON card_printing_language (card_printing_id, language_id, id, multiverse_id);
+CREATE INDEX card_printing_language_multiverse ON card_printing_language (multiverse_id, id);
+CREATE INDEX card_printing_language_name ON card_printing_language (card_name, id);
+CREATE INDEX physical_card_link_printing_language ON physical_card_link (printing_language_id, physical_card_id);
+"""
+
+
+def export_catalog_snapshot(connection):
+    """
+    Writes the cards, printings, languages and physical cards to a new SQLite
+    file that can be read without a connection to the database, and then
+    renames it over the last snapshot so readers never see a partial one
+    """
+
+    logger.info("Exporting catalog snapshot to %s...", options.snapshot_file)
+
+    snapshot_file = tempfile.NamedTemporaryFile(
+        dir=path.dirname(options.snapshot_file) or '.', suffix='.part', delete=False)
+    snapshot_file.close()
+
+    try:
+        snapshot = sqlite3.connect(snapshot_file.name)
+
+        # Nothing reads the file until it is renamed into place, so there is
+        # no need to journal the writes
+        snapshot.execute("PRAGMA journal_mode = OFF")
+        snapshot.execute("PRAGMA synchronous = OFF")
+        snapshot.execute("PRAGMA page_size = 8192")
+
+        for (table, create_table, query) in snapshot_tables:
+
+            snapshot.execute(create_table)
+
+            # The cursor only reads what it has been asked for from the
+            # server, so the large tables are never held in memory at once
+            cursor = connection.cursor('snapshot_' + table.strip('"'))
+            cursor.itersize = 10000
+            cursor.execute(query)
+
+            while True:
+                rows = cursor.fetchmany(10000)
+                if not rows:
+                    break
+                snapshot.executemany('INSERT INTO {0} VALUES ({1})'.format(
+                    table, ', '.join(['?'] * len(rows[0]))), rows)
+                run_metrics.count('exported', len(rows))
+
+            cursor.close()
+
+        snapshot.executescript(snapshot_indexes)
+
+        snapshot.execute("""
+CREATE TABLE snapshot (
+    data_version TEXT NOT NULL,
+    created_at TEXT NOT NULL
+)""")
+        snapshot.execute("INSERT INTO snapshot VALUES (?, ?)", (
+            get_data_version(),
+            datetime.datetime.now(datetime.timezone.utc).isoformat()
+        ))
+
+        snapshot.commit()
+
+        # Gives the query planner the statistics it needs to pick the
+        # covering indexes, and packs the file as tightly as it will go
+        snapshot.execute("ANALYZE")
+        snapshot.execute("VACUUM")
+        snapshot.close()
+
+        # Temporary files are only readable by their owner, but the snapshot
+        # is for other services to read
+        os.chmod(snapshot_file.name, 0o644)
+        os.replace(snapshot_file.name, options.snapshot_file)
+
+    except BaseException:
+        os.remove(snapshot_file.name)
+        raise
+
+    # The server side cursors leave the connection in a transaction
+    connection.commit()
+
+    logger.info("Done")
+
+
+def create_printing_language_view(connection):
+    """
+    Creates the divining_top_printing_language view if it doesn't exist yet,
+    which has one row for each printing language with everything that's
+    usually joined to it
+    """
+
+    cursor = connection.cursor()
+
+    # A face on more than one physical card (such as the back of a meld card)
+    # is given the first one
+    cursor.execute("""
+CREATE MATERIALIZED VIEW IF NOT EXISTS divining_top_printing_language AS
+SELECT
+    printlang.id printing_language_id,
+    printing.id card_printing_id,
+    card.id card_id,
+    card.name card_name,
+    printlang.card_name printed_name,
+    set.code set_code,
+    language.name language_name,
+    printing.collector_number,
+    printing.collector_letter,
+    printlang.multiverse_id,
+    (
+        SELECT MIN(link.physical_card_id)
+        FROM spellbook_physicalcardlink link
+        WHERE link.printing_language_id = printlang.id
+    ) physical_card_id
+FROM spellbook_cardprintinglanguage printlang
+JOIN spellbook_cardprinting printing
+  ON printing.id = printlang.card_printing_id
+JOIN spellbook_card card
+  ON card.id = printing.card_id
+JOIN spellbook_set set
+  ON set.id = printing.set_id
+JOIN spellbook_language language
+  ON language.id = printlang.language_id;
 
-def get_card_printing_details(card, setcode, collector_number):
+CREATE UNIQUE INDEX IF NOT EXISTS divining_top_printing_language_id
+ON divining_top_printing_language (printing_language_id);
 
-    cnum_match = None
-    if 'number' in card:
-        cnum_match = re.search('^(?P<special>[a-z]+)?(?P<number>[0-9]+)(?P<letter>[a-z]+)?$',
-            card['number'])
+CREATE INDEX IF NOT EXISTS divining_top_printing_language_card
+ON divining_top_printing_language (card_name, set_code, language_name);
 
-    mci_number_match = None
-    if 'mciNumber' in card:
-        mci_number_match = re.search('^(/(?P<setcode>[^/]*)/(?P<language>[^/]*)/)?(?P<number>[0-9]+)(\.html)?$', card['mciNumber'])
+CREATE INDEX IF NOT EXISTS divining_top_printing_language_multiverse_id
+ON divining_top_printing_language (multiverse_id);
 
-    printing_details = {
-        'rarity':
-            'Timeshifted'
-            if 'timeshifted' in card
-            else card.get('rarity'),
-        'flavour_text': card.get('flavor'),
-        'artist': card['artist'],
-        'collector_number':
-            cnum_match.group('number')
-            if cnum_match
-            else collector_number,
-        'collector_letter':
-            cnum_match.group('special') or cnum_match.group('letter')
-            if cnum_match
-            else None,
-        'original_text': card.get('originalText'),
-        'original_type': card.get('originalType'),
-        'setcode': setcode,
-        'mci_number': mci_number_match.group('number')
-                      if mci_number_match and 'number' not in card
-                      else None
-    }
+CREATE INDEX IF NOT EXISTS divining_top_printing_language_physical_card
+ON divining_top_printing_language (physical_card_id);
+""")
 
-    return printing_details
+    cursor.close()
+
+
+def refresh_printing_language_view(connection):
+    """
+    Brings divining_top_printing_language up to date with this run's cards
+    and physical cards. The refresh is concurrent, so the view can still be
+    read while it runs.
+    """
 
+    logger.info("Refreshing printing language view...")
 
-def update_card(card, setcode, cursor, collector_number):
+    cursor = connection.cursor()
+    cursor.execute("REFRESH MATERIALIZED VIEW CONCURRENTLY divining_top_printing_language")
+    cursor.close()
 
-    print('Updating card {0}'.format(card['name']).encode())
+    logger.info("Done")
 
-    card_details = get_card_details(card)
 
-    printing_details = get_card_printing_details(card, setcode, collector_number)
+def get_linked_card_printing_language_id(cursor, setcode, language, card_name):
 
-    language_details = {
-        'language': 'English',
-        'card_name': card['name'],
-    }
+    # This is looked up while the physical cards are being created, before
+    # divining_top_printing_language has been refreshed, so it has to read
+    # the tables
+    cursor.execute("""
+SELECT printlang.id
+FROM spellbook_card card
+JOIN spellbook_cardprinting printing
+  ON printing.card_id = card.id
+ AND printing.set_id = %(set_id)s
+JOIN spellbook_cardprintinglanguage printlang
+  ON printlang.card_printing_id = printing.id
+ AND printlang.language_id = %(language_id)s
+WHERE card.name = %(card_name)s
+""", {
+        'set_id': get_set_id(cursor, setcode),
+        'language_id': get_language_id(cursor, language),
+        'card_name': card_name
+    })
 
-    card_id = get_card_id(cursor, card['name'])
+    rows = cursor.fetchone()
+    if rows is None:
+        return None
 
-    # If the card does not exist in the database, then the
-    if card_id is None:
+    return rows[0]
 
-        cursor.execute("""
-INSERT INTO spellbook_card (
+
+class CardFaces:
+    """
+    Every card face (printing language) loaded in this run, recorded during
+    the card load so that the physical cards can be built without another
+    pass over the json.
+
+    The faces of each set are collected until end_set() is called for it,
+    and are then spooled to a temporary file, so that only the sets being
+    loaded are held in memory.
+    """
+
+    def __init__(self):
+        # set code -> (card name, collector number, collector letter,
+        # language, layout, names) of each face of the sets being loaded
+        self.pending = {}
+        self.file = None
+        self.lock = threading.Lock()
+
+    def add_set(self, set):
+        """
+        Adds every face in the given set, for a set that was loaded before
+        the load was resumed
+        """
+
+        collector_number = 0
+        for card in set[1]['cards']:
+            collector_number += 1
+
+            printing_details = get_card_printing_details(card, set[0], collector_number)
+            self.add(card, set[0],
+                     printing_details['collector_number'],
+                     printing_details['collector_letter'])
+
+        self.end_set(set[0])
+
+    def add(self, card, setcode, collector_number, collector_letter):
+
+        languages = ['English'] + [language['language'] for language in card.get('foreignNames', [])]
+        names = list(card.get('names', ()))
+
+        faces = [(card['name'], collector_number, collector_letter, language, card['layout'], names)
+                 for language in languages]
+
+        with self.lock:
+            self.pending.setdefault(setcode, []).extend(faces)
+
+    def end_set(self, setcode):
+
+        with self.lock:
+            faces = self.pending.pop(setcode, [])
+            if not faces:
+                return
+
+            if self.file is None:
+                self.file = tempfile.TemporaryFile('w+', encoding='utf8')
+
+            self.file.write(json.dumps([setcode, faces]) + '\n')
+
+    def get_sets(self):
+        """
+        Yields the set code and faces of each set in the order they were
+        loaded
+        """
+
+        if self.file is None:
+            return
+
+        self.file.seek(0)
+
+        for line in self.file:
+            (setcode, faces) = json.loads(line)
+            yield (setcode, [(card_name, collector_number, collector_letter, language, layout, tuple(names))
+                             for (card_name, collector_number, collector_letter, language, layout, names)
+                             in faces])
+
+
+card_faces = CardFaces()
+
+
+CatalogCard = collections.namedtuple('CatalogCard', [
+    'id', 'name', 'cost', 'cmc', 'colour', 'colour_identity', 'colour_count',
+    'type', 'subtype', 'power', 'num_power', 'toughness', 'num_toughness',
+    'loyalty', 'num_loyalty', 'rules_text'])
+
+CatalogPrinting = collections.namedtuple('CatalogPrinting', [
+    'id', 'card_name', 'setcode', 'collector_number', 'collector_letter',
+    'rarity', 'flavour_text', 'artist', 'original_text', 'original_type',
+    'mci_number'])
+
+CatalogPrintingLanguage = collections.namedtuple('CatalogPrintingLanguage', [
+    'id', 'card_name', 'setcode', 'collector_number', 'collector_letter',
+    'language', 'name', 'multiverse_id'])
+
+# faces is a tuple of the (set code, language, card name) of each face
+CatalogPhysicalCard = collections.namedtuple('CatalogPhysicalCard', [
+    'id', 'layout', 'faces'])
+
+
+class CardCatalog:
+    """
+    An in-memory index of the card catalog, for the lookups that would
+    otherwise each need a query: cards by name, printings by set code and
+    collector number, printing languages by multiverse id and physical cards
+    by face.
+
+    The catalog is built from the database with from_database() or from the
+    json data with from_json(), in which case there are no ids. The lookups
+    return None for anything that isn't in the catalog.
+    """
+
+    def __init__(self):
+        # name -> CatalogCard
+        self.cards = {}
+        # (set code, collector number, collector letter) -> CatalogPrinting
+        self.printings = {}
+        # multiverse id -> CatalogPrintingLanguage
+        self.printing_languages = {}
+        # (set code, language, card name) -> CatalogPhysicalCard
+        self.physical_cards = {}
+
+    @classmethod
+    def from_database(cls, connection):
+
+        catalog = cls()
+
+        for row in catalog.read_table(connection, """
+SELECT
+    id,
     name,
     cost,
     cmc,
@@ -509,391 +4205,834 @@ INSERT INTO spellbook_card (
     loyalty,
     num_loyalty,
     rules_text
-) VALUES (
-    %(name)s,
-    %(cost)s,
-    %(cmc)s,
-    %(colour)s,
-    %(colour_identity)s,
-    %(colour_count)s,
-    %(type)s,
-    %(subtype)s,
-    %(power)s,
-    %(num_power)s,
-    %(toughness)s,
-    %(num_toughness)s,
-    %(loyalty)s,
-    %(num_loyalty)s,
-    %(rules_text)s
-)
-        """, card_details)
+FROM spellbook_card
+"""):
+            card = CatalogCard(*row)
+            catalog.cards[card.name] = card
+
+        for row in catalog.read_table(connection, """
+SELECT
+    printing.id,
+    card.name,
+    set.code,
+    printing.collector_number,
+    printing.collector_letter,
+    rarity.name,
+    printing.flavour_text,
+    printing.artist,
+    printing.original_text,
+    printing.original_type,
+    printing.mci_number
+FROM spellbook_cardprinting printing
+JOIN spellbook_card card
+  ON card.id = printing.card_id
+JOIN spellbook_set set
+  ON set.id = printing.set_id
+JOIN spellbook_rarity rarity
+  ON rarity.id = printing.rarity_id
+"""):
+            catalog.add_printing(CatalogPrinting(*row))
+
+        for row in catalog.read_table(connection, """
+SELECT
+    printing_language_id,
+    card_name,
+    set_code,
+    collector_number,
+    collector_letter,
+    language_name,
+    printed_name,
+    multiverse_id
+FROM divining_top_printing_language
+WHERE multiverse_id IS NOT NULL
+ORDER BY printing_language_id
+"""):
+            catalog.add_printing_language(CatalogPrintingLanguage(*row))
+
+        physical_cards = collections.OrderedDict()
+
+        for (physical_id, layout, setcode, language, card_name) in catalog.read_table(connection, """
+SELECT
+    physical.id,
+    physical.layout,
+    set.code,
+    language.name,
+    card.name
+FROM spellbook_physicalcard physical
+JOIN spellbook_physicalcardlink link
+  ON link.physical_card_id = physical.id
+JOIN spellbook_cardprintinglanguage printlang
+  ON printlang.id = link.printing_language_id
+JOIN spellbook_cardprinting printing
+  ON printing.id = printlang.card_printing_id
+JOIN spellbook_card card
+  ON card.id = printing.card_id
+JOIN spellbook_set set
+  ON set.id = printing.set_id
+JOIN spellbook_language language
+  ON language.id = printlang.language_id
+ORDER BY physical.id, printlang.id
+"""):
+            physical_cards.setdefault((physical_id, layout), []).append((setcode, language, card_name))
+
+        for ((physical_id, layout), faces) in physical_cards.items():
+            catalog.add_physical_card(CatalogPhysicalCard(physical_id, layout, tuple(faces)))
+
+        # Named cursors can only be declared inside a transaction, which is
+        # ended here rather than left open for the caller
+        connection.commit()
+
+        return catalog
+
+    @staticmethod
+    def read_table(connection, query):
+        """
+        Yields the rows of the given query, read through a server side cursor
+        so that only a batch of them is in memory at once
+        """
+
+        cursor = connection.cursor('card_catalog')
+        cursor.itersize = 10000
+        cursor.execute(query)
+        for row in cursor:
+            yield row
+        cursor.close()
+
+    @classmethod
+    def from_json(cls, json_data):
+
+        catalog = cls()
+
+        for set in json_data:
+
+            setcode = set[0]
+
+            # (language, card name, layout, names) of each face in the set
+            faces = []
+
+            collector_number = 0
+            for card in set[1]['cards']:
+                collector_number += 1
+
+                card_details = get_card_details(card)
+                for column in ('cmc', 'num_power', 'num_toughness', 'num_loyalty'):
+                    card_details[column] = float(card_details[column])
+
+                catalog.cards[card['name']] = CatalogCard(id=None, **card_details)
+
+                printing_details = get_card_printing_details(card, setcode, collector_number)
+                number = int(printing_details['collector_number'])
+                letter = printing_details['collector_letter']
+
+                catalog.add_printing(CatalogPrinting(
+                    None,
+                    card['name'],
+                    setcode,
+                    number,
+                    letter,
+                    printing_details['rarity'],
+                    printing_details['flavour_text'],
+                    printing_details['artist'],
+                    printing_details['original_text'],
+                    printing_details['original_type'],
+                    int(printing_details['mci_number']) if printing_details['mci_number'] else None))
+
+                languages = [('English', card['name'], card.get('multiverseid'))]
+                for language in card.get('foreignNames', []):
+                    languages.append((language['language'], language['name'], language.get('multiverseid')))
+
+                for (language, name, multiverse_id) in languages:
+                    if multiverse_id is not None:
+                        catalog.add_printing_language(CatalogPrintingLanguage(
+                            None, card['name'], setcode, number, letter, language, name, multiverse_id))
+
+                    faces.append((language, card['name'], card['layout'], card.get('names', ())))
+
+            # The faces are put together the same way as update_physical_cards
+            # does, but only within the set
+            face_names = {(language, card_name) for (language, card_name, layout, names) in faces}
+
+            for (language, card_name, layout, names) in faces:
+
+                if layout == 'meld' and len(names) == 3:
+                    continue
+
+                linked_names = [name for name in names
+                                if name != card_name and (language, name) in face_names]
+                linked_names.append(card_name)
+
+                catalog.add_physical_card(CatalogPhysicalCard(
+                    None, layout, tuple((setcode, language, name) for name in linked_names)))
+
+        return catalog
+
+    def add_printing(self, printing):
+        self.printings[(printing.setcode, printing.collector_number, printing.collector_letter)] = printing
+
+    def add_printing_language(self, printing_language):
+        self.printing_languages.setdefault(printing_language.multiverse_id, printing_language)
+
+    def add_physical_card(self, physical_card):
+
+        # A face that is on more than one physical card (such as the back of
+        # a meld card) is found on the first one
+        for face in physical_card.faces:
+            self.physical_cards.setdefault(face, physical_card)
+
+    def get_card(self, card_name):
+        return self.cards.get(card_name)
+
+    def get_printing(self, setcode, collector_number, collector_letter=None):
+        return self.printings.get((setcode, collector_number, collector_letter))
+
+    def get_printing_language(self, multiverse_id):
+        return self.printing_languages.get(multiverse_id)
+
+    def get_physical_card(self, setcode, language, card_name):
+        return self.physical_cards.get((setcode, language, card_name))
+
+    def get_cards(self, card_names):
+        return [self.get_card(card_name) for card_name in card_names]
+
+    def get_printings(self, printing_keys):
+        """
+        Looks up a list of (set code, collector number, collector letter)
+        """
+        return [self.get_printing(*printing_key) for printing_key in printing_keys]
+
+    def get_printing_languages(self, multiverse_ids):
+        return [self.get_printing_language(multiverse_id) for multiverse_id in multiverse_ids]
+
+    def get_physical_cards(self, faces):
+        """
+        Looks up a list of (set code, language, card name)
+        """
+        return [self.get_physical_card(*face) for face in faces]
+
+
+class SnapshotCardCatalog(CardCatalog):
+    """
+    A card catalog that answers each lookup from a snapshot written by
+    export_catalog_snapshot instead of holding the catalog in memory.
+
+    The snapshot is read through memory mapped I/O, so every process that
+    opens the same file shares one copy of it in the page cache.
+    """
+
+    def __init__(self, file_name):
+        super().__init__()
+
+        self.connection = sqlite3.connect('file:{0}?mode=ro'.format(
+            urllib.parse.quote(path.abspath(file_name))), uri=True)
+        self.connection.execute("PRAGMA mmap_size = {0}".format(os.stat(file_name).st_size))
+
+    def get_card(self, card_name):
+
+        row = self.connection.execute("""
+SELECT
+    id,
+    name,
+    cost,
+    cmc,
+    colour,
+    colour_identity,
+    colour_count,
+    type,
+    subtype,
+    power,
+    num_power,
+    toughness,
+    num_toughness,
+    loyalty,
+    num_loyalty,
+    rules_text
+FROM card
+WHERE name = ?
+""", (card_name,)).fetchone()
+
+        return CatalogCard(*row) if row else None
+
+    def get_printing(self, setcode, collector_number, collector_letter=None):
+
+        row = self.connection.execute("""
+SELECT
+    printing.id,
+    card.name,
+    "set".code,
+    printing.collector_number,
+    printing.collector_letter,
+    rarity.name,
+    printing.flavour_text,
+    printing.artist,
+    printing.original_text,
+    printing.original_type,
+    printing.mci_number
+FROM "set"
+JOIN card_printing printing
+  ON printing.set_id = "set".id
+JOIN card
+  ON card.id = printing.card_id
+JOIN rarity
+  ON rarity.id = printing.rarity_id
+WHERE "set".code = ?
+AND printing.collector_number = ?
+AND printing.collector_letter IS ?
+""", (setcode, collector_number, collector_letter)).fetchone()
+
+        return CatalogPrinting(*row) if row else None
+
+    def get_printing_language(self, multiverse_id):
+
+        row = self.connection.execute("""
+SELECT
+    printlang.id,
+    card.name,
+    "set".code,
+    printing.collector_number,
+    printing.collector_letter,
+    language.name,
+    printlang.card_name,
+    printlang.multiverse_id
+FROM card_printing_language printlang
+JOIN card_printing printing
+  ON printing.id = printlang.card_printing_id
+JOIN card
+  ON card.id = printing.card_id
+JOIN "set"
+  ON "set".id = printing.set_id
+JOIN language
+  ON language.id = printlang.language_id
+WHERE printlang.multiverse_id = ?
+ORDER BY printlang.id
+LIMIT 1
+""", (multiverse_id,)).fetchone()
+
+        return CatalogPrintingLanguage(*row) if row else None
+
+    def get_physical_card(self, setcode, language, card_name):
+
+        row = self.connection.execute("""
+SELECT
+    physical.id,
+    physical.layout
+FROM "set"
+JOIN card_printing printing
+  ON printing.set_id = "set".id
+JOIN card
+  ON card.id = printing.card_id
+JOIN card_printing_language printlang
+  ON printlang.card_printing_id = printing.id
+JOIN language
+  ON language.id = printlang.language_id
+JOIN physical_card_link link
+  ON link.printing_language_id = printlang.id
+JOIN physical_card physical
+  ON physical.id = link.physical_card_id
+WHERE "set".code = ?
+AND language.name = ?
+AND card.name = ?
+ORDER BY physical.id
+LIMIT 1
+""", (setcode, language, card_name)).fetchone()
+
+        if row is None:
+            return None
+
+        faces = self.connection.execute("""
+SELECT
+    "set".code,
+    language.name,
+    card.name
+FROM physical_card_link link
+JOIN card_printing_language printlang
+  ON printlang.id = link.printing_language_id
+JOIN card_printing printing
+  ON printing.id = printlang.card_printing_id
+JOIN card
+  ON card.id = printing.card_id
+JOIN "set"
+  ON "set".id = printing.set_id
+JOIN language
+  ON language.id = printlang.language_id
+WHERE link.physical_card_id = ?
+ORDER BY printlang.id
+""", (row[0],)).fetchall()
+
+        return CatalogPhysicalCard(row[0], row[1], tuple(faces))
+
+    def close(self):
+        self.connection.close()
+
+
+def get_image_path(multiverse_id):
+    return path.join(options.image_folder, str(multiverse_id) + '.jpg')
+
+
+def download_card_images(connection):
+
+    cursor = connection.cursor()
+
+    cursor.execute("""
+SELECT DISTINCT cpl.multiverse_id
+FROM spellbook_cardprintinglanguage cpl
+WHERE cpl.multiverse_id IS NOT NULL
+ORDER BY cpl.multiverse_id
+    """)
+
+    multiverse_ids = [row[0] for row in cursor.fetchall()]
+
+    cursor.close()
+
+    manifest = ImageManifest(path.join(options.image_folder, image_manifest_file_name))
+
+    missing_ids = manifest.get_missing_images(multiverse_ids)
+
+    run_metrics.count('skipped', len(multiverse_ids) - len(missing_ids))
+    multiverse_ids = missing_ids
+
+    try:
+        asyncio.run(download_images(multiverse_ids, manifest))
+    finally:
+        manifest.close()
+
+
+class ImageManifest:
+    """
+    A SQLite record of the size, hash, ETag and fetch time of every card image
+    that has been downloaded.
+
+    Images are only recorded once they have been completely written, so an
+    image file without a record (or with a different size to its record) is
+    one that needs to be downloaded again.
+
+    Images are recorded from the threads that save them, so the connection
+    is shared between threads behind a lock.
+    """
+
+    def __init__(self, file_name):
+        self.connection = sqlite3.connect(file_name, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.connection.execute("""
+CREATE TABLE IF NOT EXISTS image (
+    multiverse_id INTEGER PRIMARY KEY,
+    size INTEGER NOT NULL,
+    sha1 TEXT NOT NULL,
+    etag TEXT,
+    fetched_at TEXT NOT NULL
+)""")
+        self.uncommitted = 0
+
+    def get_missing_images(self, multiverse_ids):
+        """
+        Returns the given multiverse ids that don't have a complete image
+        """
+
+        records = {}
+        for (multiverse_id, size, sha1) in self.connection.execute(
+                "SELECT multiverse_id, size, sha1 FROM image"):
+            records[multiverse_id] = (size, sha1)
+
+        # List the folder and the size of each file once rather than checking
+        # for each image
+        file_sizes = {}
+        with os.scandir(options.image_folder) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    file_sizes[entry.name] = entry.stat().st_size
+
+        missing_ids = []
+
+        for multiverse_id in multiverse_ids:
+            file_name = path.basename(get_image_path(multiverse_id))
+
+            if file_name not in file_sizes:
+                missing_ids.append(multiverse_id)
+
+            elif multiverse_id not in records:
+                # Images downloaded before there was a manifest are kept as
+                # long as they are complete
+                if not self.record_existing_image(multiverse_id):
+                    missing_ids.append(multiverse_id)
+
+            elif file_sizes[file_name] != records[multiverse_id][0]:
+                logger.warning('Image %s is not the size it was downloaded at', multiverse_id)
+                missing_ids.append(multiverse_id)
+
+            elif options.verify_images and not self.verify_image(multiverse_id, records[multiverse_id]):
+                logger.warning('Image %s is corrupt', multiverse_id)
+                missing_ids.append(multiverse_id)
+
+        self.connection.commit()
+
+        return missing_ids
+
+    def record_existing_image(self, multiverse_id):
+
+        with open(get_image_path(multiverse_id), 'rb') as f:
+            content = f.read()
+
+        if not is_complete_image(content):
+            return False
+
+        self.record(multiverse_id, content, None)
+        return True
+
+    def verify_image(self, multiverse_id, record):
+
+        (size, sha1) = record
 
-        cursor.execute("SELECT lastval()")
-        rows = cursor.fetchone()
-        (card_id) = rows[0]
+        image_path = get_image_path(multiverse_id)
+        if os.stat(image_path).st_size != size:
+            return False
 
-        printing_details['card_id'] = card_id
+        with open(image_path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest() == sha1
 
-        print('Inserted new card record {0}'.format(card_id))
+    def record(self, multiverse_id, content, etag):
 
-    else:  # card_id is not None
+        sha1 = hashlib.sha1(content).hexdigest()
+        fetched_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
 
-        print('Updating card record {0}'.format(card_id))
+        with self.lock:
+            self.connection.execute("""
+INSERT OR REPLACE INTO image (
+    multiverse_id,
+    size,
+    sha1,
+    etag,
+    fetched_at
+) VALUES (?, ?, ?, ?, ?)""", (multiverse_id, len(content), sha1, etag, fetched_at))
 
-        card_details['card_id'] = card_id
-        printing_details['card_id'] = card_id
-        cursor.execute("""
-UPDATE spellbook_card SET
-    cost =  %(cost)s,
-    cmc = %(cmc)s,
-    colour = %(colour)s,
-    colour_identity =  %(colour_identity)s,
-    colour_count = %(colour_count)s,
-    type = %(type)s,
-    subtype =  %(subtype)s,
-    power = %(power)s,
-    num_power = %(num_power)s,
-    toughness =  %(toughness)s,
-    num_toughness = %(num_toughness)s,
-    loyalty =  %(loyalty)s,
-    num_loyalty = %(num_loyalty)s,
-    rules_text = %(rules_text)s
-WHERE id = %(card_id)s
-        """, card_details)
+            # Commit regularly so an interrupted run can resume where it
+            # stopped
+            self.uncommitted += 1
+            if self.uncommitted >= 100:
+                self.connection.commit()
+                self.uncommitted = 0
 
-    printing_id = get_card_printing_id(cursor, card_id, setcode, printing_details['collector_number'], printing_details['collector_letter'])
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
 
-    if printing_id is None:
 
-        cursor.execute("""
-INSERT INTO spellbook_cardprinting (
-    rarity_id,
-    flavour_text,
-    artist,
-    collector_number,
-    collector_letter,
-    original_text,
-    original_type,
-    card_id,
-    set_id,
-    mci_number
-) VALUES (
-    ( SELECT id FROM spellbook_rarity WHERE name = %(rarity)s ),
-    %(flavour_text)s,
-    %(artist)s,
-    %(collector_number)s,
-    %(collector_letter)s,
-    %(original_text)s,
-    %(original_type)s,
-    %(card_id)s,
-    ( SELECT id FROM spellbook_set WHERE code = %(setcode)s ),
-    %(mci_number)s
-)
-        """, printing_details)
+def is_complete_image(content):
+    """
+    Returns whether the given bytes are a whole JPEG or PNG image (rather
+    than a truncated one or an error page)
+    """
 
-        cursor.execute("SELECT lastval()")
-        rows = cursor.fetchone()
-        printing_id = rows[0]
+    if content.startswith(b'\xff\xd8'):
+        # JPEGs end with an end of image marker, sometimes followed by padding
+        return b'\xff\xd9' in content[-32:]
 
-        print('Inserted new card printing {0}'.format(printing_id))
-    else:
-        printing_details['printing_id'] = printing_id
+    if content.startswith(b'\x89PNG\r\n\x1a\n'):
+        return b'IEND' in content[-12:]
 
-        cursor.execute("""
-UPDATE spellbook_cardprinting SET
-rarity_id = (SELECT id FROM spellbook_rarity WHERE name = %(rarity)s ),
-flavour_text = %(flavour_text)s,
-artist = %(artist)s,
-collector_number = %(collector_number)s,
-collector_letter = %(collector_letter)s,
-original_text = %(original_text)s,
-original_type = %(original_type)s,
-card_id = %(card_id)s,
-mci_number = %(mci_number)s
-WHERE id = %(printing_id)s
-        """, printing_details)
+    return False
 
 
-    language_id = get_or_create_card_language(cursor, 'English', card['name'], printing_id, card.get('multiverseid'))
+async def download_images(multiverse_ids, manifest):
 
-    if 'foreignNames' in card:
+    progress = DownloadProgress(len(multiverse_ids))
 
-        for language in card['foreignNames']:
-            language_id = get_or_create_card_language(cursor,
-                                               language['language'],
-                                               language['name'],
-                                               printing_id,
-                                               language.get('multiverseid'))
+    # The connector pools keep-alive connections, and is sized so that every
+    # download in flight can have one
+    connector = aiohttp.TCPConnector(limit=options.image_concurrency)
+    timeout = aiohttp.ClientTimeout(total=60)
 
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
 
-def get_colour_flags_from_names(colour_names):
-    flags = 0
-    for colour in colour_names:
-        flags |= colour_name_to_flag[colour.lower()]
+        # Each worker takes the next id from the shared iterator until there
+        # are none left
+        remaining_ids = iter(multiverse_ids)
+        workers = [asyncio.create_task(image_download_worker(session, remaining_ids, manifest, progress))
+                   for i in range(options.image_concurrency)]
 
-    return flags
+        reporter = asyncio.create_task(progress.report_periodically())
 
+        await asyncio.gather(*workers)
 
-def get_or_create_card_language(cursor, language, name, printing_id, multiverse_id):
-       
-    language_id = get_card_printing_language_id(cursor, printing_id, language)
-    if language_id is not None:
-        return language_id
+        reporter.cancel()
 
-    cursor.execute("""
-INSERT INTO spellbook_cardprintinglanguage (
-    language_id,
-    card_name,
-    card_printing_id,
-    multiverse_id
-) VALUES (
-    ( SELECT id FROM spellbook_language WHERE name = %(language)s ),
-    %(card_name)s,
-    %(card_printing_id)s,
-    %(multiverse_id)s
-)""", {
-        'language': language,
-        'card_name': name,
-        'card_printing_id': printing_id,
-        'multiverse_id': multiverse_id
-    })
+    progress.report()
 
-    cursor.execute("SELECT lastval()")
-    rows = cursor.fetchone()
-    language_id = rows[0]
 
-    print('Inserted card language for {0} {1}'.format(language, language_id))
+async def image_download_worker(session, multiverse_ids, manifest, progress):
 
-    return language_id
+    for multiverse_id in multiverse_ids:
+        try:
+            size = await download_image_for_card(session, multiverse_id, manifest)
+            progress.add_success(size)
+        except Exception as error:
+            logger.warning('Failed to download %s: %s', multiverse_id, error)
+            progress.add_failure()
 
 
-def update_ruling_table(json_data, connection):
+async def download_image_for_card(session, multiverse_id, manifest):
 
-    # The rulings table can be safely truncated and rebuilt because there are
-    # no other tables that reference it
-    cursor = connection.cursor()
+    (content, headers) = await fetch_with_retries(session, image_download_url.format(multiverse_id))
 
-    cursor.execute("""
-TRUNCATE spellbook_cardruling;
-ALTER SEQUENCE spellbook_cardruling_id_seq RESTART;
-""")
+    if not is_complete_image(content):
+        raise ValueError('The response was not a complete image')
 
-    for set in json_data:
+    # Writing the file and recording it in the manifest would otherwise block
+    # every other download while they wait on the disk
+    await asyncio.to_thread(save_image, multiverse_id, content, headers.get('ETag'), manifest)
 
-        for card in set[1]['cards']:
+    return len(content)
 
-            # Skip cards that don't have additional names (links to other
-            # cards)
-            if 'rulings' not in card:
-                continue
 
-            for ruling in card['rulings']:
+def save_image(multiverse_id, content, etag, manifest):
 
-                cursor.execute("""
-INSERT INTO spellbook_cardruling (
-    date,
-    text,
-    card_id
-) VALUES (
-    %(ruling_date)s,
-    %(ruling_text)s,
-    (
-        SELECT id
-        FROM spellbook_card
-        WHERE name = %(card_name)s
-    )
-) ON CONFLICT (date, text, card_id) DO NOTHING
-                """, {
-                    'card_name': card['name'],
-                    'ruling_date': ruling['date'],
-                    'ruling_text': ruling['text']
-                })
+    write_file_atomically(get_image_path(multiverse_id), [content])
 
-    cursor.close()
+    manifest.record(multiverse_id, content, etag)
 
 
-def update_physical_cards(json_data, connection):
+# The response statuses that are worth trying again
+retryable_statuses = {408, 429, 500, 502, 503, 504}
 
-    cursor = connection.cursor()
+# host -> TokenBucket
+rate_limiters = {}
 
-    for set in json_data:
 
-        setcode = set[0]
+async def fetch_with_retries(session, url, headers=None, rate_limited=True):
+    """
+    Returns the body and headers of the given url, retrying connection
+    errors, timeouts and retryable statuses with exponential backoff.
 
-        collector_number = 0
-        for card_data in set[1]['cards']:
-            collector_number += 1
-            
-            card_id = get_card_id(cursor, card_data['name'])
-            assert(card_id is not None)
-            printing_details = get_card_printing_details(card_data, setcode, collector_number)
-            printing_id = get_card_printing_id(cursor, card_id, setcode, printing_details['collector_number'], printing_details['collector_letter'])
-            assert(printing_id is not None)
+    The body is None if the server answers a conditional request with 304
+    Not Modified. Requests are limited to options.image_rate per host unless
+    rate_limited is False.
+    """
 
-            language_id = get_card_printing_language_id(cursor, printing_id, 'English')
-            update_physical_card_info(cursor, card_data, language_id)
+    host = urllib.parse.urlsplit(url).hostname
 
-            if 'foreignNames' in card_data:
-                for card_language in card_data['foreignNames']:
-                    
-                    language_id = get_card_printing_language_id(cursor, printing_id, card_language['language'])
+    if rate_limited and options.image_rate > 0 and host not in rate_limiters:
+        # A bucket needs room for at least one whole token, or a rate below
+        # one a second could never be acquired
+        rate_limiters[host] = TokenBucket(options.image_rate, max(1, options.image_rate))
 
-                    update_physical_card_info(cursor, card_data, language_id)
+    attempt = 0
+    while True:
 
+        if rate_limited and host in rate_limiters:
+            await rate_limiters[host].acquire()
 
+        try:
+            async with session.get(url, headers=headers) as response:
+                if response.status == 304:
+                    return (None, response.headers)
 
+                if response.status not in retryable_statuses:
+                    response.raise_for_status()
+                    return (await response.read(), response.headers)
 
-def update_physical_card_info(cursor, card_data, language_id):
+                error = 'HTTP {0}'.format(response.status)
 
-    # Don't do anything for the back half of meld cards (their children/front
-    # cards will set up the physical ID)
-    if card_data['layout'] == 'meld' and len(card_data['names']) == 3:
-        return
+        except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError) as exception:
+            error = exception
 
-    cursor.execute("""
-SELECT physical_card_id
-FROM spellbook_physicalcardlink
-WHERE printing_language_id = %(language_id)s
-    """, { 'language_id': language_id })
+        if attempt >= options.image_retries:
+            raise aiohttp.ClientError('{0} after {1} attempts: {2}'.format(url, attempt + 1, error))
 
-    row = cursor.fetchone()
-    physical_id = row[0] if row is not None else None
+        # Back off exponentially, with some jitter so that failed requests
+        # don't all retry in step
+        await asyncio.sleep(min(30, 0.5 * 2 ** attempt) * random.uniform(0.5, 1.5))
+        attempt += 1
 
-    if physical_id is not None:
-        print('Physical ID for {0} already exists'.format(card_data['name']))
-        # Physical card and link already exists, no work to be done
-        return
 
-    cursor.execute("""
-SELECT
-  lang.name,
-  printing.set_id,
-  collector_number,
-  collector_letter
-FROM spellbook_cardprintinglanguage printlang
-JOIN spellbook_cardprinting printing
-  ON printing.id = printlang.card_printing_id
-JOIN spellbook_language lang
-  ON lang.id = printlang.language_id
-WHERE printlang.id = %(language_id)s
-    """, { 'language_id': language_id })
-    row = cursor.fetchone()
-    assert(row is not None)
-    (language, set_id, collector_number, collector_letter) = row
+class TokenBucket:
+    """
+    Limits acquire() to rate calls per second on average, allowing bursts of
+    up to capacity calls
+    """
 
-    linked_language_ids = []
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
 
-    if 'names' in card_data:
+    async def acquire(self):
 
-        for link_name in card_data['names']:
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
 
-            if link_name == card_data['name']:
-                continue
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
 
-            cursor.execute("""
-SELECT printlang.id
-FROM spellbook_card card
-JOIN spellbook_cardprinting printing
-  ON printing.card_id = card.id
- AND printing.set_id = %(set_id)s
-JOIN spellbook_cardprintinglanguage printlang
-  ON printlang.card_printing_id = printing.id
-JOIN spellbook_language lang
-  ON lang.id = printlang.language_id
-  AND lang.name = %(language)s
-WHERe card.name = %(linked_name)s
-        """, { 'set_id': set_id, 'language': language, 'linked_name': link_name })
+                await asyncio.sleep((1 - self.tokens) / self.rate)
 
-            row = cursor.fetchone()
-            if row is None:
-                print('{0} has no physical ID'.format(link_name))
-                continue
 
-            assert(cursor.rowcount == 1)
+class DownloadProgress:
 
-            link_language_id = row[0]
+    def __init__(self, total):
+        self.total = total
+        self.succeeded = 0
+        self.failed = 0
+        self.bytes = 0
+        self.started = time.monotonic()
 
-            linked_language_ids.append(link_language_id)
+    def add_success(self, size):
+        self.succeeded += 1
+        self.bytes += size
+        run_metrics.count('downloaded')
 
-    cursor.execute("""
-INSERT INTO spellbook_physicalcard (
-    layout
-) VALUES (
-    %(layout)s
-) RETURNING id
-    """, { 'layout':  'meld-back' if card_data['layout'] == 'meld' and len(card_data['names']) == 3 else card_data['layout']}) 
-    rows = cursor.fetchone()
-    physical_id = rows[0]
+    def add_failure(self):
+        self.failed += 1
+        run_metrics.count('failed')
 
-    linked_language_ids.append(language_id)
+    def report(self):
 
-    for id in linked_language_ids:
-        print('linking to {0}'.format(id))
-        cursor.execute("""
-INSERT INTO spellbook_physicalcardlink (
-    physical_card_id,
-    printing_language_id
-) VALUES (
-    %(physical_id)s,
-    %(language_id)s
-) ON CONFLICT (physical_card_id, printing_language_id) DO NOTHING""",  { 'language_id': id, 'physical_id': physical_id })
-        print('Creating new card link of {0}'.format(id))
+        elapsed = max(time.monotonic() - self.started, 0.001)
+
+        logger.info('Downloaded %s/%s images (%s failed), %.1f images/s, %.1f KB/s',
+                    self.succeeded, self.total, self.failed,
+                    self.succeeded / elapsed, self.bytes / 1024 / elapsed)
 
+    async def report_periodically(self, interval=10):
+        while True:
+            await asyncio.sleep(interval)
+            self.report()
 
-def download_image_for_card(multiverse_id):
 
-    image_path = options.image_folder + str(multiverse_id) + '.jpg'
+# The number of mysql rows read and written to postgres at a time
+migration_batch_size = 1000
 
-    print('Downloading {0}'.format(multiverse_id))
 
-    stream = requests.get(image_download_url.format(multiverse_id))
+def migrate_database(connection):
 
-    with open(image_path, 'wb') as output:
-        output.write(stream.content)
+    logger.info("Migrating user cards...")
 
+    usernames = dict(entry.split('=') for entry in options.mysql_users.split(','))
 
-def download_card_images(connection):
+    postgres_cursor = connection.cursor()
 
-    cursor = connection.cursor()
+    postgres_cursor.execute("""
+SELECT username, id
+FROM auth_user
+WHERE username = ANY(%(usernames)s)
+""", {'usernames': list(usernames.values())})
+    user_ids = dict(postgres_cursor)
+
+    # mysql user id -> auth_user id
+    owner_ids = {}
+    for (mysql_user_id, username) in usernames.items():
+        if username not in user_ids:
+            logger.warning('There is no user named %s to migrate to', username)
+            continue
+        owner_ids[int(mysql_user_id)] = user_ids[username]
 
-    cursor.execute("""
-SELECT DISTINCT cpl.multiverse_id
-FROM spellbook_cardprintinglanguage cpl
-WHERE cpl.multiverse_id IS NOT NULL
-ORDER BY cpl.multiverse_id
+    physical_ids = get_english_physical_card_ids(postgres_cursor)
+
+    postgres_cursor.close()
+
+    connectParams = dict(entry.split('=') for entry in options.mysql_connection_string.split(';'))
+    cnx = mysql.connector.connect(**connectParams)
+    mysql_cursor = cnx.cursor()
+
+    mysql_cursor.execute("""
+SELECT ownerid FROM usercards
+UNION
+SELECT userid FROM usercardchanges
     """)
 
-    data = cursor.fetchall()
+    for (mysql_user_id,) in mysql_cursor.fetchall():
+        if mysql_user_id not in owner_ids:
+            logger.warning('Skipping mysql user %s, who has no username', mysql_user_id)
 
-    for row in data:
-        multiverse_id = row[0]
-        image_path = options.image_folder + str(multiverse_id) + '.jpg'
+    cnx.close()
 
-        # Skip the image if it already exists
-        if path.exists(image_path):
-            continue
+    mysql_user_ids = sorted(owner_ids)
 
-        image_download_queue.put(multiverse_id)
+    postgres_cursor = connection.cursor()
 
-    cursor.close()
+    if options.workers <= 1:
+        truncate_migrated_tables(postgres_cursor)
+        postgres_cursor.close()
+        migrate_users(mysql_user_ids, owner_ids, physical_ids, connection)
+        logger.info("Done")
+        return
 
-    for i in range(1, 8):
-        thread = imageDownloadThread(image_download_queue)
-        thread.setDaemon(True)
-        thread.start()
+    # The workers can't write to tables truncated by this connection until
+    # it commits, and committing the truncate would lose every collection if
+    # a worker failed, so they write to staging tables that are swapped in
+    # at the end
+    postgres_cursor.execute("""
+DROP TABLE IF EXISTS divining_top_staging_userownedcard;
+CREATE UNLOGGED TABLE divining_top_staging_userownedcard (
+    source_id integer NOT NULL,
+    count integer NOT NULL,
+    physical_card_id integer NOT NULL,
+    owner_id integer NOT NULL
+);
+
+DROP TABLE IF EXISTS divining_top_staging_usercardchange;
+CREATE UNLOGGED TABLE divining_top_staging_usercardchange (
+    source_id integer NOT NULL,
+    difference integer NOT NULL,
+    physical_card_id integer NOT NULL,
+    owner_id integer NOT NULL,
+    date timestamp with time zone NOT NULL
+);
+""")
+    connection.commit()
 
-    image_download_queue.join()
+    workers = [UserMigrationThread(mysql_user_ids[i::options.workers], owner_ids, physical_ids)
+               for i in range(options.workers)]
 
+    for worker in workers:
+        worker.start()
 
-def migrate_database(connection):
+    for worker in workers:
+        worker.join()
 
-    connectParams = dict(entry.split('=') for entry in options.mysql_connection_string.split(';'))
-    cnx = mysql.connector.connect(**connectParams)
+    for worker in workers:
+        if worker.error is not None:
+            raise worker.error
 
-    mysql_cursor = cnx.cursor()
-    postgres_cursor = connection.cursor()
+    truncate_migrated_tables(postgres_cursor)
 
+    # The rows are inserted in the order of their mysql ids, so they get the
+    # same ids as they would in a migration on one connection
     postgres_cursor.execute("""
+INSERT INTO spellbook_userownedcard (
+    count,
+    physical_card_id,
+    owner_id
+)
+SELECT count, physical_card_id, owner_id
+FROM divining_top_staging_userownedcard
+ORDER BY source_id;
+
+INSERT INTO spellbook_usercardchange (
+    difference,
+    physical_card_id,
+    owner_id,
+    date
+)
+SELECT difference, physical_card_id, owner_id, date
+FROM divining_top_staging_usercardchange
+ORDER BY source_id;
+
+DROP TABLE divining_top_staging_userownedcard;
+DROP TABLE divining_top_staging_usercardchange;
+""")
+
+    postgres_cursor.close()
+
+    logger.info("Done")
+
+
+def truncate_migrated_tables(cursor):
+
+    cursor.execute("""
 TRUNCATE spellbook_userownedcard CASCADE;
 ALTER SEQUENCE spellbook_userownedcard_id_seq RESTART;
 
@@ -901,116 +5040,186 @@ TRUNCATE spellbook_usercardchange CASCADE;
 ALTER SEQUENCE spellbook_usercardchange_id_seq RESTART;
     """)
 
-    query = """
-SELECT c.name, uc.count, uc.setcode
+
+def get_english_physical_card_ids(cursor):
+    """
+    Returns a map of (English card name, set code) to the physical card id
+    of that card
+    """
+
+    cursor.execute("""
+SELECT
+    card_name,
+    set_code,
+    MIN(physical_card_id)
+FROM divining_top_printing_language
+WHERE language_name = 'English'
+AND physical_card_id IS NOT NULL
+GROUP BY card_name, set_code
+    """)
+
+    physical_ids = {}
+    for (card_name, set_code, physical_id) in cursor:
+        physical_ids[(card_name, set_code)] = physical_id
+
+    return physical_ids
+
+
+def migrate_users(mysql_user_ids, owner_ids, physical_ids, connection, staged=False):
+    """
+    Copies the owned cards and card changes of the given mysql users into
+    postgres, streaming them from mysql and writing them in batches.
+
+    If staged is True they are written to the migration staging tables along
+    with their mysql ids, rather than to the real tables.
+    """
+
+    if not mysql_user_ids:
+        return
+
+    connectParams = dict(entry.split('=') for entry in options.mysql_connection_string.split(';'))
+    cnx = mysql.connector.connect(**connectParams)
+
+    # An unbuffered cursor streams the rows rather than fetching them all
+    mysql_cursor = cnx.cursor(buffered=False)
+    postgres_cursor = connection.cursor()
+
+    user_list = ', '.join(['%s'] * len(mysql_user_ids))
+
+    mysql_cursor.execute("""
+SELECT uc.id, uc.ownerid, c.name, uc.count, uc.setcode
 FROM usercards uc
 JOIN cards c
 ON c.id = uc.cardid
-WHERE ownerid = 1
+WHERE uc.ownerid IN ({0})
 ORDER BY uc.id ASC
-    """
+    """.format(user_list), mysql_user_ids)
 
-    mysql_cursor.execute(query)
+    # Only the first row for each physical card a user owns is kept
+    owned_cards = set()
 
-    for (card_name, card_count, set_code) in mysql_cursor:
+    while True:
+        rows = mysql_cursor.fetchmany(migration_batch_size)
+        if not rows:
+            break
 
-        postgres_cursor.execute("""
-SELECT MIN(link.physical_card_id)
-FROM spellbook_physicalcardlink link
-JOIN spellbook_cardprintinglanguage printlang
-  ON printlang.id = link.printing_language_id
-JOIN spellbook_cardprinting print
-  ON print.id = printlang.card_printing_id
-JOIN spellbook_set set
-  ON set.id = print.set_id
-JOIN spellbook_language lang
-  ON lang.id = printlang.language_id
-WHERE lang.name = 'English'
-AND printlang.card_name = %(card_name)s
-AND set.code = %(set_code)s
-        """, {'card_name': card_name, 'set_code': set_code })
-        row = postgres_cursor.fetchone()
-        physical_id = row[0]
-
-        assert(physical_id is not None)
-
-        postgres_cursor.execute("""
-SELECT 1 FROM spellbook_userownedcard
-WHERE owner_id = ( SELECT id FROM auth_user WHERE username = 'Liam' )
-AND physical_card_id = %(physical_id)s
-        """, { 'physical_id': physical_id })
-        row = postgres_cursor.fetchone()
-        if row is not None:
-            continue
+        owned_card_rows = []
+
+        for (source_id, mysql_user_id, card_name, card_count, set_code) in rows:
+
+            physical_id = physical_ids.get((card_name, set_code))
+            assert(physical_id is not None)
+
+            owner_id = owner_ids[mysql_user_id]
+
+            if (owner_id, physical_id) in owned_cards:
+                continue
+
+            owned_cards.add((owner_id, physical_id))
+            owned_card_rows.append((source_id, card_count, physical_id, owner_id))
 
-        postgres_cursor.execute("""
+        if staged:
+            execute_values(postgres_cursor, """
+INSERT INTO divining_top_staging_userownedcard (
+    source_id,
+    count,
+    physical_card_id,
+    owner_id
+) VALUES %s
+""", owned_card_rows, page_size=migration_batch_size)
+        else:
+            execute_values(postgres_cursor, """
 INSERT INTO spellbook_userownedcard (
     count,
     physical_card_id,
     owner_id
-) VALUES (
-    %(card_count)s,
-    %(physical_id)s,
-    ( SELECT id FROM auth_user WHERE username = 'Liam' )
-)
-    """, {
-            'card_count': card_count,
-            'physical_id': physical_id
-        })
+) VALUES %s
+""", [row[1:] for row in owned_card_rows], page_size=migration_batch_size)
 
-    query = """
-SELECT 
-    c.name, 
-    ucc.setcode, 
-    ucc.datemodified, 
-    ucc.difference 
+    mysql_cursor.execute("""
+SELECT
+    ucc.id,
+    ucc.userid,
+    c.name,
+    ucc.setcode,
+    ucc.datemodified,
+    ucc.difference
 FROM usercardchanges ucc
 JOIN cards c
 ON c.id = ucc.cardid
-WHERE userid = 1
+WHERE ucc.userid IN ({0})
 ORDER BY ucc.id ASC
-    """
+    """.format(user_list), mysql_user_ids)
 
-    mysql_cursor.execute(query)
+    while True:
+        rows = mysql_cursor.fetchmany(migration_batch_size)
+        if not rows:
+            break
 
-    for (card_name, set_code, date_modified, card_difference) in mysql_cursor:
+        change_rows = []
 
-        postgres_cursor.execute("""
+        for (source_id, mysql_user_id, card_name, set_code, date_modified, card_difference) in rows:
+
+            physical_id = physical_ids.get((card_name, set_code))
+            assert(physical_id is not None)
+
+            change_rows.append((source_id, card_difference, physical_id,
+                                owner_ids[mysql_user_id], date_modified))
+
+        if staged:
+            execute_values(postgres_cursor, """
+INSERT INTO divining_top_staging_usercardchange (
+    source_id,
+    difference,
+    physical_card_id,
+    owner_id,
+    date
+) VALUES %s
+""", change_rows, page_size=migration_batch_size)
+        else:
+            execute_values(postgres_cursor, """
 INSERT INTO spellbook_usercardchange (
     difference,
     physical_card_id,
     owner_id,
     date
-) VALUES (
-    %(card_difference)s,
-    (
-        SELECT MIN(link.physical_card_id)
-        FROM spellbook_physicalcardlink link
-        JOIN spellbook_cardprintinglanguage printlang
-          ON printlang.id = link.printing_language_id
-        JOIN spellbook_cardprinting print
-          ON print.id = printlang.card_printing_id
-        JOIN spellbook_set set
-          ON set.id = print.set_id
-        JOIN spellbook_language lang
-          ON lang.id = printlang.language_id
-        WHERE lang.name = 'English'
-        AND printlang.card_name = %(card_name)s
-        AND set.code = %(set_code)s
-    ),
-    ( SELECT id FROM auth_user WHERE username = 'Liam' ),
-    %(date_modified)s
-)
-    """, {
-            'card_difference': card_difference,
-            'card_name': card_name,
-            'set_code': set_code,
-            'date_modified': date_modified
-        })
+) VALUES %s
+""", [row[1:] for row in change_rows], page_size=migration_batch_size)
 
     postgres_cursor.close()
     cnx.close()
 
+
+class UserMigrationThread(threading.Thread):
+    """
+    Migrates a batch of users into the migration staging tables on a
+    connection of its own, committing them once they have all been migrated
+    """
+
+    def __init__(self, mysql_user_ids, owner_ids, physical_ids):
+        threading.Thread.__init__(self)
+        self.mysql_user_ids = mysql_user_ids
+        self.owner_ids = owner_ids
+        self.physical_ids = physical_ids
+        self.error = None
+
+    def run(self):
+
+        connection = None
+
+        try:
+            connection = connect_to_database()
+            migrate_users(self.mysql_user_ids, self.owner_ids, self.physical_ids, connection, staged=True)
+            connection.commit()
+
+        except Exception as error:
+            self.error = error
+
+        finally:
+            if connection is not None:
+                connection.close()
+
+
 def get_colour_flags_from_codes(colour_codes):
     flags = 0
     for colour in colour_codes:
@@ -1020,24 +5229,12 @@ def get_colour_flags_from_codes(colour_codes):
 
 
 def convert_to_number(val):
-    match = re.search('([\d.]+)', str(val))
+    match = number_pattern.search(str(val))
     if match:
-        return match.groups(1)
+        return float(match.group(1))
 
     return 0
 
 
-class imageDownloadThread(threading.Thread):
-    def __init__(self, queue):
-        threading.Thread.__init__(self)
-        self.queue = queue
-
-    def run(self):
-        while True:
-            multiverse_id = self.queue.get()
-            download_image_for_card(multiverse_id)
-            self.queue.task_done()
-
-
 if __name__ == "__main__":
     main()
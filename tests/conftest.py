@@ -0,0 +1,70 @@
+import http.server
+import threading
+import sys
+from os import path
+
+import pytest
+
+# The loader and the benchmark are scripts rather than a package, so they're
+# imported from their folder
+sys.path.insert(0, path.join(path.dirname(path.dirname(path.abspath(__file__))), 'divining_top'))
+
+
+class ScriptedRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Answers each request for a path with the next of the responses scripted
+    for it on the server, repeating the last one once they run out, and
+    records the headers of every request. A response is a (status, headers,
+    body) tuple, or a function of the request headers that returns one
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+
+        self.server.requests.append((self.path, dict(self.headers)))
+
+        responses = self.server.responses.get(self.path)
+        if not responses:
+            response = (404, {}, b'')
+        elif len(responses) > 1:
+            response = responses.pop(0)
+        else:
+            response = responses[0]
+
+        if callable(response):
+            response = response(self.headers)
+
+        (status, headers, body) = response
+
+        self.send_response(status)
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def scripted_server():
+    """
+    A local http server whose responses are scripted per path in its
+    responses
+    """
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ScriptedRequestHandler)
+    server.daemon_threads = True
+    server.responses = {}
+    server.requests = []
+    server.url = 'http://127.0.0.1:{0}'.format(server.server_address[1])
+
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    yield server
+
+    server.shutdown()
+    server.server_close()
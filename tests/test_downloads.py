@@ -0,0 +1,139 @@
+import asyncio
+import hashlib
+import json
+from os import path
+
+import pytest
+
+for module in ['aiohttp', 'mysql.connector', 'numpy', 'psycopg2', 'requests']:
+    pytest.importorskip(module)
+
+import divining_top  # noqa: E402
+import benchmark  # noqa: E402
+
+
+@pytest.fixture
+def metrics(monkeypatch):
+    metrics = divining_top.RunMetrics()
+    monkeypatch.setattr(divining_top, 'run_metrics', metrics)
+    return metrics
+
+
+def test_json_zip_is_only_downloaded_again_when_its_etag_changes(monkeypatch, tmp_path, scripted_server):
+
+    monkeypatch.setattr(divining_top, 'json_download_url', scripted_server.url + '/AllSets-x.json.zip')
+    monkeypatch.setattr(divining_top, 'json_zip_file', str(tmp_path / 'AllSets-x.json.zip'))
+    monkeypatch.setattr(divining_top, 'json_zip_headers_file', str(tmp_path / 'AllSets-x.json.zip.headers'))
+
+    etag = ['"v1"']
+    content = [b'first zip']
+
+    def respond(request_headers):
+        if request_headers.get('If-None-Match') == etag[0]:
+            return (304, {'ETag': etag[0]}, b'')
+        return (200, {'ETag': etag[0]}, content[0])
+
+    scripted_server.responses['/AllSets-x.json.zip'] = [respond]
+
+    assert divining_top.download_json_data()
+    assert not divining_top.download_json_data()
+
+    etag[0] = '"v2"'
+    content[0] = b'second zip'
+
+    assert divining_top.download_json_data()
+
+    with open(divining_top.json_zip_file, 'rb') as f:
+        assert f.read() == b'second zip'
+
+    with open(divining_top.json_zip_headers_file, 'r', encoding='utf8') as f:
+        assert json.load(f)['etag'] == '"v2"'
+
+    sent_etags = [headers.get('If-None-Match') for (request_path, headers) in scripted_server.requests]
+    assert sent_etags == [None, '"v1"', '"v1"']
+
+
+def test_images_are_retried_and_error_pages_are_rejected(monkeypatch, tmp_path, scripted_server, metrics):
+
+    monkeypatch.setattr(divining_top.options, 'image_folder', str(tmp_path))
+    monkeypatch.setattr(divining_top.options, 'image_rate', 0)
+    monkeypatch.setattr(divining_top.options, 'image_retries', 2)
+    monkeypatch.setattr(divining_top.options, 'image_concurrency', 2)
+    monkeypatch.setattr(divining_top, 'image_download_url', scripted_server.url + '/image/{0}')
+
+    image = benchmark.synthetic_image
+
+    scripted_server.responses['/image/1'] = [(503, {}, b''), (200, {'ETag': '"i1"'}, image)]
+    scripted_server.responses['/image/2'] = [(200, {'Content-Type': 'text/html'}, b'<html>Error</html>')]
+    scripted_server.responses['/image/3'] = [(500, {}, b'')]
+
+    manifest = divining_top.ImageManifest(str(tmp_path / divining_top.image_manifest_file_name))
+
+    try:
+        with metrics.stage('images') as stage:
+            asyncio.run(divining_top.download_images([1, 2, 3], manifest))
+
+        assert manifest.get_missing_images([1, 2, 3]) == [2, 3]
+    finally:
+        manifest.close()
+
+    assert stage['rows']['downloaded'] == 1
+    assert stage['rows']['failed'] == 2
+
+    with open(divining_top.get_image_path(1), 'rb') as f:
+        assert f.read() == image
+    assert not path.exists(divining_top.get_image_path(2))
+
+    request_counts = dict((request_path, 0) for (request_path, headers) in scripted_server.requests)
+    for (request_path, headers) in scripted_server.requests:
+        request_counts[request_path] += 1
+
+    # An error page is a complete response, so it isn't retried
+    assert request_counts == {'/image/1': 2, '/image/2': 1, '/image/3': 3}
+
+
+def test_unchanged_set_files_are_revalidated_rather_than_downloaded(monkeypatch, tmp_path, metrics):
+
+    all_sets = benchmark.generate_all_sets(1, 1)
+    all_sets = dict(sorted(all_sets.items())[:3])
+
+    server = benchmark.start_set_file_server()
+    server.set_files = benchmark.get_set_files(all_sets)
+
+    monkeypatch.setattr(divining_top.options, 'sets_url', 'http://127.0.0.1:{0}'.format(server.server_address[1]))
+    monkeypatch.setattr(divining_top, 'sets_folder', str(tmp_path / 'sets'))
+    monkeypatch.setattr(divining_top, 'set_manifest_file', str(tmp_path / 'sets' / 'manifest.json'))
+
+    try:
+        with metrics.stage('download') as first:
+            assert divining_top.download_set_files()
+
+        with metrics.stage('revalidation') as second:
+            assert not divining_top.download_set_files()
+
+        all_sets['S001']['name'] = 'Renamed Synthetic Set'
+        server.set_files = benchmark.get_set_files(all_sets)
+
+        with metrics.stage('update') as third:
+            assert divining_top.download_set_files()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    assert first['rows'].get('downloaded') == 3
+    assert second['rows'].get('downloaded') is None
+    assert second['rows']['skipped'] == 3
+    assert third['rows'].get('downloaded') == 1
+    assert third['rows']['skipped'] == 2
+
+    with open(divining_top.set_manifest_file, 'r', encoding='utf8') as f:
+        entries = dict((entry['code'], entry) for entry in json.load(f))
+
+    for (set_code, set_data) in all_sets.items():
+        (content, etag) = server.set_files['{0}-x.json'.format(set_code)]
+
+        assert entries[set_code]['etag'] == etag
+        assert entries[set_code]['sha1'] == hashlib.sha1(content).hexdigest()
+
+        with open(divining_top.get_set_file_path(set_code), 'rb') as f:
+            assert f.read() == content
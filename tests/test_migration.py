@@ -0,0 +1,158 @@
+import datetime
+import sqlite3
+
+import pytest
+
+for module in ['aiohttp', 'mysql.connector', 'numpy', 'psycopg2', 'requests']:
+    pytest.importorskip(module)
+
+import divining_top  # noqa: E402
+
+
+class MysqlStandIn:
+    """
+    Stands in for mysql.connector with a SQLite database of the usercards,
+    usercardchanges and cards tables, recording how the migration reads them
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.buffered = []
+        self.fetch_sizes = []
+
+    def connect(self, **connect_params):
+        return MysqlStandInConnection(self)
+
+
+class MysqlStandInConnection:
+
+    def __init__(self, stand_in):
+        self.stand_in = stand_in
+        self.connection = sqlite3.connect(stand_in.file_name, detect_types=sqlite3.PARSE_DECLTYPES)
+
+    def cursor(self, buffered=None):
+        self.stand_in.buffered.append(buffered)
+        return MysqlStandInCursor(self.stand_in, self.connection.cursor())
+
+    def close(self):
+        self.connection.close()
+
+
+class MysqlStandInCursor:
+
+    def __init__(self, stand_in, cursor):
+        self.stand_in = stand_in
+        self.cursor = cursor
+
+    def execute(self, query, params=()):
+        self.cursor.execute(query.replace('%s', '?'), params)
+
+    def fetchmany(self, size):
+        self.stand_in.fetch_sizes.append(size)
+        return self.cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+
+class PostgresStandIn:
+    """
+    Stands in for the postgres connection, whose writes are recorded by
+    record_values in place of execute_values
+    """
+
+    def __init__(self):
+        self.writes = []
+
+    def cursor(self):
+        return self
+
+    def close(self):
+        pass
+
+    def record_values(self, cursor, query, rows, page_size=100):
+        table = query.split('INSERT INTO ')[1].split()[0]
+        self.writes.append((table, list(rows)))
+
+
+@pytest.fixture
+def mysql_stand_in(monkeypatch, tmp_path):
+
+    file_name = str(tmp_path / 'mysql.sqlite3')
+
+    connection = sqlite3.connect(file_name)
+    connection.executescript("""
+CREATE TABLE cards (id INTEGER PRIMARY KEY, name TEXT);
+CREATE TABLE usercards (id INTEGER PRIMARY KEY, ownerid INTEGER, cardid INTEGER, count INTEGER, setcode TEXT);
+CREATE TABLE usercardchanges (
+    id INTEGER PRIMARY KEY,
+    userid INTEGER,
+    cardid INTEGER,
+    setcode TEXT,
+    datemodified TIMESTAMP,
+    difference INTEGER
+);
+""")
+    connection.executemany("INSERT INTO cards VALUES (?, ?)", [(1, 'Card A'), (2, 'Card B')])
+    connection.executemany("INSERT INTO usercards VALUES (?, ?, ?, ?, ?)", [
+        (1, 1, 1, 2, 'S00'),
+        (2, 2, 1, 1, 'S00'),
+        # A second row for a physical card the user already owns
+        (3, 1, 1, 5, 'S00'),
+        (4, 1, 2, 3, 'S01'),
+        (5, 3, 2, 1, 'S01'),
+    ])
+    connection.executemany("INSERT INTO usercardchanges VALUES (?, ?, ?, ?, ?, ?)", [
+        (index + 1, user_id, card_id, setcode, datetime.datetime(2015, 1, 1, 0, index), difference)
+        for (index, (user_id, card_id, setcode, difference))
+        in enumerate([(1, 1, 'S00', 2), (2, 1, 'S00', 1), (1, 2, 'S01', 3), (3, 2, 'S01', -1), (1, 1, 'S00', -1)])
+    ])
+    connection.commit()
+    connection.close()
+
+    stand_in = MysqlStandIn(file_name)
+    monkeypatch.setattr(divining_top.mysql.connector, 'connect', stand_in.connect)
+    monkeypatch.setattr(divining_top.options, 'mysql_connection_string', 'user=test;database=test')
+
+    return stand_in
+
+
+@pytest.mark.parametrize('staged', [False, True])
+def test_migration_streams_users_in_batches(monkeypatch, mysql_stand_in, staged):
+
+    postgres = PostgresStandIn()
+    monkeypatch.setattr(divining_top, 'execute_values', postgres.record_values)
+    monkeypatch.setattr(divining_top, 'migration_batch_size', 2)
+
+    physical_ids = {('Card A', 'S00'): 10, ('Card B', 'S01'): 20}
+    owner_ids = {1: 101, 2: 102}
+
+    divining_top.migrate_users([1, 2], owner_ids, physical_ids, postgres, staged=staged)
+
+    assert mysql_stand_in.buffered == [False]
+    assert set(mysql_stand_in.fetch_sizes) == {2}
+
+    owned_card_rows = [row for (table, rows) in postgres.writes if table.endswith('userownedcard') for row in rows]
+    change_rows = [row for (table, rows) in postgres.writes if table.endswith('usercardchange') for row in rows]
+
+    # The rows of user 3, who isn't migrated, are never read, and only the
+    # first row for each physical card a user owns is kept
+    expected_owned_cards = [(1, 2, 10, 101), (2, 1, 10, 102), (4, 3, 20, 101)]
+    expected_changes = [
+        (1, 2, 10, 101, datetime.datetime(2015, 1, 1, 0, 0)),
+        (2, 1, 10, 102, datetime.datetime(2015, 1, 1, 0, 1)),
+        (3, 3, 20, 101, datetime.datetime(2015, 1, 1, 0, 2)),
+        (5, -1, 10, 101, datetime.datetime(2015, 1, 1, 0, 4)),
+    ]
+
+    if staged:
+        assert owned_card_rows == expected_owned_cards
+        assert change_rows == expected_changes
+        assert all(table.startswith('divining_top_staging_') for (table, rows) in postgres.writes)
+    else:
+        assert owned_card_rows == [row[1:] for row in expected_owned_cards]
+        assert change_rows == [row[1:] for row in expected_changes]
+        assert all(table.startswith('spellbook_') for (table, rows) in postgres.writes)
+
+    # Each batch is written as soon as it has been read
+    assert len(postgres.writes) == 4